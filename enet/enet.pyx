@@ -1,8 +1,11 @@
 import atexit
 
 from cpython cimport bool
+from cpython.buffer cimport (PyObject_GetBuffer, PyBuffer_Release, 
+    PyBUF_SIMPLE)
 
 from libc.stddef cimport ptrdiff_t
+from libc.stdlib cimport malloc, realloc, free
 
 cdef extern from "enet/types.h":
     ctypedef unsigned char enet_uint8
@@ -306,7 +309,7 @@ cdef class Address:
 
 cdef class Packet:
     """
-    Packet (str dataContents, int flags)
+    Packet (dataContents, int flags)
 
     ATTRIBUTES
 
@@ -332,14 +335,26 @@ cdef class Packet:
 
         An ENet data packet that may be sent to or received from a peer.
 
+        dataContents can be a str or any object that supports the buffer
+        interface, in which case its data is copied straight into the
+        packet.
+
     """
 
     cdef ENetPacket *_enet_packet
     cdef bool sent
 
     def __init__(self, data=None, flags=0):
-        if data is not None:
+        cdef Py_buffer view
+        if isinstance(data, str):
             self._enet_packet = enet_packet_create(data, len(data), flags)
+        elif data is not None:
+            PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+            try:
+                self._enet_packet = enet_packet_create(<char*>view.buf, view.len, 
+                    flags)
+            finally:
+                PyBuffer_Release(&view)
 
         # This will get set to True when a peer.send() is called with the Packet
         # to ensure we don't try to destroy this packet as ENET will handle that
@@ -779,6 +794,87 @@ cdef class Peer:
             if self.check_valid():
                 return self._enet_peer.eventData
 
+cdef class PeerGroup:
+    """
+    PeerGroup ()
+
+    DESCRIPTION
+
+        A fixed list of peers that a single Packet can be queued to at once.
+
+        The peers are kept as plain ENetPeer pointers, so the group has to be
+        cleared and filled again whenever one of its peers disconnects.
+
+    """
+
+    cdef ENetPeer **_peers
+    cdef int _count
+    cdef int _size
+
+    def __dealloc__(self):
+        free(self._peers)
+
+    def __len__(self):
+        return self._count
+
+    def add(self, Peer peer):
+        """
+        add (Peer peer)
+
+        Adds a peer to the group.
+        """
+
+        cdef ENetPeer **peers
+        if peer.check_valid():
+            if self._count == self._size:
+                if self._size == 0:
+                    self._size = 8
+                else:
+                    self._size *= 2
+                peers = <ENetPeer**>realloc(self._peers,
+                    self._size * sizeof(ENetPeer*))
+                if peers == NULL:
+                    raise MemoryError()
+                self._peers = peers
+            self._peers[self._count] = peer._enet_peer
+            self._count += 1
+
+    def clear(self):
+        """
+        clear ()
+
+        Removes all peers from the group.
+        """
+
+        self._count = 0
+
+    def send(self, enet_uint8 channelID, Packet packet, Peer exclude=None):
+        """
+        send (int channelID, Packet packet, Peer exclude=None)
+
+        Queues a packet to be sent to every peer in the group except
+        'exclude'.
+
+        returns the number of peers the packet was queued for
+        """
+
+        cdef ENetPeer *skip = NULL
+        cdef ENetPacket *enet_packet
+        cdef int i, sent = 0
+        if not packet.is_valid():
+            return 0
+        if exclude is not None:
+            skip = exclude._enet_peer
+        enet_packet = packet._enet_packet
+        for i in range(self._count):
+            if self._peers[i] == skip:
+                continue
+            if enet_peer_send(self._peers[i], channelID, enet_packet) == 0:
+                sent += 1
+        if sent:
+            packet.sent = True
+        return sent
+
 cdef class Event:
     """
     Event ()
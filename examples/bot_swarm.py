@@ -0,0 +1,320 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Headless load generator. Connects a swarm of bots to a server, lets them
+join and act out a pattern, and reports join latency, traffic and (with
+--status pointing at the status server) the server's tick times.
+
+    python bot_swarm.py 127.0.0.1 --count 32 --pattern mixed --duration 60
+"""
+
+import sys
+sys.path.append('..')
+
+import math
+import json
+import random
+import argparse
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from pyspades.protocol import BaseConnection, BaseProtocol
+from pyspades.packet import read_server_packet
+from pyspades.constants import *
+from pyspades.common import make_color
+from pyspades.tools import get_percentiles
+from pyspades.web import getPage
+from pyspades import contained as loaders
+
+PATTERNS = ('idle', 'walk', 'shoot', 'build', 'dig', 'mixed')
+
+# packets reused by every bot
+existing_player = loaders.ExistingPlayer()
+map_cached = loaders.MapCached()
+position_data = loaders.PositionData()
+orientation_data = loaders.OrientationData()
+input_data = loaders.InputData()
+weapon_input = loaders.WeaponInput()
+set_tool = loaders.SetTool()
+set_color = loaders.SetColor()
+block_action = loaders.BlockAction()
+
+class BotConnection(BaseConnection):
+    swarm = None
+    index = None
+    player_id = None
+    position = None
+    connect_time = None
+    map_crc = None
+    map_cached = False
+    joined = False
+    action_loop = None
+    step = 0
+
+    def on_connect(self):
+        self.connect_time = reactor.seconds()
+
+    def on_disconnect(self):
+        if self.action_loop is not None and self.action_loop.running:
+            self.action_loop.stop()
+        self.swarm.bot_disconnected(self)
+
+    def loader_received(self, loader, channel):
+        contained = read_server_packet(loader.data)
+        if contained.id == loaders.MapStart.id:
+            self.map_crc = contained.crc
+            # like the client, skip the download if we already have the map
+            self.map_cached = self.map_crc in self.swarm.map_crcs
+            map_cached.cached = int(self.map_cached)
+            self.send_contained(map_cached)
+        elif contained.id == loaders.StateData.id:
+            if not self.map_cached:
+                self.swarm.map_crcs.add(self.map_crc)
+            self.player_id = contained.player_id
+            self.send_join()
+        elif contained.id == loaders.CreatePlayer.id:
+            if contained.player_id != self.player_id:
+                return
+            self.position = [contained.x, contained.y, contained.z]
+            if not self.joined:
+                self.joined = True
+                self.swarm.bot_joined(self)
+                self.start_actions()
+
+    def send_join(self):
+        existing_player.player_id = self.player_id
+        existing_player.team = self.index % 2
+        existing_player.weapon = RIFLE_WEAPON
+        existing_player.tool = WEAPON_TOOL
+        existing_player.kills = 0
+        existing_player.color = make_color(112, 112, 112)
+        existing_player.name = 'bot%s' % self.index
+        self.send_contained(existing_player)
+
+    def start_actions(self):
+        self.action_loop = LoopingCall(self.act)
+        interval = 1.0 / self.swarm.rate
+        self.action_loop.start(interval, now = False)
+
+    def act(self):
+        self.step += 1
+        pattern = self.swarm.pattern
+        if pattern == 'mixed':
+            pattern = PATTERNS[1 + (self.index + self.step / 50) % 4]
+        if pattern == 'idle':
+            return
+        self.send_movement(pattern == 'walk')
+        if pattern == 'shoot':
+            self.send_tool(WEAPON_TOOL)
+            weapon_input.player_id = self.player_id
+            weapon_input.primary = self.step % 2 == 0
+            weapon_input.secondary = False
+            self.send_contained(weapon_input)
+        elif pattern == 'build':
+            self.send_tool(BLOCK_TOOL)
+            self.send_block(BUILD_BLOCK, self.step % 4)
+        elif pattern == 'dig':
+            self.send_tool(SPADE_TOOL)
+            self.send_block(DESTROY_BLOCK, self.step % 4)
+
+    def send_movement(self, walk):
+        angle = (self.index * 0.7 + self.step * 0.1) % (math.pi * 2)
+        orientation_data.x = math.cos(angle)
+        orientation_data.y = math.sin(angle)
+        orientation_data.z = 0.0
+        self.send_contained(orientation_data, True)
+        input_data.player_id = self.player_id
+        input_data.up = walk
+        input_data.down = False
+        input_data.left = False
+        input_data.right = False
+        input_data.jump = walk and self.step % 20 == 0
+        input_data.crouch = False
+        input_data.sneak = False
+        input_data.sprint = False
+        self.send_contained(input_data)
+        if walk:
+            # walk in a small circle around the spawn point
+            self.position[0] += math.cos(angle) * 0.1
+            self.position[1] += math.sin(angle) * 0.1
+        position_data.set(self.position)
+        self.send_contained(position_data, True)
+
+    def send_tool(self, tool):
+        set_tool.player_id = self.player_id
+        set_tool.value = tool
+        self.send_contained(set_tool)
+        if tool == BLOCK_TOOL:
+            set_color.player_id = self.player_id
+            set_color.value = make_color(*random.choice(
+                ((255, 0, 0), (0, 255, 0), (0, 0, 255))))
+            self.send_contained(set_color)
+
+    def send_block(self, value, offset):
+        # act on the blocks right next to the bot's feet
+        x, y, z = self.position
+        block_action.player_id = self.player_id
+        block_action.value = value
+        block_action.x = int(x) + (1, 0, -1, 0)[offset]
+        block_action.y = int(y) + (0, 1, 0, -1)[offset]
+        block_action.z = int(z) + 2
+        self.send_contained(block_action)
+
+class SwarmProtocol(BaseProtocol):
+    def __init__(self, count):
+        # every bot needs its own enet peer
+        self.max_connections = count
+        BaseProtocol.__init__(self)
+
+class BotSwarm(object):
+    def __init__(self, host, port, count, pattern, rate, stagger,
+                 status_url = None):
+        self.host = host
+        self.port = port
+        self.count = count
+        self.pattern = pattern
+        self.rate = rate
+        self.stagger = stagger
+        self.status_url = status_url
+        self.map_crcs = set()
+        self.bots = []
+        self.join_times = []
+        self.disconnects = 0
+        self.tick_samples = []
+        self.traffic_samples = []
+        self.map_transfer = None
+        self.protocol = SwarmProtocol(count)
+        self.last_sample = None
+
+    def start(self):
+        for index in xrange(self.count):
+            reactor.callLater(index * self.stagger, self.connect_bot, index)
+        self.sample_loop = LoopingCall(self.sample)
+        self.sample_loop.start(1.0, now = False)
+
+    def connect_bot(self, index):
+        connection = self.protocol.connect(BotConnection, self.host,
+            self.port, GAME_VERSION)
+        connection.swarm = self
+        connection.index = index
+        self.bots.append(connection)
+
+    def bot_joined(self, bot):
+        self.join_times.append(reactor.seconds() - bot.connect_time)
+
+    def bot_disconnected(self, bot):
+        self.disconnects += 1
+
+    def sample(self):
+        host = self.protocol.host
+        current_time = reactor.seconds()
+        sample = (current_time, host.totalSentData, host.totalReceivedData)
+        if self.last_sample is not None:
+            last_time, last_sent, last_received = self.last_sample
+            dt = current_time - last_time
+            # the enet counters are 32-bit
+            sent = (sample[1] - last_sent) % (1 << 32)
+            received = (sample[2] - last_received) % (1 << 32)
+            self.traffic_samples.append((sent / dt, received / dt))
+        self.last_sample = sample
+        if self.status_url is not None:
+            getPage(self.status_url).addCallbacks(self.status_received,
+                self.status_failed)
+        sent, received = (self.traffic_samples[-1] if self.traffic_samples
+            else (0, 0))
+        print '%s joined, %s disconnected, server in %s B/s, out %s B/s' % (
+            len(self.join_times), self.disconnects, int(sent), int(received))
+
+    def status_received(self, data):
+        status = json.loads(data)
+        tick_times = status.get('tickTimes', None)
+        if tick_times is not None:
+            self.tick_samples.append(tick_times)
+        self.map_transfer = status.get('mapTransfer', self.map_transfer)
+
+    def status_failed(self, failure):
+        print 'could not get status: %s' % failure.getErrorMessage()
+
+    def report(self):
+        print
+        print 'bots: %s, joined: %s, disconnected: %s' % (self.count,
+            len(self.join_times), self.disconnects)
+        print_percentiles('join latency (ms)',
+            [value * 1000.0 for value in self.join_times])
+        print_percentiles('server inbound (B/s)',
+            [sent for (sent, received) in self.traffic_samples])
+        print_percentiles('server outbound (B/s)',
+            [received for (sent, received) in self.traffic_samples])
+        if self.tick_samples:
+            print_percentiles('server tick p50 (ms)',
+                [item['p50'] for item in self.tick_samples
+                    if item['p50'] is not None])
+            print_percentiles('server tick p99 (ms)',
+                [item['p99'] for item in self.tick_samples
+                    if item['p99'] is not None])
+        elif self.status_url is not None:
+            print 'no tick times received from %s' % self.status_url
+        if self.map_transfer is not None:
+            print_summary('server map transfer (ms)',
+                self.map_transfer['time'])
+            print_summary('server map bytes/tick', self.map_transfer['bytes'])
+
+def print_percentiles(name, values):
+    if not values:
+        print '%-24s no samples' % name
+        return
+    percentiles = get_percentiles(values)
+    print '%-24s p50 %10.2f  p95 %10.2f  p99 %10.2f  max %10.2f' % (name,
+        percentiles[50], percentiles[95], percentiles[99], max(values))
+
+def print_summary(name, item):
+    if item is None:
+        print '%-24s no samples' % name
+        return
+    print '%-24s p50 %10.2f  p95 %10.2f  p99 %10.2f  max %10.2f' % (name,
+        item['p50'], item['p95'], item['p99'], item['max'])
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip(),
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('host', nargs = '?', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 32887)
+    parser.add_argument('--count', type = int, default = 16,
+        help = 'number of bots')
+    parser.add_argument('--pattern', choices = PATTERNS, default = 'mixed')
+    parser.add_argument('--rate', type = float, default = 10.0,
+        help = 'actions per second for every bot')
+    parser.add_argument('--stagger', type = float, default = 0.1,
+        help = 'seconds between bot connects')
+    parser.add_argument('--duration', type = float, default = 60.0,
+        help = 'seconds to run before reporting')
+    parser.add_argument('--status', default = None,
+        help = 'status server json url, e.g. http://127.0.0.1:32886/json')
+    args = parser.parse_args()
+
+    swarm = BotSwarm(args.host, args.port, args.count, args.pattern,
+        args.rate, args.stagger, args.status)
+    swarm.start()
+    def stop():
+        swarm.report()
+        reactor.stop()
+    reactor.callLater(args.duration, stop)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
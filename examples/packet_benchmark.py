@@ -0,0 +1,47 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Times decoding every packet type in CONTAINED_LIST, once with a new loader
+and reader for every packet and once with the pooled read_client_packet
+"""
+
+import sys
+import timeit
+from pyspades.bytes import ByteReader
+from pyspades.packet import (CONTAINED_LIST, load_client_packet,
+    read_client_packet)
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+# every loader reads at most this many bytes of zeros without failing
+PAYLOAD_SIZE = 64
+
+print '%-20s %12s %12s' % ('packet', 'new (us)', 'pooled (us)')
+for item in CONTAINED_LIST:
+    data = chr(item.id) + '\x00' * PAYLOAD_SIZE
+    try:
+        load_client_packet(ByteReader(data))
+    except Exception, e:
+        print '%-20s skipped (%s)' % (item.__name__, e)
+        continue
+    new_time = timeit.timeit(lambda: load_client_packet(ByteReader(data)),
+        number = COUNT)
+    pooled_time = timeit.timeit(lambda: read_client_packet(data),
+        number = COUNT)
+    print '%-20s %12.3f %12.3f' % (item.__name__, new_time * 1e6 / COUNT,
+        pooled_time * 1e6 / COUNT)
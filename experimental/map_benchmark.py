@@ -0,0 +1,126 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory and speed of VXLData on the stock maps. Run from this directory:
+
+    python map_benchmark.py [seed]
+
+Memory is measured as the growth of the process RSS, so it is only
+reported on systems that have /proc.
+"""
+
+import sys
+sys.path.append('..')
+
+import os
+import imp
+import time
+import random
+
+from pyspades.vxl import VXLData
+
+MAP_DIRS = ['../feature_server/maps', '../data']
+COPIES = 4
+COLOR_READS = 1000000
+
+def get_rss():
+    try:
+        statm = open('/proc/self/statm').read().split()
+    except IOError:
+        return None
+    return int(statm[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def format_size(value):
+    if value is None:
+        return 'n/a'
+    return '%.1f MB' % (value / (1024.0 * 1024.0))
+
+def load_maps(seed):
+    for directory in MAP_DIRS:
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            base, ext = os.path.splitext(name)
+            if ext == '.vxl':
+                yield name, lambda path = path: VXLData(open(path, 'rb'))
+            elif ext == '.txt':
+                info = imp.load_source(base, path)
+                gen_script = getattr(info, 'gen_script', None)
+                if gen_script is None:
+                    continue
+                def generate(base = base, gen_script = gen_script):
+                    random.seed(seed)
+                    return gen_script(base, seed)
+                yield '%s#%s' % (base, seed), generate
+
+def timed(func, *arg):
+    start = time.time()
+    value = func(*arg)
+    return time.time() - start, value
+
+def read_colors(map):
+    get_color = map.get_color
+    get_z = map.get_z
+    randint = random.randint
+    points = []
+    for _ in xrange(COLOR_READS):
+        x = randint(0, 511)
+        y = randint(0, 511)
+        points.append((x, y, get_z(x, y)))
+    start = time.time()
+    for x, y, z in points:
+        get_color(x, y, z)
+    return time.time() - start
+
+def benchmark(name, load):
+    rss = get_rss()
+    dt, map = timed(load)
+    map_size = None
+    if rss is not None:
+        map_size = get_rss() - rss
+    print '%s' % name
+    print '  load:           %.3f s, %s' % (dt, format_size(map_size))
+
+    rss = get_rss()
+    copies = []
+    start = time.time()
+    for _ in xrange(COPIES):
+        copies.append(map.copy())
+    dt = (time.time() - start) / COPIES
+    copy_size = None
+    if rss is not None:
+        copy_size = (get_rss() - rss) / COPIES
+    print '  copy:           %.3f s, %s' % (dt, format_size(copy_size))
+
+    print '  %s get_color: %.3f s' % (COLOR_READS, read_colors(map))
+    print '  generate:       %.3f s' % timed(map.generate)[0]
+    print '  update_shadows: %.3f s' % timed(map.update_shadows)[0]
+    # keep the maps alive so freed memory is not reused by the next one
+    return map, copies
+
+def main():
+    seed = 1
+    if len(sys.argv) > 1:
+        seed = int(sys.argv[1])
+    maps = []
+    for name, load in load_maps(seed):
+        maps.append(benchmark(name, load))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checks World.get_nearest_characters against a brute force search, with
+query points right next to cell edges
+"""
+
+import sys
+sys.path.append('..')
+
+import random
+from pyspades.common import Vertex3
+from pyspades import world
+
+CELL_SIZE = 16.0
+
+def brute_force(characters, x, y, z, count, max_distance):
+    found = []
+    for character in characters:
+        px, py, pz = character.position.get()
+        distance = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+        if max_distance is None or distance <= max_distance ** 2:
+            found.append((distance, character))
+    found.sort()
+    return [character for (distance, character) in found[:count]]
+
+def create_character(new_world, x, y, z):
+    return new_world.create_object(world.Character, Vertex3(x, y, z),
+        Vertex3())
+
+# a query point at the edge of its cell, with one character just across the
+# edge in the next ring and one further away in the same cell
+new_world = world.World()
+near = create_character(new_world, CELL_SIZE + 0.1, 8.0, 0.0)
+far = create_character(new_world, 0.5, 8.0, 0.0)
+x, y, z = CELL_SIZE - 0.1, 8.0, 0.0
+assert new_world.get_nearest_characters(x, y, z) == [near]
+assert new_world.get_nearest_characters(x, y, z, 2) == [near, far]
+assert new_world.get_nearest_characters(x, y, z, 2, 1.0) == [near]
+
+# the same with a character two rings out but still within max_distance
+new_world = world.World()
+near = create_character(new_world, 2 * CELL_SIZE + 0.1, 8.0, 0.0)
+assert new_world.get_nearest_characters(x, y, z, 1, CELL_SIZE + 1.0) == [
+    near]
+
+random.seed(0)
+for _ in xrange(200):
+    new_world = world.World()
+    characters = [create_character(new_world, random.uniform(0, 128),
+        random.uniform(0, 128), random.uniform(0, 64))
+        for _ in xrange(random.randint(1, 30))]
+    # snap the query to a cell edge half of the time
+    x = random.uniform(0, 128)
+    if random.random() < 0.5:
+        x = round(x / CELL_SIZE) * CELL_SIZE - 0.01
+    y = random.uniform(0, 128)
+    z = random.uniform(0, 64)
+    count = random.randint(1, 5)
+    max_distance = random.choice([None, random.uniform(1, 64)])
+    expected = brute_force(characters, x, y, z, count, max_distance)
+    assert new_world.get_nearest_characters(x, y, z, count,
+        max_distance) == expected
+
+print 'ok'
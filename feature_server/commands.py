@@ -751,6 +751,7 @@ def change_planned_map(connection, *pre_maps):
     
     map = maps[0]
     protocol.planned_map = check_rotation([map])[0]
+    protocol.preload_map(protocol.planned_map)
     protocol.send_chat('%s changed next map to %s' % (name, map), irc = True)
 
 @name('rotation')
@@ -880,6 +881,31 @@ def server_info(connection):
         msg += ' at %s' % protocol.identifier
     return msg
 
+@admin
+def bandwidth(connection):
+    stats = connection.protocol.get_broadcast_stats()[:5]
+    if not stats:
+        return 'No broadcasts sent yet'
+    return 'Top broadcasts: %s' % (', '.join('%s %s KB (%s packets)' % (
+        name, size / 1024, packets) for name, _, packets, size in stats))
+
+@name('tickprofile')
+@admin
+def tick_profile(connection, section = None):
+    summary = connection.protocol.profiler.get_summary()
+    if section is not None:
+        if section not in summary:
+            return 'No timings for %s' % section
+        item = summary[section]
+        return '%s: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+            section, item['p50'], item['p95'], item['p99'], item['max'])
+    items = sorted(summary.iteritems(), key = lambda item: item[1]['p99'],
+        reverse = True)[:6]
+    if not items:
+        return 'No ticks profiled yet'
+    return 'Slowest sections (p99): %s' % (', '.join('%s %.2f ms' % (
+        name, item['p99']) for name, item in items))
+
 def scripts(connection):
     scripts = connection.protocol.config.get('scripts', [])
     return 'Scripts enabled: %s' % (', '.join(scripts))
@@ -960,6 +986,8 @@ command_list = [
     ping,
     version,
     server_info,
+    bandwidth,
+    tick_profile,
     scripts,
     weapon,
     mapname
@@ -15,14 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
-from pyspades.vxl import VXLData
+from pyspades.vxl import VXLData, load_dump
 
 import os
 import imp
 import math
 import random
+import zlib
 
 DEFAULT_LOAD_DIR = './maps'
+DEFAULT_CACHE_DIR = './maps/cache'
 
 class MapNotFound(Exception):
     def __init__(self, map):
@@ -43,21 +45,32 @@ def check_rotation(maps, load_dir = DEFAULT_LOAD_DIR):
             raise MapNotFound(map)
     return infos
 
+# picks seeds for generated maps without touching the global random module
+seed_random = random.Random()
+
 class Map(object):
-    def __init__(self, rot_info, load_dir = DEFAULT_LOAD_DIR):
+    data = None
+    seed = None
+
+    def __init__(self, rot_info, load_dir = DEFAULT_LOAD_DIR, 
+                 cache_dir = DEFAULT_CACHE_DIR, generate = True):
+        """
+        With generate set to False, generated maps are only loaded from the
+        cache, and generate() has to be called before the map is used
+        """
+        self.cache_dir = cache_dir
         self.load_information(rot_info, load_dir)
         
         if self.gen_script:
-            seed = rot_info.get_seed()
-            self.name = '%s #%s' % (rot_info.name, seed)
-            print "Generating map '%s'..." % self.name
-            random.seed(seed)
-            self.data = self.gen_script(rot_info.name, seed)
+            self.seed = rot_info.get_seed()
+            self.name = '%s #%s' % (rot_info.name, self.seed)
+            self.generate(cache_only = not generate)
         else:
             print "Loading map '%s'..." % self.name
             self.load_vxl(rot_info, load_dir)
 
-        print 'Map loaded successfully.'
+        if self.data is not None:
+            print 'Map loaded successfully.'
 
     def load_information(self, rot_info, load_dir):
         try:
@@ -65,6 +78,10 @@ class Map(object):
         except IOError:
             info = None
         self.info = info
+        self.meta_crc = None
+        if info is not None:
+            with open(rot_info.get_meta_filename(), 'rb') as fp:
+                self.meta_crc = zlib.crc32(fp.read()) & 0xffffffff
         self.rot_info = rot_info
         self.gen_script = getattr(info, 'gen_script', None)
         if self.gen_script:
@@ -86,6 +103,9 @@ class Map(object):
         self.on_map_leave = getattr(info, 'on_map_leave', None)
         self.on_block_destroy = getattr(info, 'on_block_destroy', None)
         self.is_indestructable = getattr(info, 'is_indestructable', None)
+        # boxes of (x1, y1, z1, x2, y2, z2) that can't be destroyed, which
+        # unlike is_indestructable don't need a python call per voxel
+        self.protected_regions = getattr(info, 'protected_regions', [])
         
     def apply_script(self, protocol, connection, config):
         if self.script is not None:
@@ -97,8 +117,105 @@ class Map(object):
             fp = open(rot_info.get_map_filename(load_dir), 'rb')
         except OSError:
             raise MapNotFound(rot_info.name)
-        self.data = VXLData(fp)
+        crc = zlib.crc32(fp.read()) & 0xffffffff
+        cache_name = '%s-%08x' % (rot_info.name, crc)
+        self.data = self.load_cache(cache_name)
+        if self.data is None:
+            fp.seek(0)
+            self.data = VXLData(fp)
+            self.save_cache(cache_name)
         fp.close()
+    
+    def generate(self, cache_only = False):
+        """
+        Generates the map if that has not been done yet. Gen scripts use the
+        global random module, so this has to run on the reactor thread
+        """
+        if self.data is not None:
+            return
+        rot_info = self.rot_info
+        seed = self.seed
+        # generated maps are cached by seed and by the script they came from,
+        # but only for a fixed seed, since a random one is never seen again
+        cache_name = None
+        if rot_info.seed is not None:
+            cache_name = '%s-%s-%08x' % (rot_info.name, seed, self.meta_crc)
+            self.data = self.load_cache(cache_name)
+            if self.data is not None or cache_only:
+                return
+        elif cache_only:
+            return
+        print "Generating map '%s'..." % self.name
+        # seed the script, then put back the random state the game was using
+        state = random.getstate()
+        random.seed(seed)
+        try:
+            self.data = self.gen_script(rot_info.name, seed)
+        finally:
+            random.setstate(state)
+        if cache_name is not None:
+            self.save_cache(cache_name)
+        print 'Map generated successfully.'
+    
+    def get_cache_filename(self, cache_name):
+        return os.path.join(self.cache_dir, '%s.cache' % cache_name)
+    
+    def load_cache(self, cache_name):
+        """
+        Returns the map in the cache under cache_name, or None if there is
+        no usable one
+        """
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self.get_cache_filename(cache_name), 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            return None
+        return load_dump(data)
+    
+    def save_cache(self, cache_name):
+        if self.cache_dir is None:
+            return
+        filename = self.get_cache_filename(cache_name)
+        # maps can be loaded in a thread while another is being saved, so
+        # the file only appears under its real name once it is complete
+        temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(temp_filename, 'wb') as fp:
+                fp.write(self.data.dump())
+            if os.path.isfile(filename):
+                os.remove(filename)
+            os.rename(temp_filename, filename)
+        except (IOError, OSError), e:
+            print 'Could not cache map: %s' % e
+            return
+        self.remove_old_caches(cache_name)
+    
+    def remove_old_caches(self, cache_name):
+        """
+        Removes the caches of older versions of the map under cache_name,
+        i.e. the ones with the same name (and seed) but another crc
+        """
+        prefix = cache_name.rsplit('-', 1)[0]
+        try:
+            filenames = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            name, ext = os.path.splitext(filename)
+            if ext != '.cache' or name == cache_name:
+                continue
+            old_prefix, _, crc = name.rpartition('-')
+            if old_prefix != prefix or len(crc) != 8:
+                continue
+            try:
+                int(crc, 16)
+                os.remove(os.path.join(self.cache_dir, filename))
+            except (ValueError, OSError):
+                pass
 
 class RotationInfo(object):
     seed = None
@@ -114,8 +231,7 @@ class RotationInfo(object):
     def get_seed(self):
         if self.seed is not None:
             return self.seed
-        random.seed()
-        return random.randint(0, math.pow(2, 31))
+        return seed_random.randint(0, math.pow(2, 31))
         
     def get_map_name(self):
         return self.name
@@ -1,5 +1,8 @@
 from pyspades.ipaddr import IPNetwork
 
+import socket
+import struct
+
 cache = {}
 
 def get_network(cidr):
@@ -15,65 +18,141 @@ def get_cidr(network):
         return str(network.ip)
     return str(network)
 
+def get_key(key):
+    """
+    Returns (version, address, prefix length, address length) for an ip or
+    cidr string
+    """
+    if '/' not in key and ':' not in key:
+        # plain ipv4 addresses are what connections are checked with, so
+        # they skip IPNetwork
+        try:
+            return 4, struct.unpack('!I', socket.inet_aton(key))[0], 32, 32
+        except socket.error:
+            pass
+    network = get_network(key)
+    return (network._version, int(network.network), network._prefixlen,
+        network._max_prefixlen)
+
+class Entry(object):
+    __slots__ = ['network', 'value', 'index', 'node']
+
+    def __init__(self, network, value, index, node):
+        self.network = network
+        self.value = value
+        self.index = index
+        self.node = node
+
 class NetworkDict(object):
+    """
+    Maps networks to values. Looking up an ip or network gives the earliest
+    added entry whose network contains it.
+
+    Networks are kept in a binary trie on their address bits, with every
+    entry stored at the node for its prefix, so lookups only have to look at
+    the nodes along the path for the key.
+    """
     def __init__(self):
-        self.networks = []
-    
+        # a node is [child for bit 0, child for bit 1, entries]
+        self.roots = {}
+        # entries in the order they were added. removed entries are set to
+        # None and cleared out once they make up half the list
+        self.entries = []
+        self.count = 0
+        self.next_index = 0
+
     def read_list(self, values):
         for item in values:
             self[item[1]] = [item[0]] + item[2:]
-        
+
     def make_list(self):
         values = []
         for network, value in self.iteritems():
             values.append([value[0]] + [network] + list(value[1:]))
         return values
-    
+
+    def get_matches(self, key):
+        """
+        Returns the entries whose network contains key, earliest first
+        """
+        version, address, prefix, bits = get_key(key)
+        node = self.roots.get(version, None)
+        matches = []
+        depth = 0
+        while node is not None:
+            matches.extend(node[2])
+            if depth == prefix:
+                break
+            node = node[(address >> (bits - 1 - depth)) & 1]
+            depth += 1
+        if len(matches) > 1:
+            matches.sort(key = lambda entry: entry.index)
+        return matches
+
+    def remove_entry(self, entry):
+        entry.node[2].remove(entry)
+        self.entries[entry.index - self.next_index + len(self.entries)] = None
+        self.count -= 1
+        if self.count * 2 < len(self.entries):
+            entries = [item for item in self.entries if item is not None]
+            self.entries = entries
+            # indices are kept, so they still count from the end of the list
+            for new_index, item in enumerate(entries):
+                item.index = self.next_index - len(entries) + new_index
+
     def remove(self, key):
-        ip = get_network(key)
-        networks = []
         results = []
-        for item in self.networks:
-            network, value = item
-            if ip in network:
-                results.append(item)
-            else:
-                networks.append(item)
-        self.networks = networks
+        for entry in self.get_matches(key):
+            self.remove_entry(entry)
+            results.append((entry.network, entry.value))
         return results
-    
+
     def __setitem__(self, key, value):
-        self.networks.append((get_network(key), value))
-    
+        network = get_network(key)
+        version, address, prefix, bits = get_key(key)
+        try:
+            node = self.roots[version]
+        except KeyError:
+            node = self.roots[version] = [None, None, []]
+        for depth in xrange(prefix):
+            bit = (address >> (bits - 1 - depth)) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, []]
+            node = child
+        entry = Entry(network, value, self.next_index, node)
+        self.next_index += 1
+        node[2].append(entry)
+        self.entries.append(entry)
+        self.count += 1
+
     def __getitem__(self, key):
         return self.get_entry(key)[1]
-    
+
     def get_entry(self, key):
-        ip = get_network(key)
-        for entry in self.networks:
-            network, value = entry
-            if ip in network:
-                return entry
-        raise KeyError()
-    
+        matches = self.get_matches(key)
+        if not matches:
+            raise KeyError()
+        entry = matches[0]
+        return entry.network, entry.value
+
     def __len__(self):
-        return len(self.networks)
-    
-    def __delitem__(self, key, value):
-        ip = get_network(key)
-        self.networks = [item for item in self.networks if ip not in item]
-    
-    def pop(self, *arg, **kw):
-        network, value = self.networks.pop(*arg, **kw)
-        return get_cidr(network), value
-    
+        return self.count
+
+    def __delitem__(self, key):
+        if not self.remove(key):
+            raise KeyError()
+
+    def pop(self, index = -1):
+        entries = [entry for entry in self.entries if entry is not None]
+        entry = entries[index]
+        self.remove_entry(entry)
+        return get_cidr(entry.network), entry.value
+
     def iteritems(self):
-        for network, value in self.networks:
-            yield get_cidr(network), value
-    
+        for entry in self.entries[:]:
+            if entry is not None:
+                yield get_cidr(entry.network), entry.value
+
     def __contains__(self, key):
-        try:
-            self.get_entry(key)
-            return True
-        except KeyError:
-            return False
+        return len(self.get_matches(key)) > 0
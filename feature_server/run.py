@@ -86,9 +86,9 @@ if sys.version_info < (2, 7):
 import pyspades.debug
 from pyspades.server import (ServerProtocol, ServerConnection, position_data,
     grenade_packet, Team)
-from map import Map, MapNotFound, check_rotation
+from map import Map, MapNotFound, check_rotation, DEFAULT_CACHE_DIR
 from console import create_console
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.task import LoopingCall
 from twisted.python import log
 from twisted.python.logfile import DailyLogFile
@@ -98,6 +98,9 @@ from pyspades.constants import *
 from pyspades.master import MAX_SERVER_NAME_SIZE, get_external_ip
 from pyspades.tools import make_server_identifier
 from pyspades.types import AttributeSet
+from pyspades.events import EventBus, compile_events
+from pyspades.profiler import TickProfiler
+from pyspades.vxl import VoxelSet, RegionSet
 from networkdict import NetworkDict, get_network
 from pyspades.exceptions import InvalidData
 from pyspades.bytes import NoDataLeft
@@ -228,7 +231,7 @@ class FeatureConnection(ServerConnection):
             self.refill()
         if self.god_build:
             if self.protocol.god_blocks is None:
-                self.protocol.god_blocks = set()
+                self.protocol.god_blocks = VoxelSet()
             self.protocol.god_blocks.update(points)
         elif self.protocol.user_blocks is not None:
             self.protocol.user_blocks.update(points)
@@ -238,10 +241,10 @@ class FeatureConnection(ServerConnection):
             self.refill()
         if self.god_build:
             if self.protocol.god_blocks is None:
-                self.protocol.god_blocks = set()
-            self.protocol.god_blocks.add((x, y, z))
+                self.protocol.god_blocks = VoxelSet()
+            self.protocol.god_blocks.add(x, y, z)
         elif self.protocol.user_blocks is not None:
-            self.protocol.user_blocks.add((x, y, z))
+            self.protocol.user_blocks.add(x, y, z)
     
     def on_block_destroy(self, x, y, z, mode):
         map_on_block_destroy = self.protocol.map_info.on_block_destroy
@@ -259,22 +262,19 @@ class FeatureConnection(ServerConnection):
                 if is_indestructable(x, y, z):
                     return False
             elif mode == SPADE_DESTROY:
-                if (is_indestructable(x, y, z) or
-                is_indestructable(x, y, z + 1) or
-                is_indestructable(x, y, z - 1)):
+                if self.protocol.is_box_indestructable(x, y, z - 1,
+                x + 1, y + 1, z + 2):
                     return False
             elif mode == GRENADE_DESTROY:
-                for nade_x in xrange(x - 1, x + 2):
-                    for nade_y in xrange(y - 1, y + 2):
-                        for nade_z in xrange(z - 1, z + 2):
-                            if is_indestructable(nade_x, nade_y, nade_z):
-                                return False
+                if self.protocol.is_box_indestructable(x - 1, y - 1, z - 1,
+                x + 2, y + 2, z + 2):
+                    return False
     
     def on_block_removed(self, x, y, z):
         if self.protocol.user_blocks is not None:
-            self.protocol.user_blocks.discard((x, y, z))
+            self.protocol.user_blocks.discard(x, y, z)
         if self.protocol.god_blocks is not None:
-            self.protocol.god_blocks.discard((x, y, z))
+            self.protocol.god_blocks.discard(x, y, z)
     
     def on_hit(self, hit_amount, player, type, grenade):
         if not self.protocol.killing:
@@ -522,11 +522,16 @@ class FeatureProtocol(ServerProtocol):
     identifier = None
 
     planned_map = None
+    # [rot_info, map] for the map being loaded in the background, where map
+    # is None until loading has finished
+    preloading = None
+    last_map_swap_time = None
     
     map_info = None
     spawns = None
     user_blocks = None
     god_blocks = None
+    protected_regions = None
     
     last_time = None
     interface = None
@@ -602,9 +607,15 @@ class FeatureProtocol(ServerProtocol):
         self.default_ban_time = config.get('default_ban_duration', 24*60)
         
         self.speedhack_detect = config.get('speedhack_detect', True)
+        self.interest_distance = config.get('interest_distance', None)
+        self.interest_line_of_sight = config.get('interest_line_of_sight',
+            False)
+        self.map_transfer_rate = config.get('map_transfer_rate',
+            self.map_transfer_rate)
         if config.get('user_blocks_only', False):
-            self.user_blocks = set()
+            self.user_blocks = VoxelSet()
         self.set_god_build = config.get('set_god_build', False)
+        self.map_cache_dir = config.get('map_cache_dir', DEFAULT_CACHE_DIR)
         self.debug_log = config.get('debug_log', False)
         if self.debug_log:
             pyspades.debug.open_debug_log()
@@ -734,27 +745,85 @@ class FeatureProtocol(ServerProtocol):
         else:
             self.send_chat('%s Next map: %s.' % (message, map.full_name),
                            irc = True)
-            reactor.callLater(10, self.set_map_name, map)
+            self.preload_map(map)
+            reactor.callLater(10, self.set_preloaded_map_name, map)
     
     def get_mode_name(self):
         return self.game_mode_name
     
     def set_map_name(self, rot_info):
-        try:
-            map_info = self.get_map(rot_info)
-        except MapNotFound, e:
-            return e
+        start_time = time.time()
+        map_info = self.get_preloaded_map(rot_info)
+        if map_info is None:
+            try:
+                map_info = self.get_map(rot_info)
+            except MapNotFound, e:
+                return e
+        else:
+            # generated maps are only made here, on the reactor thread
+            map_info.generate()
         if self.map_info:
             self.on_map_leave()
         self.map_info = map_info
+        self.protected_regions = RegionSet()
+        for box in map_info.protected_regions:
+            self.protected_regions.add_box(*box)
         self.max_score = self.map_info.cap_limit or self.default_cap_limit
         self.set_map(self.map_info.data)
         self.set_time_limit(self.map_info.time_limit)
         self.update_format()
+        self.last_map_swap_time = time.time() - start_time
+        print 'Map swap stalled the server for %.3f seconds.' % (
+            self.last_map_swap_time)
         return True
     
-    def get_map(self, rot_info):
-        return Map(rot_info)
+    def get_map(self, rot_info, generate = True):
+        return Map(rot_info, cache_dir = self.map_cache_dir,
+            generate = generate)
+    
+    def preload_map(self, rot_info):
+        """
+        Starts loading a map in a background thread, so set_map_name can
+        swap it in without loading it first. Generated maps are left to be
+        generated by set_map_name, since gen scripts use the global random
+        module the game also uses
+        """
+        if self.preloading is not None and self.preloading[0] is rot_info:
+            return
+        # rotation info, loaded map and the deferred of the load
+        entry = self.preloading = [rot_info, None, None]
+        def on_loaded(map_info):
+            entry[1] = map_info
+        def on_failed(failure):
+            # set_map_name loads it again and reports the error then
+            pass
+        entry[2] = threads.deferToThread(self.get_map, rot_info,
+            False).addCallbacks(on_loaded, on_failed)
+    
+    def set_preloaded_map_name(self, rot_info):
+        """
+        Calls set_map_name for rot_info, after waiting for its preload to
+        finish if it is still running
+        """
+        entry = self.preloading
+        if entry is None or entry[0] is not rot_info or entry[2].called:
+            self.set_map_name(rot_info)
+            return
+        def on_done(result):
+            # someone may have changed the map in the meantime
+            if self.preloading is entry:
+                self.set_map_name(rot_info)
+        entry[2].addCallback(on_done)
+    
+    def get_preloaded_map(self, rot_info):
+        """
+        Returns the preloaded map for rot_info, or None if it did not load
+        """
+        entry = self.preloading
+        self.preloading = None
+        if entry is None or entry[0] is not rot_info:
+            return None
+        return entry[1]
     
     def set_map_rotation(self, maps, now = True):
         try:
@@ -771,11 +840,13 @@ class FeatureProtocol(ServerProtocol):
         return [map.full_name for map in self.maps]
     
     def is_indestructable(self, x, y, z):
+        if self.protected_regions.contains(x, y, z):
+            return True
         if self.user_blocks is not None:
-            if (x, y, z) not in self.user_blocks:
+            if not self.user_blocks.contains(x, y, z):
                 return True
         if self.god_blocks is not None:
-            if (x, y, z) in self.god_blocks:
+            if self.god_blocks.contains(x, y, z):
                 return True
         map_is_indestructable = self.map_info.is_indestructable
         if map_is_indestructable is not None:
@@ -783,6 +854,32 @@ class FeatureProtocol(ServerProtocol):
                 return True
         return False
     
+    def is_box_indestructable(self, x1, y1, z1, x2, y2, z2):
+        """
+        Returns True if any voxel in the box from (x1, y1, z1) up to but not
+        including (x2, y2, z2) is indestructable
+        """
+        if (self.is_indestructable.im_func is not
+                FeatureProtocol.is_indestructable.im_func or
+                self.map_info.is_indestructable is not None):
+            # the checks are not all compiled, so each voxel has to be asked
+            for x in xrange(x1, x2):
+                for y in xrange(y1, y2):
+                    for z in xrange(z1, z2):
+                        if self.is_indestructable(x, y, z):
+                            return True
+            return False
+        if self.protected_regions.any_in_box(x1, y1, z1, x2, y2, z2):
+            return True
+        if self.user_blocks is not None:
+            volume = (x2 - x1) * (y2 - y1) * (z2 - z1)
+            if self.user_blocks.count_in_box(x1, y1, z1, x2, y2, z2) < volume:
+                return True
+        if self.god_blocks is not None:
+            if self.god_blocks.any_in_box(x1, y1, z1, x2, y2, z2):
+                return True
+        return False
+    
     def update_format(self):
         """
         Called when the map (or other variables) have been updated
@@ -1023,11 +1120,27 @@ for script in script_names[:]:
         print "(script '%s' not found: %r)" % (script, e)
         script_names.remove(script)
 
+# scripts can subclass with apply_script, subscribe to events with
+# apply_events, or both. subscribed events are folded into the final classes
+# so that the server calls them without going through a chain of subclasses
+protocol_events = EventBus()
+connection_events = EventBus()
+
 for script in script_objects:
-    protocol_class, connection_class = script.apply_script(protocol_class,
-        connection_class, config)
+    if hasattr(script, 'apply_script'):
+        protocol_class, connection_class = script.apply_script(protocol_class,
+            connection_class, config)
+    if hasattr(script, 'apply_events'):
+        script.apply_events(protocol_events, connection_events, config)
 
 protocol_class.connection_class = connection_class
+# timing every script hook costs a little per call, so it is opt-in
+hook_profiler = None
+if config.get('profile_hooks', False):
+    hook_profiler = TickProfiler(protocol_class.tick_samples)
+    protocol_class.profiler = hook_profiler
+compile_events(protocol_class, protocol_events, hook_profiler)
+compile_events(connection_class, connection_events, hook_profiler)
 
 interface = config.get('network_interface', '')
 if interface == '':
@@ -7,6 +7,7 @@ Maintainer: hompy
 from twisted.internet.reactor import seconds
 from pyspades.collision import distance_3d_vector
 from pyspades.common import prettify_timespan
+from pyspades.vxl import VoxelSet
 from commands import add, admin, name, get_player, alias
 
 # "blockinfo" must be AFTER "votekick" in the config.txt script list
@@ -103,21 +104,19 @@ def apply_script(protocol, connection, config):
         
         def on_block_build(self, x, y, z):
             if self.protocol.block_info is None:
-                self.protocol.block_info = {}
+                self.protocol.block_info = VoxelSet()
             self.protocol.block_info[(x, y, z)] = (self.name, self.team.id)
             connection.on_block_build(self, x, y, z)
         
         def on_line_build(self, points):
             if self.protocol.block_info is None:
-                self.protocol.block_info = {}
-            name_team = (self.name, self.team.id)
-            for point in points:
-                self.protocol.block_info[point] = name_team
+                self.protocol.block_info = VoxelSet()
+            self.protocol.block_info.update(points, (self.name, self.team.id))
             connection.on_line_build(self, points)
         
         def on_block_removed(self, x, y, z):
             if self.protocol.block_info is None:
-                self.protocol.block_info = {}
+                self.protocol.block_info = VoxelSet()
             if self.blocks_removed is None:
                 self.blocks_removed = []
             pos = (x, y, z)
@@ -68,20 +68,27 @@ def apply_script(protocol, connection, config):
         def on_reset(self):
             self.painting = False
             connection.on_reset(self)
-        
-        def on_position_update(self):
-            if self.painting and self.world_object.sneak:
-                paint_ray(self)
-            connection.on_position_update(self)
-        
-        def on_orientation_update(self, x, y, z):
-            if self.painting and self.world_object.sneak:
-                paint_ray(self)
-            connection.on_orientation_update(self, x, y, z)
-        
-        def on_animation_update(self, jump, crouch, sneak, sprint):
-            if self.painting and sneak:
-                paint_ray(self)
-            return connection.on_animation_update(self, jump, crouch, sneak, sprint)
     
-    return protocol, PaintConnection
\ No newline at end of file
+    return protocol, PaintConnection
+
+def apply_events(protocol_events, connection_events, config):
+    def on_position_update(self):
+        if self.painting and self.world_object.sneak:
+            paint_ray(self)
+    
+    def on_orientation_update(self, x, y, z):
+        if self.painting and self.world_object.sneak:
+            paint_ray(self)
+    
+    def on_animation_update(self, jump, crouch, sneak, sprint):
+        if self.painting and sneak:
+            paint_ray(self)
+    
+    # paint used to be the outermost override, so it runs before the
+    # other scripts' handlers
+    connection_events.subscribe('on_position_update', on_position_update,
+        order = -1)
+    connection_events.subscribe('on_orientation_update',
+        on_orientation_update, order = -1)
+    connection_events.subscribe('on_animation_update', on_animation_update,
+        order = -1)
@@ -11,13 +11,21 @@ from pyspades.common import coordinates
 def protect(connection, value = None):
     protocol = connection.protocol
     if value is None:
+        if protocol.protected is not None:
+            for sector in protocol.protected:
+                protocol.protected_regions.remove_sector(*sector)
         protocol.protected = None
         protocol.send_chat('All areas unprotected', irc = True)
     else:
         if protocol.protected is None:
             protocol.protected = set()
         pos = coordinates(value)
-        protocol.protected.symmetric_difference_update([pos])
+        if pos in protocol.protected:
+            protocol.protected.discard(pos)
+            protocol.protected_regions.remove_sector(*pos)
+        else:
+            protocol.protected.add(pos)
+            protocol.protected_regions.add_sector(*pos)
         message = 'The area at %s is now %s' % (value.upper(),
             'protected' if pos in protocol.protected else 'unprotected')
         protocol.send_chat(message, irc = True)
@@ -48,18 +56,14 @@ def apply_script(protocol, connection, config):
         def on_map_change(self, map):
             self.protected = set(coordinates(s) for s in
                 getattr(self.map_info.info, 'protected', []))
+            # protocol.is_indestructable checks the sectors through these
+            for sector in self.protected:
+                self.protected_regions.add_sector(*sector)
             protocol.on_map_change(self, map)
         
-        def is_indestructable(self, x, y, z):
-            if self.is_protected(x, y, z):
-                return True
-            return protocol.is_indestructable(self, x, y, z)
-        
         def is_protected(self, x, y, z):
             if self.protected:
-                for sx, sy in self.protected:
-                    if x >= sx and y >= sy and x < sx + 64 and y < sy + 64:
-                        return True
+                return (x & ~63, y & ~63) in self.protected
             return False
     
     return ProtectProtocol, ProtectConnection
\ No newline at end of file
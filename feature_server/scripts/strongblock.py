@@ -12,6 +12,7 @@ from pyspades.server import block_action, set_color
 from pyspades.common import make_color
 from pyspades.color import rgb_distance
 from pyspades.constants import *
+from pyspades.vxl import VoxelSet
 
 DIRT_COLOR = (71, 48, 35)
 
@@ -32,7 +33,7 @@ def rebuild_block(player, x, y, z, color):
 
 def check_if_buried(protocol, x, y, z):
     if not protocol.map.is_surface(x, y, z):
-        protocol.strong_blocks.pop((x, y, z), None)
+        protocol.strong_blocks.discard(x, y, z)
 
 def bury_adjacent(protocol, x, y, z):
     check_if_buried(protocol, x, y, z - 1)
@@ -85,7 +86,7 @@ def apply_script(protocol, connection, config):
         strong_blocks = None
         
         def on_map_change(self, map):
-            self.strong_blocks = {}
+            self.strong_blocks = VoxelSet()
             protocol.on_map_change(self, map)
     
     return StrongBlockProtocol, StrongBlockConnection
\ No newline at end of file
@@ -147,6 +147,7 @@ class VoteMap(object):
             self.protocol.send_chat('Mapvote ended. Next map will be: %s.' % 
                 result, irc = True)
             self.protocol.planned_map = check_rotation([result])[0]
+            self.protocol.preload_map(self.protocol.planned_map)
         self.set_cooldown()
         
     def set_cooldown(self):
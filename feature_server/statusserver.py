@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.web import server
 from twisted.web.resource import Resource
 from string import Template
@@ -25,7 +25,13 @@ import json
 from cStringIO import StringIO
 
 STATUS_NAME = 'status.html'
-OVERVIEW_UPDATE_INTERVAL = 1 * 60 # 1 minute
+OVERVIEW_UPDATE_INTERVAL = 5 # seconds
+
+def encode_overview(data):
+    image = Image.fromstring('RGBA', (512, 512), data)
+    out = StringIO()
+    image.save(out, 'png')
+    return out.getvalue()
 
 class CommonResource(Resource):
     protocol = None
@@ -49,6 +55,7 @@ class JSONPage(CommonResource):
             else:
                 greens.append(player.name)
                                 
+        profile = protocol.profiler.get_summary()
         dictionary = {
             "serverName" : protocol.name,
             "serverVersion": protocol.version,
@@ -64,7 +71,10 @@ class JSONPage(CommonResource):
             "scores" : {
                 "currentBlueScore": protocol.blue_team.score,
                 "currentGreenScore": protocol.green_team.score,
-            "maxScore": protocol.max_score}
+            "maxScore": protocol.max_score},
+            "tickTimes": profile.get('tick', None),
+            "profile": profile,
+            "mapTransfer": protocol.get_map_transfer_summary()
             }
 
         return json.dumps(dictionary)
@@ -80,34 +90,86 @@ class StatusPage(CommonResource):
 class MapOverview(CommonResource):
     def render_GET(self, request):
         overview = self.parent.get_overview()
+        if overview is None:
+            # the first overview is still being encoded
+            self.parent.overview_waiting.append(request)
+            request.notifyFinish().addErrback(self.request_lost, request)
+            return server.NOT_DONE_YET
+        return self.render_overview(request, overview)
+    render_HEAD = render_GET
+
+    def render_overview(self, request, overview):
         request.setHeader("content-type", 'png/image')
         request.setHeader("content-length", str(len(overview)))
         if request.method == "HEAD":
             return ''
         return overview
-    render_HEAD = render_GET
+
+    def request_lost(self, failure, request):
+        # the client went away before the overview was ready
+        try:
+            self.parent.overview_waiting.remove(request)
+        except ValueError:
+            pass
+
+    def send_overview(self, request, overview):
+        request.write(self.render_overview(request, overview))
+        request.finish()
 
 class StatusServerFactory(object):
     last_overview = None
     overview = None
+    overview_map = None
+    encoding = False
     def __init__(self, protocol, config):
         self.env = Environment(loader = PackageLoader('web'))
         self.protocol = protocol
+        self.overview_interval = config.get('overview_interval',
+            OVERVIEW_UPDATE_INTERVAL)
+        self.overview_waiting = []
         root = Resource()
         root.putChild('json', JSONPage(self))
         root.putChild('', StatusPage(self))
-        root.putChild('overview', MapOverview(self))
+        self.overview_page = MapOverview(self)
+        root.putChild('overview', self.overview_page)
         site = server.Site(root)
         protocol.listenTCP(config.get('port', 32886), site)
     
     def get_overview(self):
+        """
+        Returns the latest PNG overview, or None if there is none yet.
+        Only the tiles changed since the last update are redrawn, and the
+        PNG is encoded in a thread, so until it is done the previous one is
+        served
+        """
         current_time = reactor.seconds()
-        if (self.last_overview is None or 
-        current_time - self.last_overview > OVERVIEW_UPDATE_INTERVAL):
-            overview = self.protocol.map.get_overview(rgba = True)
-            image = Image.fromstring('RGBA', (512, 512), overview)
-            data = StringIO()
-            image.save(data, 'png')
-            self.overview = data.getvalue()
+        if not self.encoding and (self.last_overview is None or 
+        current_time - self.last_overview > self.overview_interval):
             self.last_overview = current_time
-        return self.overview
\ No newline at end of file
+            map = self.protocol.map
+            if map.update_overview() or map is not self.overview_map:
+                self.overview_map = map
+                self.encoding = True
+                threads.deferToThread(encode_overview,
+                    map.get_cached_overview()).addCallbacks(
+                    self.overview_encoded, self.overview_failed)
+        return self.overview
+    
+    def overview_encoded(self, overview):
+        self.encoding = False
+        self.overview = overview
+        waiting = self.overview_waiting
+        self.overview_waiting = []
+        for request in waiting:
+            self.overview_page.send_overview(request, overview)
+    
+    def overview_failed(self, failure):
+        self.encoding = False
+        # try again on the next request
+        self.overview_map = None
+        waiting = self.overview_waiting
+        self.overview_waiting = []
+        for request in waiting:
+            request.setResponseCode(500)
+            request.finish()
+        return failure
\ No newline at end of file
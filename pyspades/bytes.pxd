@@ -9,6 +9,7 @@ cdef class ByteReader:
     cdef int start, size
     cdef object input
     
+    cpdef reset(self, input, int start = ?, int size = ?)
     cdef char * check_available(self, int size) except NULL
     cpdef read(self, int bytes = ?)
     cpdef int readByte(self, bint unsigned = ?) except INT_ERROR
@@ -41,4 +42,5 @@ cdef class ByteWriter:
     cpdef writeString(self, value, int size = ?)
     cpdef pad(self, int bytes)
     cpdef rewind(self, int bytes)
+    cpdef reset(self)
     cpdef size_t tell(self)
\ No newline at end of file
@@ -41,6 +41,8 @@ cdef extern from "bytes_c.cpp":
     void write_string(void * stream, char * data, size_t size)
     void write(void * stream, char * data, size_t size)
     void rewind_stream(void * stream, int bytes)
+    void reset_stream(void * stream)
+    char * get_stream_data(void * stream)
     object get_stream(void * stream)
     size_t get_stream_size(void * stream)
     size_t get_stream_pos(void * stream)
@@ -54,6 +56,11 @@ DEF FLOAT_ERROR = float('nan')
     
 cdef class ByteReader:
     def __init__(self, input, int start = 0, int size = -1):
+        self.reset(input, start, size)
+    
+    cpdef reset(self, input, int start = 0, int size = -1):
+        """Points the reader at new data, so one reader can be reused
+        instead of creating a new one for every packet"""
         self.input = input
         self.data = input
         self.data += start
@@ -206,12 +213,35 @@ cdef class ByteWriter:
     cpdef rewind(self, int bytes):
         rewind_stream(self.stream, bytes)
     
+    cpdef reset(self):
+        """Empties the writer, keeping its buffer for the next use"""
+        reset_stream(self.stream)
+    
     cpdef size_t tell(self):
         return get_stream_pos(self.stream)
     
     def __str__(self):
         return get_stream(self.stream)
     
+    # the written data can be read through the buffer interface without
+    # copying it into a string first, e.g. by enet.Packet
+    
+    def __getbuffer__(self, Py_buffer * buffer, int flags):
+        buffer.buf = get_stream_data(self.stream)
+        buffer.obj = self
+        buffer.len = get_stream_size(self.stream)
+        buffer.readonly = 1
+        buffer.itemsize = 1
+        buffer.format = NULL
+        buffer.ndim = 1
+        buffer.shape = NULL
+        buffer.strides = NULL
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+    
+    def __releasebuffer__(self, Py_buffer * buffer):
+        pass
+    
     def __dealloc__(self):
         delete_stream(self.stream)
     
@@ -17,21 +17,59 @@
     along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 */
 
-#include <iostream>
-#include <sstream>
-#include <string>
+#include <stdlib.h>
+#include <string.h>
 #include "Python.h"
-using namespace std;
+
+#define STREAM_RESERVE_SIZE 64
+
+// a contiguous write buffer. size is the furthest that has been written,
+// since pos can be moved back with rewind_stream
+
+struct WriteStream
+{
+    char * data;
+    size_t pos, size, capacity;
+};
 
 void * create_stream()
 {
-    stringstream * ss = new stringstream(stringstream::out | stringstream::binary);
+    WriteStream * ss = new WriteStream;
+    ss->data = (char*)malloc(STREAM_RESERVE_SIZE);
+    ss->pos = ss->size = 0;
+    ss->capacity = STREAM_RESERVE_SIZE;
     return (void*)ss;
 }
 
-void delete_stream(void * ss)
+void delete_stream(void * stream)
+{
+    WriteStream * ss = (WriteStream*)stream;
+    free(ss->data);
+    delete ss;
+}
+
+inline void reset_stream(void * stream)
+{
+    WriteStream * ss = (WriteStream*)stream;
+    ss->pos = ss->size = 0;
+}
+
+// returns where the next size bytes should be written
+inline char * reserve_stream(WriteStream * ss, size_t size)
 {
-    delete (stringstream*)ss;
+    size_t end = ss->pos + size;
+    if (end > ss->capacity) {
+        size_t capacity = ss->capacity * 2;
+        if (capacity < end)
+            capacity = end;
+        ss->data = (char*)realloc(ss->data, capacity);
+        ss->capacity = capacity;
+    }
+    char * out = ss->data + ss->pos;
+    ss->pos = end;
+    if (end > ss->size)
+        ss->size = end;
+    return out;
 }
 
 /*
@@ -105,30 +143,28 @@ write methods
 
 inline void write_byte(void * stream, char value)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->put(value);
+    *reserve_stream((WriteStream*)stream, 1) = value;
 }
 
 inline void write_ubyte(void * stream, unsigned char value)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->put((char)value);
+    *reserve_stream((WriteStream*)stream, 1) = (char)value;
 }
 
 // short
 
 inline void write_short(void * stream, short value, int big_endian)
 {
-    stringstream * ss = (stringstream*)stream;
+    char * out = reserve_stream((WriteStream*)stream, 2);
     if (big_endian)
     {
-        ss->put((char)(value >> 8));
-        ss->put((char)value);
+        out[0] = (char)(value >> 8);
+        out[1] = (char)value;
     }
     else
     {
-        ss->put((char)value);
-        ss->put((char)(value >> 8));
+        out[0] = (char)value;
+        out[1] = (char)(value >> 8);
     }
 }
 
@@ -142,20 +178,20 @@ inline void write_ushort(void * stream, unsigned short value,
 
 inline void write_int(void * stream, int value, int big_endian)
 {
-    stringstream * ss = (stringstream*)stream;
+    char * out = reserve_stream((WriteStream*)stream, 4);
     if (big_endian)
     {
-        ss->put((char)(value >> 24));
-        ss->put((char)(value >> 16));
-        ss->put((char)(value >> 8));
-        ss->put((char)value);
+        out[0] = (char)(value >> 24);
+        out[1] = (char)(value >> 16);
+        out[2] = (char)(value >> 8);
+        out[3] = (char)value;
     }
     else
     {
-        ss->put((char)value);
-        ss->put((char)(value >> 8));
-        ss->put((char)(value >> 16));
-        ss->put((char)(value >> 24));
+        out[0] = (char)value;
+        out[1] = (char)(value >> 8);
+        out[2] = (char)(value >> 16);
+        out[3] = (char)(value >> 24);
     }
 }
 
@@ -169,49 +205,48 @@ inline void write_uint(void * stream, unsigned int value,
 
 inline void write_float(void * stream, double value, int big_endian)
 {
-    stringstream * ss = (stringstream*)stream;
-    char out[4];
-    _PyFloat_Pack4(value, (unsigned char *)&out, !big_endian);
-    ss->write(out, 4);
+    char * out = reserve_stream((WriteStream*)stream, 4);
+    _PyFloat_Pack4(value, (unsigned char *)out, !big_endian);
 }
 
 inline void write_string(void * stream, char * data, size_t size)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->write(data, size);
-    ss->put(0);
+    char * out = reserve_stream((WriteStream*)stream, size + 1);
+    memcpy(out, data, size);
+    out[size] = 0;
 }
 
 inline void write(void * stream, char * data, size_t size)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->write(data, size);
+    memcpy(reserve_stream((WriteStream*)stream, size), data, size);
 }
 
 inline void rewind_stream(void * stream, int bytes)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->seekp(-bytes, stringstream::cur);
+    WriteStream * ss = (WriteStream*)stream;
+    if ((size_t)bytes > ss->pos)
+        ss->pos = 0;
+    else
+        ss->pos -= bytes;
 }
 
 inline size_t get_stream_size(void * stream)
 {
-    stringstream * ss = (stringstream*)stream;
-    return ss->str().length();
+    return ((WriteStream*)stream)->size;
 }
 
 inline size_t get_stream_pos(void * stream)
 {
-    stringstream * ss = (stringstream*)stream;
-    streampos pos = ss->tellp();
-    if (pos == (streampos)-1)
-        return 0;
-    return pos;
+    return ((WriteStream*)stream)->pos;
+}
+
+inline char * get_stream_data(void * stream)
+{
+    return ((WriteStream*)stream)->data;
 }
 
 inline PyObject * get_stream(void * stream)
 {
-    stringstream * ss = (stringstream*)stream;
-    const string tmp = ss->str();
-    return PyString_FromStringAndSize(tmp.c_str(), tmp.length());
-}
\ No newline at end of file
+    WriteStream * ss = (WriteStream*)stream;
+    return PyString_FromStringAndSize(ss->data, ss->size);
+}
@@ -245,7 +245,7 @@ void genland(unsigned int seed, MapData * map)
         map->geometry[get_pos(x, y, z)] = true;
         lowest_z = get_lowest_height(x, y) + 1;
         for (; z < lowest_z; z++) {
-            map->colors[get_pos(x, y, z)] = ((int*)&buf[k])[0];
+            store_color(get_pos(x, y, z), map, ((int*)&buf[k])[0]);
         }
     }}
 
@@ -0,0 +1,139 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event handlers for connections and protocols.
+
+Scripts can subscribe functions to on_* events instead of subclassing.
+A handler is called like the method it stands for, with the connection or
+protocol as its first argument. Handlers run in ascending order. Returning
+False vetoes the event, so later handlers are skipped. Returning anything
+else that is not None replaces the result, as with the methods.
+
+compile_events() folds a bus into a class. The method the class ended up
+with after apply_script subclassing runs as a handler of order 0, before
+any other handlers of that order.
+"""
+
+def _stub():
+    pass
+
+STUB_CODE = _stub.func_code.co_code
+
+def is_stub(func):
+    """
+    Returns True if func does nothing but return None
+    """
+    code = getattr(func, 'func_code', None)
+    return code is not None and code.co_code == STUB_CODE
+
+def make_dispatcher(handlers):
+    if len(handlers) == 1:
+        return handlers[0]
+    def dispatch(*arg):
+        result = None
+        for handler in handlers:
+            returned = handler(*arg)
+            if returned is False:
+                return False
+            elif returned is not None:
+                result = returned
+        return result
+    return dispatch
+
+class Events(object):
+    """
+    The compiled events of a class. Every attribute is either the function
+    to call for that event (with the connection or protocol passed first)
+    or None if nothing listens to it.
+    """
+    def __init__(self, functions):
+        self.__dict__.update(functions)
+
+class EventBus(object):
+    def __init__(self):
+        self.handlers = {}
+        self.count = 0
+
+    def subscribe(self, name, func, order = 0):
+        self.count += 1
+        # count keeps handlers of the same order in subscription order
+        self.handlers.setdefault(name, []).append((order, self.count, func))
+
+    def unsubscribe(self, name, func):
+        self.handlers[name] = [item for item in self.handlers.get(name, [])
+            if item[2] is not func]
+
+    def on(self, name, order = 0):
+        """
+        Decorator version of subscribe
+        """
+        def decorator(func):
+            self.subscribe(name, func, order)
+            return func
+        return decorator
+
+    def get_handlers(self, name):
+        return [(order, func) for (order, _, func) in
+            sorted(self.handlers.get(name, []))]
+
+def get_event_names(cls):
+    return [name for name in dir(cls) if name.startswith('on_')
+        and callable(getattr(cls, name))]
+
+def compile_events(cls, bus = None, profiler = None):
+    """
+    Sets cls.events to the compiled events of cls. Events with handlers in
+    bus get their method replaced with a dispatcher, so code calling the
+    method directly still reaches every handler. With a TickProfiler, every
+    event that does something is timed as a hook_<name> section.
+    """
+    names = set(get_event_names(cls))
+    if bus is not None:
+        names.update(bus.handlers)
+    functions = {}
+    for name in names:
+        method = getattr(cls, name, None)
+        method = getattr(method, 'im_func', method)
+        if method is not None and is_stub(method):
+            method = None
+        handlers = []
+        if bus is not None:
+            handlers = bus.get_handlers(name)
+        if handlers:
+            if method is not None:
+                # stable sort, so the method goes ahead of handlers of order 0
+                handlers.insert(0, (0, method))
+                handlers.sort(key = lambda item: item[0])
+            method = make_dispatcher([func for (_, func) in handlers])
+            setattr(cls, name, method)
+        if profiler is not None and method is not None:
+            method = profiler.timed('hook_%s' % name, method)
+            setattr(cls, name, method)
+        functions[name] = method
+    cls.events = Events(functions)
+    return cls.events
+
+def get_events(cls):
+    """
+    Returns the compiled events of cls, compiling them if cls has not been
+    compiled itself
+    """
+    events = cls.__dict__.get('events', None)
+    if events is None:
+        events = compile_events(cls)
+    return events
@@ -70,12 +70,36 @@ CLIENT_LOADERS = CONTAINED_LOADERS.copy()
 for item in (contained.HitPacket,):
     CLIENT_LOADERS[item.id] = item
 
+# one instance of every loader, which read_*_packet decode into
+SERVER_POOL = dict((id, item()) for (id, item) in SERVER_LOADERS.iteritems())
+CLIENT_POOL = dict((id, item()) for (id, item) in CLIENT_LOADERS.iteritems())
+
+cdef ByteReader pool_reader = ByteReader('')
+
 def load_server_packet(data):
     return load_contained_packet(data, SERVER_LOADERS)
 
 def load_client_packet(data):
     return load_contained_packet(data, CLIENT_LOADERS)
 
+def read_server_packet(data):
+    """Like load_server_packet, but takes the packet data as a string and
+    decodes into the same loader for every packet of a type, so the result
+    is only valid until the next packet is read"""
+    pool_reader.reset(data)
+    return read_contained_packet(pool_reader, SERVER_POOL)
+
+def read_client_packet(data):
+    """Client packet version of read_server_packet"""
+    pool_reader.reset(data)
+    return read_contained_packet(pool_reader, CLIENT_POOL)
+
 cdef inline Loader load_contained_packet(ByteReader data, dict table):
     type = data.readByte(True)
     return table[type](data)
+
+cdef inline Loader read_contained_packet(ByteReader data, dict pool):
+    type = data.readByte(True)
+    cdef Loader loader = pool[type]
+    loader.read(data)
+    return loader
@@ -0,0 +1,80 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per-tick timing of the server loop.
+
+Time spent in a section is summed over a tick, and every tick the section
+ran in adds its total to a rolling window of the latest samples. A tick
+is one ServerProtocol.update().
+"""
+
+from collections import deque
+from pyspades.tools import get_percentiles
+import time
+
+timer = time.time
+
+class TickProfiler(object):
+    def __init__(self, samples = 600):
+        self.samples = samples
+        self.histograms = {}
+        self.current = {}
+
+    def add(self, name, duration):
+        current = self.current
+        current[name] = current.get(name, 0.0) + duration
+
+    def end_tick(self, duration):
+        self.add('tick', duration)
+        histograms = self.histograms
+        for name, total in self.current.iteritems():
+            try:
+                histograms[name].append(total)
+            except KeyError:
+                histogram = histograms[name] = deque(maxlen = self.samples)
+                histogram.append(total)
+        self.current = {}
+
+    def get_samples(self, name):
+        return self.histograms.get(name, ())
+
+    def get_summary(self):
+        """
+        Returns a dict of section -> dict with the number of samples and the
+        50th, 95th, 99th percentile and max time in milliseconds
+        """
+        summary = {}
+        for name, histogram in self.histograms.iteritems():
+            percentiles = get_percentiles(histogram)
+            item = {'samples': len(histogram), 'max': max(histogram) * 1000.0}
+            for percentile, value in percentiles.iteritems():
+                item['p%s' % percentile] = value * 1000.0
+            summary[name] = item
+        return summary
+
+    def timed(self, name, func):
+        """
+        Wraps func so that the time spent in it goes to the given section
+        """
+        def timed_func(*arg, **kw):
+            start_time = timer()
+            try:
+                return func(*arg, **kw)
+            finally:
+                self.add(name, timer() - start_time)
+        return timed_func
@@ -24,6 +24,9 @@ import enet
 
 import math
 
+# reused for serializing outgoing packets
+packet_writer = ByteWriter()
+
 class BaseConnection(object):
     disconnected = False
     timeout_call = None
@@ -52,9 +55,10 @@ class BaseConnection(object):
             flags = enet.PACKET_FLAG_UNSEQUENCED
         else:
             flags = enet.PACKET_FLAG_RELIABLE
-        data = ByteWriter()
+        data = packet_writer
+        data.reset()
         contained.write(data)
-        packet = enet.Packet(str(data), flags)
+        packet = enet.Packet(data, flags)
         self.peer.send(0, packet)
     
     # events
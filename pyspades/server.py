@@ -24,13 +24,16 @@ from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from pyspades.protocol import BaseConnection, BaseProtocol
 from pyspades.bytes import ByteReader, ByteWriter
-from pyspades.packet import load_client_packet
+from pyspades.packet import read_client_packet, CLIENT_LOADERS
+from pyspades.profiler import TickProfiler, timer
+from pyspades.tools import get_percentiles
 from pyspades.common import *
 from pyspades.constants import *
 from pyspades import contained as loaders
 from pyspades.types import MultikeyDict, IDPool
 from pyspades.master import get_master_connection
 from pyspades.collision import vector_collision, collision_3d
+from pyspades.events import get_events
 from pyspades import world
 from pyspades.debug import *
 from pyspades.weapon import WEAPONS
@@ -46,6 +49,24 @@ import collections
 import zlib
 
 COMPRESSION_LEVEL = 9
+MAP_CHUNK_SIZE = 1024
+
+# ENET_PEER_PACKET_LOSS_SCALE and ENET_PEER_PACKET_THROTTLE_SCALE
+PACKET_LOSS_SCALE = 1 << 16
+PACKET_THROTTLE_SCALE = 32
+
+# bytes of the map kept in flight to a joining player. ENet never has more
+# than 64 kb of reliable data in flight to a peer, so anything above that
+# would only queue up
+MAP_WINDOW_MIN = 4 * MAP_CHUNK_SIZE
+MAP_WINDOW_START = 16 * MAP_CHUNK_SIZE
+MAP_WINDOW_MAX = 64 * MAP_CHUNK_SIZE
+# window growth per round trip after the first loss
+MAP_WINDOW_STEP = 4 * MAP_CHUNK_SIZE
+# the window stops growing while the mean packet loss is above 2%
+MAP_LOSS_LIMIT = PACKET_LOSS_SCALE * 2 / 100
+# shortest round trip the window is adjusted for, in seconds
+MAP_MIN_ROUND_TRIP = 0.02
 
 create_player = loaders.CreatePlayer()
 position_data = loaders.PositionData()
@@ -79,6 +100,10 @@ weapon_reload = loaders.WeaponReload()
 territory_capture = loaders.TerritoryCapture()
 progress_bar = loaders.ProgressBar()
 world_update = (loaders.WorldUpdate075() if GAME_VERSION == 3 else loaders.WorldUpdate())
+
+# reused for serializing outgoing packets, which are then copied straight
+# into an enet.Packet
+packet_writer = ByteWriter()
 block_line = loaders.BlockLine()
 weapon_input = loaders.WeaponInput()
 ascript_start = loaders.ScriptStartPT()
@@ -86,6 +111,10 @@ ascript_chunk = loaders.ScriptChunkPT()
 ascript_end = loaders.ScriptEndPT()
 ascript_call = loaders.ScriptCallPT()
 
+# profiler sections for the packets clients send
+PACKET_SECTIONS = dict((id, 'packet_%s' % item.__name__)
+    for (id, item) in CLIENT_LOADERS.iteritems())
+
 def check_nan(*values):
     for value in values:
         if math.isnan(value):
@@ -123,72 +152,86 @@ class SlidingWindow(object):
     def get(self):
         return self.window[0], self.window[-1]
 
-class MapGeneratorChild(object):
-    pos = 0
-    def __init__(self, generator):
-        self.parent = generator
-    
-    def get_size(self):
-        return self.parent.get_size()
-    
-    def read(self, size):
-        pos = self.pos
-        if pos + size > self.parent.pos:
-            self.parent.read(size)
-        data = self.parent.all_data[pos:pos+size]
-        self.pos += len(data)
-        return data
-    
-    def data_left(self):
-        return self.parent.data_left() or self.pos < self.parent.pos
-
-class ProgressiveMapGenerator(object):
-    data = ''
+class MapSnapshot(object):
+    """
+    Compressed map stream that is generated once and then shared by every
+    joining connection. Changes made to the map afterwards are kept in the
+    map's delta log and replayed to the client after the transfer
+    """
     done = False
+    size = 0
     
-    # parent attributes
-    all_data = ''
-    pos = 0
-    def __init__(self, map, parent = False):
-        self.parent = parent
+    def __init__(self, map):
+        self.map = map
         self.generator = map.get_generator()
+        self.delta_id = map.start_delta()
         self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self.chunks = []
+        self.data = ''
     
     def get_size(self):
+        if self.done:
+            return self.size
         return 1.5 * 1024 * 1024 # 2 mb
     
-    def read(self, size):
+    def generate(self, count):
+        """
+        Compress more of the map until at least count chunks are available
+        or the map is done
+        """
+        chunks = self.chunks
         data = self.data
-        generator = self.generator
-        if len(data) < size and generator is not None:
-            while 1:
-                map_data = generator.get_data(1024)
-                if generator.done:
-                    self.generator = None
-                    data += self.compressor.flush()
-                    break
+        while len(chunks) < count and not self.done:
+            generator = self.generator
+            map_data = generator.get_data(1024)
+            if generator.done:
+                data += self.compressor.flush()
+                self.generator = self.compressor = None
+                self.done = True
+                end = len(data)
+            else:
                 data += self.compressor.compress(map_data)
-                if len(data) >= size:
-                    break
-        if self.parent:
-            # save the data in case we are a parent
-            self.all_data += data
-            self.pos += len(data)
-        else:
-            self.data = data[size:]
-            return data[:size]
+                end = len(data) - len(data) % MAP_CHUNK_SIZE
+            for pos in xrange(0, end, MAP_CHUNK_SIZE):
+                chunks.append(data[pos:pos + MAP_CHUNK_SIZE])
+            self.size += end
+            data = data[end:]
+        self.data = data
+    
+    def get_reader(self):
+        return MapSnapshotReader(self)
+    
+    def is_current(self, map):
+        return self.map is map and self.delta_id == map.delta_id
+
+class MapSnapshotReader(object):
+    index = 0
     
-    def get_child(self):
-        return MapGeneratorChild(self)
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+    
+    def get_size(self):
+        return self.snapshot.get_size()
+    
+    def read(self):
+        snapshot = self.snapshot
+        index = self.index
+        if index >= len(snapshot.chunks):
+            snapshot.generate(index + 1)
+            if index >= len(snapshot.chunks):
+                return ''
+        self.index = index + 1
+        return snapshot.chunks[index]
     
     def data_left(self):
-        return bool(self.data) or self.generator is not None
+        return (not self.snapshot.done or 
+            self.index < len(self.snapshot.chunks))
 
 class ServerConnection(BaseConnection):
     address = None
-    player_id = None
+    _player_id = None
     map_packets_sent = 0
-    team = None
+    _team = None
     weapon = None
     weapon_object = None
     name = None
@@ -200,7 +243,7 @@ class ServerConnection(BaseConnection):
     blocks = None
     spawn_call = None
     respawn_time = None
-    saved_loaders = None
+    _saved_loaders = None
     last_refill = None
     last_block_destroy = None
     filter_visibility_data = False
@@ -213,6 +256,12 @@ class ServerConnection(BaseConnection):
     world_object = None
     last_block = None
     map_data = None
+    map_window = MAP_WINDOW_START
+    map_window_time = None
+    map_window_sent = 0
+    map_slow_start = True
+    map_packets_lost = 0
+    map_transfer_start = None
     ascript_data = None
     last_position_update = None
     iceball_mode = False
@@ -220,6 +269,8 @@ class ServerConnection(BaseConnection):
     
     def __init__(self, *arg, **kw):
         BaseConnection.__init__(self, *arg, **kw)
+        # hot paths check these so they can skip events nobody listens to
+        self.events = get_events(self.__class__)
         protocol = self.protocol
         address = self.peer.address
         self.total_blocks_removed = 0
@@ -227,6 +278,36 @@ class ServerConnection(BaseConnection):
         self.respawn_time = protocol.respawn_time
         self.rapids = SlidingWindow(RAPID_WINDOW_ENTRIES)
         self.cached = 0
+    
+    # these decide who gets a broadcast, so the protocol has to rebuild its
+    # recipient lists whenever one of them changes
+    
+    def _get_player_id(self):
+        return self._player_id
+    
+    def _set_player_id(self, value):
+        self._player_id = value
+        self.protocol.recipients = None
+    
+    player_id = property(_get_player_id, _set_player_id)
+    
+    def _get_team(self):
+        return self._team
+    
+    def _set_team(self, value):
+        self._team = value
+        self.protocol.recipients = None
+    
+    team = property(_get_team, _set_team)
+    
+    def _get_saved_loaders(self):
+        return self._saved_loaders
+    
+    def _set_saved_loaders(self, value):
+        self._saved_loaders = value
+        self.protocol.recipients = None
+    
+    saved_loaders = property(_get_saved_loaders, _set_saved_loaders)
 
     def on_connect(self):
         if self.local:
@@ -280,7 +361,7 @@ class ServerConnection(BaseConnection):
                 self.peer.send(1, pkt)
             elif name == "*MAP":
                 # load map
-                self.send_map(ProgressiveMapGenerator(self.protocol.map))
+                self.send_map_snapshot()
         except IOError:
             pkt = enet.Packet("\x35", enet.PACKET_FLAG_RELIABLE)
             self.peer.send(1, pkt)
@@ -301,7 +382,7 @@ class ServerConnection(BaseConnection):
         if self.player_id is not None:
             if self.iceball_mode and channel:
                 return self.iceball_packet_received(loader.data)
-            contained = load_client_packet(ByteReader(loader.data))
+            contained = read_client_packet(loader.data)
             if contained.id in (loaders.ExistingPlayer.id, 
                                 loaders.ShortPlayerData.id):
                 old_team = self.team
@@ -347,11 +428,13 @@ class ServerConnection(BaseConnection):
                         self.on_hack_attempt(
                             'Invalid orientation data received')
                         return
-                    returned = self.on_orientation_update(x, y, z)
-                    if returned == False:
-                        return
-                    if returned is not None:
-                        x, y, z = returned
+                    on_orientation_update = self.events.on_orientation_update
+                    if on_orientation_update is not None:
+                        returned = on_orientation_update(self, x, y, z)
+                        if returned == False:
+                            return
+                        if returned is not None:
+                            x, y, z = returned
                     if abs(x**2 + y**2 + z**2 - 1.0) > 0.005 and self.team != self.protocol.spectator_team and (self.user_types is None or 'admin' not in self.user_types):
                         self.on_hack_attempt(
                             'Ghetto hack detected %s' % self.user_types)
@@ -378,7 +461,9 @@ class ServerConnection(BaseConnection):
                         return
                     if not self.freeze_animation:
                         world_object.set_position(x, y, z)
-                        self.on_position_update()
+                        on_position_update = self.events.on_position_update
+                        if on_position_update is not None:
+                            on_position_update(self)
                     if self.filter_visibility_data:
                         return
                     game_mode = self.protocol.game_mode
@@ -422,8 +507,11 @@ class ServerConnection(BaseConnection):
                     contained.player_id = self.player_id
                     self.protocol.send_contained(contained, sender = self)
                 elif contained.id == loaders.InputData.id:
-                    returned = self.on_walk_update(contained.up, contained.down, 
-                        contained.left, contained.right)
+                    returned = None
+                    on_walk_update = self.events.on_walk_update
+                    if on_walk_update is not None:
+                        returned = on_walk_update(self, contained.up,
+                            contained.down, contained.left, contained.right)
                     if returned is not None:
                         up, down, left, right = returned
                         if (up != contained.up or down != contained.down or
@@ -452,8 +540,11 @@ class ServerConnection(BaseConnection):
                             # (contained.primary_fire, contained.secondary_fire,
                                 # contained.jump, contained.crouch) = returned
                             # self.send_contained(contained)
-                    returned = self.on_animation_update(contained.jump,
-                        contained.crouch, contained.sneak, contained.sprint)
+                    returned = None
+                    on_animation_update = self.events.on_animation_update
+                    if on_animation_update is not None:
+                        returned = on_animation_update(self, contained.jump,
+                            contained.crouch, contained.sneak, contained.sprint)
                     if returned is not None:
                         jump, crouch, sneak, sprint = returned
                         if (jump != contained.jump or crouch != contained.crouch or
@@ -502,11 +593,13 @@ class ServerConnection(BaseConnection):
                         type = HEADSHOT_KILL
                     else:
                         type = WEAPON_KILL
-                    returned = self.on_hit(hit_amount, player, type, None)
-                    if returned == False:
-                        return
-                    elif returned is not None:
-                        hit_amount = returned
+                    on_hit = self.events.on_hit
+                    if on_hit is not None:
+                        returned = on_hit(self, hit_amount, player, type, None)
+                        if returned == False:
+                            return
+                        elif returned is not None:
+                            hit_amount = returned
                     player.hit(hit_amount, self, type)
                 elif contained.id == loaders.GrenadePacket.id:
                     if not self.grenades:
@@ -604,7 +697,9 @@ class ServerConnection(BaseConnection):
                         if self.tool == SPADE_TOOL and not collision_3d(
                             pos.x, pos.y, pos.z, x, y, z, MAX_DIG_DISTANCE):
                             return
-                        if self.on_block_destroy(x, y, z, value) == False:
+                        on_block_destroy = self.events.on_block_destroy
+                        if (on_block_destroy is not None and
+                                on_block_destroy(self, x, y, z, value) == False):
                             return
                         elif value == DESTROY_BLOCK:
                             count = map.destroy_point(x, y, z)
@@ -613,11 +708,12 @@ class ServerConnection(BaseConnection):
                                 self.blocks = min(50, self.blocks + 1)
                                 self.on_block_removed(x, y, z)
                         elif value == SPADE_DESTROY:
-                            for xyz in ((x, y, z), (x, y, z + 1), (x, y, z - 1)):
-                                count = map.destroy_point(*xyz)
-                                if count:
-                                    self.total_blocks_removed += count
-                                    self.on_block_removed(*xyz)
+                            removed, falling = map.destroy_points(
+                                [(x, y, z), (x, y, z + 1), (x, y, z - 1)])
+                            self.total_blocks_removed += (len(removed) + 
+                                len(falling))
+                            for xyz in removed:
+                                self.on_block_removed(*xyz)
                         self.last_block_destroy = reactor.seconds()
                     block_action.x = x
                     block_action.y = y
@@ -814,7 +910,7 @@ class ServerConnection(BaseConnection):
             else:
                 position = Vertex3(x, y, z)
                 self.world_object = self.protocol.world.create_object(
-                    world.Character, position, None, self._on_fall)
+                    world.Character, position, None, self._on_fall, self)
             self.world_object.dead = False
             self.tool = WEAPON_TOOL
             self.refill(True)
@@ -1017,7 +1113,7 @@ class ServerConnection(BaseConnection):
         else:
             if self.protocol.powerthirst:
                 self.send_ascript(stringio.StringIO(self.protocol.ascript_main), "main", "void main(int plrid)", [(ASP_INT, self.player_id)])
-            self.send_map(ProgressiveMapGenerator(self.protocol.map))
+            self.send_map_snapshot()
     
     def _send_connection_data(self):
         saved_loaders = self.saved_loaders = []
@@ -1105,10 +1201,20 @@ class ServerConnection(BaseConnection):
         z = position.z
         if x < 0 or x > 512 or y < 0 or y > 512 or z < 0 or z > 63:
             return
+        # get_damage is zero for anything 16 or more blocks away on any axis
+        characters = self.protocol.world.get_characters_in_box(
+            x - 16, y - 16, z - 16, x + 16, y + 16, z + 16)
+        enemies = []
+        for character in characters:
+            player = character.owner
+            if player is None or player.world_object is not character:
+                continue
+            if player.team is self.team.other:
+                enemies.append(player)
         x = int(math.floor(x))
         y = int(math.floor(y))
         z = int(math.floor(z))
-        for player_list in (self.team.other.get_players(), (self,)):
+        for player_list in (enemies, (self,)):
             for player in player_list:
                 if not player.hp:
                     continue
@@ -1126,13 +1232,15 @@ class ServerConnection(BaseConnection):
         if self.on_block_destroy(x, y, z, GRENADE_DESTROY) == False:
             return
         map = self.protocol.map
+        points = []
         for nade_x in xrange(x - 1, x + 2):
             for nade_y in xrange(y - 1, y + 2):
                 for nade_z in xrange(z - 1, z + 2):
-                    count = map.destroy_point(nade_x, nade_y, nade_z)
-                    if count:
-                        self.total_blocks_removed += count
-                        self.on_block_removed(nade_x, nade_y, nade_z)
+                    points.append((nade_x, nade_y, nade_z))
+        removed, falling = map.destroy_points(points)
+        self.total_blocks_removed += len(removed) + len(falling)
+        for xyz in removed:
+            self.on_block_removed(*xyz)
         block_action.x = x
         block_action.y = y
         block_action.z = z
@@ -1205,9 +1313,19 @@ class ServerConnection(BaseConnection):
             ascript_chunk.data = s
             self.send_contained(ascript_chunk)
 
-    def send_map(self, data = None):
+    def send_map(self, data = None, limit = MAP_WINDOW_START):
+        """
+        Sends up to limit bytes of the map and returns how many were sent.
+        Finishes the transfer once all of it is sent, or if the client has
+        the map cached
+        """
         if data is not None:
             self.map_data = data
+            self.map_window = MAP_WINDOW_START
+            self.map_window_time = None
+            self.map_window_sent = 0
+            self.map_slow_start = True
+            self.map_transfer_start = reactor.seconds()
             if self.iceball_mode:
                 self.map_doffs = 0
                 ulen = 16*1024*1024 # TODO: calculate the unpacked length PROPERLY
@@ -1225,9 +1343,9 @@ class ServerConnection(BaseConnection):
                 map_start.name = self.protocol.map_info.rot_info.get_map_name()
                 self.send_contained(map_start)
         elif self.map_data is None:
-            return
+            return 0
         if self.cached is None:
-            return
+            return 0
             
         if self.cached is 1 or not self.map_data.data_left():
             if self.iceball_mode:
@@ -1236,29 +1354,86 @@ class ServerConnection(BaseConnection):
             self.map_data = None
             if self.saved_loaders:
                 for data in self.saved_loaders:
-                    packet = enet.Packet(str(data), enet.PACKET_FLAG_RELIABLE)
+                    packet = enet.Packet(data, enet.PACKET_FLAG_RELIABLE)
                     self.peer.send(0, packet)
             self.saved_loaders = None
+            self.protocol.map_transfer_done(self,
+                reactor.seconds() - self.map_transfer_start)
             self.on_join()
-            return
-        for _ in xrange(10):
-            if not self.map_data.data_left():
-                break
+            return 0
+        sent = 0
+        while sent < limit and self.map_data.data_left():
             if self.iceball_mode:
-                dm = self.map_data.read(1024)
+                dm = self.map_data.read()
                 d = struct.pack("<BIH", 0x33, self.map_doffs, len(dm)) + dm
                 self.map_doffs += len(dm)
                 pkt = enet.Packet(d, enet.PACKET_FLAG_RELIABLE)
                 self.peer.send(1, pkt)
             elif self.protocol.powerthirst:
-                map_data_pt.data = self.map_data.read(1024)
+                dm = map_data_pt.data = self.map_data.read()
                 self.send_contained(map_data_pt)
             else:
-                map_data.data = self.map_data.read(1024)
+                dm = map_data.data = self.map_data.read()
                 self.send_contained(map_data)
+            sent += len(dm)
+        self.map_window_sent += sent
+        return sent
+    
+    def send_map_snapshot(self):
+        protocol = self.protocol
+        data = protocol.get_map_snapshot()
+        if self.saved_loaders is not None:
+            # bring the snapshot up to date before anything that happens
+            # during the transfer is replayed
+            self.saved_loaders.extend(protocol.get_map_delta())
+        self.send_map(data)
     
-    def continue_map_transfer(self):
-        self.send_map()
+    def continue_map_transfer(self, limit = MAP_WINDOW_START):
+        return self.send_map(limit = limit)
+    
+    def get_map_window_space(self):
+        """
+        Returns how many more bytes of the map can be put in flight. Once
+        every round trip, the window doubles (or after the first loss, grows
+        by MAP_WINDOW_STEP) while ENet reports no new losses, and halves
+        when it does. It only grows if at least half of it was sent in the
+        last round trip, so a transfer that is waiting for the client or held
+        back by map_transfer_rate keeps its window. It is capped by ENet's
+        throttle and the bandwidth the client asked for
+        """
+        peer = self.peer
+        current_time = reactor.seconds()
+        round_trip = max(MAP_MIN_ROUND_TRIP, peer.roundTripTime / 1000.0)
+        if self.map_window_time is None:
+            self.map_window_time = current_time
+            self.map_window_sent = 0
+            self.map_packets_lost = peer.packetsLost
+        elif current_time - self.map_window_time >= round_trip:
+            self.map_window_time = current_time
+            filled = self.map_window_sent * 2 >= self.map_window
+            self.map_window_sent = 0
+            # ENet resets packetsLost whenever it updates packetLoss
+            packets_lost = peer.packetsLost
+            lost = packets_lost > self.map_packets_lost or (
+                packets_lost < self.map_packets_lost and packets_lost > 0)
+            self.map_packets_lost = packets_lost
+            window = self.map_window
+            if lost:
+                window /= 2
+                self.map_slow_start = False
+            elif not filled or peer.packetLoss > MAP_LOSS_LIMIT:
+                pass
+            elif self.map_slow_start:
+                window *= 2
+            else:
+                window += MAP_WINDOW_STEP
+            limit = (MAP_WINDOW_MAX * max(1, peer.packetThrottle) / 
+                PACKET_THROTTLE_SCALE)
+            bandwidth = peer.incomingBandwidth
+            if bandwidth:
+                limit = min(limit, int(bandwidth * round_trip))
+            self.map_window = max(MAP_WINDOW_MIN, min(window, limit))
+        return self.map_window - peer.reliableDataInTransit
     
     def continue_ascript_transfer(self):
         self.send_ascript()
@@ -1633,6 +1808,14 @@ class ServerProtocol(BaseProtocol):
     master = False
     max_score = 10
     map = None
+    map_snapshot = None
+    map_delta_limit = 4096
+    recipients = None
+    broadcast_stats = None
+    # if set, WorldUpdate only carries enemies within this distance, and
+    # with interest_line_of_sight, only those that can be seen
+    interest_distance = None
+    interest_line_of_sight = False
     ascript_main = None
     spade_teamkills_on_grief = False
     friendly_fire = False
@@ -1652,6 +1835,14 @@ class ServerProtocol(BaseProtocol):
     team2_name = 'Green'
     spectator_name = 'Spectator'
     loop_count = 0
+    # how many ticks the profiler keeps timings for
+    tick_samples = 600
+    profiler = None
+    # bytes per second all map transfers together may send, or None for no
+    # limit, so joining players do not crowd out the game traffic
+    map_transfer_rate = 2 * 1024 * 1024
+    # how many map transfers are kept for the join time statistics
+    map_transfer_samples = 100
     melee_damage = 100
     version = GAME_VERSION
     respawn_waves = False
@@ -1663,9 +1854,17 @@ class ServerProtocol(BaseProtocol):
         # this should not allow additional players.
         self.max_connections = self.max_players + 2
         BaseProtocol.__init__(self, *arg, **kw)
+        self.events = get_events(self.__class__)
         self.entities = []
         self.players = MultikeyDict()
         self.player_ids = IDPool()
+        self.broadcast_stats = {}
+        if self.profiler is None:
+            self.profiler = TickProfiler(self.tick_samples)
+        self.packet_time = 0.0
+        self.map_transfer_times = collections.deque(
+            maxlen = self.map_transfer_samples)
+        self.map_transfer_bytes = collections.deque(maxlen = self.tick_samples)
         self.spectator_team = self.team_class(-1, self.spectator_name, 
             (0, 0, 0), True, self)
         self.blue_team = self.team_class(0, self.team1_name, self.team1_color,
@@ -1695,17 +1894,69 @@ class ServerProtocol(BaseProtocol):
                                             abs(vec[1]*1.02) +\
                                             abs(vec[2]*1.01))
     
+    def on_disconnect(self, peer):
+        self.recipients = None
+        BaseProtocol.on_disconnect(self, peer)
+    
+    def remove_peer(self, peer):
+        self.recipients = None
+        BaseProtocol.remove_peer(self, peer)
+    
+    def get_recipients(self):
+        """Returns a dict of team -> enet.PeerGroup for all joined players
+        (with None as the key for everyone), and a list of the players that
+        have to be handled one by one, i.e. those still loading the map"""
+        if self.recipients is not None:
+            return self.recipients
+        everyone = enet.PeerGroup()
+        groups = {None : everyone}
+        others = []
+        for player in self.connections.values():
+            if player.player_id is None:
+                continue
+            if (player.saved_loaders is not None or 
+                    not isinstance(player.peer, enet.Peer)):
+                others.append(player)
+                continue
+            everyone.add(player.peer)
+            team = player.team
+            if team is not None:
+                try:
+                    group = groups[team]
+                except KeyError:
+                    group = groups[team] = enet.PeerGroup()
+                group.add(player.peer)
+        self.recipients = groups, others
+        return self.recipients
+    
     def send_contained(self, contained, unsequenced = False, sender = None,
                        team = None, save = False, rule = None):
         if unsequenced:
             flags = enet.PACKET_FLAG_UNSEQUENCED
         else:
             flags = enet.PACKET_FLAG_RELIABLE
-        data = ByteWriter()
+        data = packet_writer
+        data.reset()
         contained.write(data)
-        data = str(data)
         packet = enet.Packet(data, flags)
-        for player in self.connections.values():
+        size = len(data)
+        if save:
+            # sending can run other code that reuses packet_writer
+            data = str(data)
+        if rule is not None:
+            players = self.connections.values()
+            sent = 0
+        else:
+            groups, players = self.get_recipients()
+            exclude = None
+            if sender is not None and isinstance(sender.peer, enet.Peer):
+                exclude = sender.peer
+            group = groups.get(team, None)
+            if group is None:
+                sent = 0
+            else:
+                sent = group.send(0, packet, exclude)
+        for player in players:
             if player is sender or player.player_id is None:
                 continue
             if team is not None and player.team is not team:
@@ -1717,6 +1968,29 @@ class ServerProtocol(BaseProtocol):
                     player.saved_loaders.append(data)
             else:
                 player.peer.send(0, packet)
+                sent += 1
+        self.add_broadcast_stats(contained, sent, sent * size)
+    
+    def add_broadcast_stats(self, contained, packets, size):
+        """Counts one broadcast that went out as packets packets with size
+        bytes in total"""
+        try:
+            stats = self.broadcast_stats[contained.__class__]
+        except KeyError:
+            stats = self.broadcast_stats[contained.__class__] = [0, 0, 0]
+        stats[0] += 1
+        stats[1] += packets
+        stats[2] += size
+    
+    def get_broadcast_stats(self):
+        """Returns (name, broadcasts, packets, bytes) for every kind of
+        broadcast sent so far, with the most bytes first"""
+        stats = [(klass.__name__, broadcasts, packets, size) 
+            for klass, (broadcasts, packets, size) in 
+            self.broadcast_stats.iteritems()]
+        stats.sort(key = lambda item: item[3], reverse = True)
+        return stats
+    
     def call_ascript(self, *args, **kwargs):
         for i in xrange(self.super_max_players):
             position = orientation = None
@@ -1763,20 +2037,104 @@ class ServerProtocol(BaseProtocol):
             entities.append(flag)
         return entities
     
+    def data_received(self, peer, packet, channel):
+        start_time = timer()
+        BaseProtocol.data_received(self, peer, packet, channel)
+        duration = timer() - start_time
+        self.packet_time += duration
+        data = packet.data
+        if data:
+            name = PACKET_SECTIONS.get(ord(data[0]), 'packet_unknown')
+        else:
+            name = 'packet_unknown'
+        self.profiler.add(name, duration)
+    
     def update(self):
+        profiler = self.profiler
+        tick_start = start_time = timer()
         self.loop_count += 1
+        self.packet_time = 0.0
         BaseProtocol.update(self)
+        end_time = timer()
+        # packets are timed by type in data_received
+        profiler.add('enet', end_time - start_time - self.packet_time)
+        start_time = end_time
+        transfers = []
         for player in self.connections.values():
-            if (player.ascript_data is not None and 
-            not player.peer.reliableDataInTransit):
-                player.continue_ascript_transfer()
-            elif (player.map_data is not None and 
-            not player.peer.reliableDataInTransit):
-                player.continue_map_transfer()
+            if player.ascript_data is not None:
+                if not player.peer.reliableDataInTransit:
+                    player.continue_ascript_transfer()
+            elif player.map_data is not None:
+                transfers.append(player)
+        if transfers:
+            self.update_map_transfers(transfers)
+        self.update_map_snapshot()
+        end_time = timer()
+        profiler.add('transfer', end_time - start_time)
+        start_time = end_time
         self.world.update(UPDATE_FREQUENCY)
-        self.on_world_update()
+        on_world_update = self.events.on_world_update
+        if on_world_update is not None:
+            on_world_update(self)
+        end_time = timer()
+        profiler.add('world', end_time - start_time)
         if self.loop_count % int(UPDATE_FPS / NETWORK_FPS) == 0:
+            start_time = end_time
             self.update_network()
+            end_time = timer()
+            profiler.add('network', end_time - start_time)
+        profiler.end_tick(end_time - tick_start)
+    
+    def update_map_transfers(self, players):
+        """
+        Tops up the map in flight to every joining player, within the
+        window of each and map_transfer_rate for all of them together
+        """
+        budget = None
+        if self.map_transfer_rate is not None:
+            budget = int(self.map_transfer_rate * UPDATE_FREQUENCY)
+        # the player to go first changes every tick, so that no one is
+        # always left with what remains of the budget
+        start = self.loop_count % len(players)
+        total = 0
+        for player in players[start:] + players[:start]:
+            if not player.map_data.data_left() or player.cached is 1:
+                # the end is only sent once everything else has arrived
+                if not player.peer.reliableDataInTransit:
+                    player.continue_map_transfer()
+                continue
+            limit = player.get_map_window_space()
+            if budget is not None:
+                limit = min(limit, budget - total)
+            if limit <= 0:
+                continue
+            total += player.continue_map_transfer(limit)
+        self.map_transfer_bytes.append(total)
+    
+    def map_transfer_done(self, connection, duration):
+        self.map_transfer_times.append(duration)
+    
+    def get_map_transfer_summary(self):
+        """
+        Returns a dict with the number of running map transfers, and the
+        same summary as TickProfiler.get_summary of the transfer times in
+        milliseconds and of the map bytes sent per tick while transfers
+        were running
+        """
+        summary = {}
+        for name, values in (
+                ('time', [value * 1000.0 for value in self.map_transfer_times]),
+                ('bytes', self.map_transfer_bytes)):
+            if not values:
+                summary[name] = None
+                continue
+            item = {'samples': len(values), 'max': max(values)}
+            for percentile, value in get_percentiles(values).iteritems():
+                item['p%s' % percentile] = value
+            summary[name] = item
+        summary['transfers'] = len([connection for connection in
+            self.connections.values() if connection.map_data is not None])
+        return summary
     
     def update_network(self):
         items = {}
@@ -1798,12 +2156,148 @@ class ServerProtocol(BaseProtocol):
             world_update.items = [a if i in items else ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0))
                 for a in xrange(self.super_max_players)]
             self.send_contained(world_update, unsequenced = True)
-        else:
+        elif self.interest_distance is None:
             world_update.items = items
             self.send_contained(world_update, unsequenced = True)
+        else:
+            self.send_world_updates(items)
+    
+    def send_world_updates(self, items):
+        """
+        Sends each player a WorldUpdate with only the enemies that are within
+        interest_distance of them (and in line of sight, with
+        interest_line_of_sight). Players that see the same set of players
+        share one packet
+        """
+        max_distance = self.interest_distance ** 2
+        line_of_sight = self.interest_line_of_sight
+        entries = [(player_id, self.players[player_id].team, position) 
+            for player_id, (position, orientation) in items.iteritems()]
+        # whether two enemies see each other is the same both ways, so every
+        # pair is only checked once per update
+        visible = {}
+        packets = {}
+        sent = total = 0
+        for player in self.connections.values():
+            if player.player_id is None or player.saved_loaders is not None:
+                continue
+            team = player.team
+            world_object = player.world_object
+            if team is None or team.spectator or world_object is None:
+                key = None
+            else:
+                player_id = player.player_id
+                x1, y1, z1 = world_object.position.get()
+                ids = []
+                for other_id, other_team, (x2, y2, z2) in entries:
+                    if other_team is team:
+                        ids.append(other_id)
+                        continue
+                    if player_id < other_id:
+                        pair = (player_id, other_id)
+                    else:
+                        pair = (other_id, player_id)
+                    try:
+                        seen = visible[pair]
+                    except KeyError:
+                        seen = ((x2 - x1) ** 2 + (y2 - y1) ** 2 <= 
+                            max_distance)
+                        if seen and line_of_sight:
+                            seen = world_object.can_see(x2, y2, z2)
+                        visible[pair] = seen
+                    if seen:
+                        ids.append(other_id)
+                key = tuple(ids)
+            try:
+                packet, size = packets[key]
+            except KeyError:
+                if key is None:
+                    world_update.items = items
+                else:
+                    world_update.items = dict((other_id, items[other_id])
+                        for other_id in key)
+                data = packet_writer
+                data.reset()
+                world_update.write(data)
+                size = len(data)
+                packet = enet.Packet(data, enet.PACKET_FLAG_UNSEQUENCED)
+                packets[key] = (packet, size)
+            player.peer.send(0, packet)
+            sent += 1
+            total += size
+        if sent:
+            self.add_broadcast_stats(world_update, sent, total)
+    
+    def get_map_snapshot(self):
+        """
+        Returns a reader for the compressed base map. The stream is shared
+        between joining players, and get_map_delta() gives the changes that
+        were made since it was taken
+        """
+        snapshot = self.map_snapshot
+        map = self.map
+        if snapshot is None or not snapshot.is_current(map):
+            snapshot = self.map_snapshot = MapSnapshot(map)
+        return snapshot.get_reader()
+    
+    def get_map_delta(self):
+        """
+        Returns the loaders that bring a client holding the current map
+        snapshot up to date
+        """
+        builds = []
+        removals = []
+        for x, y, z, was_solid, color in self.map.get_delta():
+            if color is None:
+                removals.append((x, y, z))
+            else:
+                builds.append((color & 0xFFFFFF, x, y, z, was_solid))
+        # build before removing, so nothing is left hanging on the client
+        builds.sort()
+        data = []
+        last_color = None
+        set_color.player_id = 32
+        block_action.player_id = 32
+        for color, x, y, z, was_solid in builds:
+            if color != last_color:
+                set_color.value = color
+                data.append(set_color.generate())
+                last_color = color
+            block_action.x = x
+            block_action.y = y
+            block_action.z = z
+            if was_solid:
+                # recolored block
+                block_action.value = DESTROY_BLOCK
+                data.append(block_action.generate())
+            block_action.value = BUILD_BLOCK
+            data.append(block_action.generate())
+        block_action.value = DESTROY_BLOCK
+        for x, y, z in removals:
+            block_action.x = x
+            block_action.y = y
+            block_action.z = z
+            data.append(block_action.generate())
+        return data
+    
+    def update_map_snapshot(self):
+        """
+        Generates the map snapshot a bit at a time, and takes a new one once
+        the delta log has grown too large to replay
+        """
+        snapshot = self.map_snapshot
+        map = self.map
+        if map is None:
+            return
+        if (snapshot is None or not snapshot.is_current(map) or
+        map.get_delta_size() > self.map_delta_limit):
+            snapshot = self.map_snapshot = MapSnapshot(map)
+        if not snapshot.done:
+            snapshot.generate(len(snapshot.chunks) + 1)
     
     def set_map(self, map):
         self.map = map
+        self.map_snapshot = None
         self.world.map = map
         self.on_map_change(map)
         self.blue_team.initialize()
@@ -1812,7 +2306,6 @@ class ServerProtocol(BaseProtocol):
             self.reset_tc()
         self.players = MultikeyDict()
         if self.connections:
-            data = ProgressiveMapGenerator(self.map, parent = True)
             for connection in self.connections.values():
                 if connection.player_id is None:
                     continue
@@ -1822,7 +2315,7 @@ class ServerProtocol(BaseProtocol):
                 connection.reset()
                 connection.cached = None
                 connection._send_connection_data()
-                connection.send_map(data.get_child())
+                connection.send_map_snapshot()
         self.update_entities()
     
     def reset_game(self, player = None, territory = None):
@@ -1903,16 +2396,9 @@ class ServerProtocol(BaseProtocol):
     def update_entities(self):
         map = self.map
         for entity in self.entities:
-            moved = False
-            if map.get_solid(entity.x, entity.y, entity.z - 1):
-                moved = True
-                entity.z -= 1
-                while map.get_solid(entity.x, entity.y, entity.z - 1):
-                    entity.z -= 1
-            else:
-                while not map.get_solid(entity.x, entity.y, entity.z):
-                    moved = True
-                    entity.z += 1
+            z = map.get_surface(entity.x, entity.y, entity.z)
+            moved = z != entity.z
+            entity.z = z
             if moved or self.on_update_entity(entity):
                 entity.update()
     
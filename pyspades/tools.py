@@ -16,6 +16,7 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 import struct
+import math
 
 def make_server_identifier(ip, port = 32887):
     a, b, c, d = ip.split('.')
@@ -42,6 +43,21 @@ def get_server_details(value):
     d = (host & 0xFF000000) >> 24
     return ('%s.%s.%s.%s' % (a, b, c, d), port)
 
+def get_percentiles(values, percentiles = (50, 95, 99)):
+    """
+    Returns a dict of percentile -> value for a list of numbers, using the
+    nearest rank
+    """
+    values = sorted(values)
+    result = {}
+    for percentile in percentiles:
+        if not values:
+            result[percentile] = None
+            continue
+        index = int(math.ceil(percentile / 100.0 * len(values))) - 1
+        result[percentile] = values[max(0, index)]
+    return result
+
 if __name__ == '__main__':
     import sys
     args = sys.argv[1:]
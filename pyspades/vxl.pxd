@@ -1,21 +1,35 @@
+from libcpp.vector cimport vector
+
 cdef extern from "vxl_c.cpp":
     enum:
         MAP_X
         MAP_Y
         MAP_Z
         DEFAULT_COLOR
+    struct Overview:
+        unsigned int * data
     struct MapData:
-        pass
+        Overview * overview
     struct MapGenerator:
         pass
+    struct HeightMap:
+        unsigned char * top
+        unsigned char * ground
     MapGenerator * create_map_generator(MapData * original)
     void delete_map_generator(MapGenerator * generator)
     object get_generator_data(MapGenerator * generator, int columns)
-    MapData * load_vxl(unsigned char * v)
+    MapData * load_vxl(unsigned char * v) nogil
     MapData * copy_map(MapData * map)
     void delete_vxl(MapData * map)
     object save_vxl(MapData * map)
+    object dump_map(MapData * map, int crc)
+    MapData * load_map_dump(char * data, size_t size, int * crc)
     int check_node(int x, int y, int z, MapData * map, int destroy)
+    int check_nodes(int count, int * x, int * y, int * z, MapData * map, 
+        int destroy)
+    int destroy_points(int count, int * x, int * y, int * z, char * removed,
+        MapData * map, vector[int] * floating)
+    void get_xyz(int pos, int * x, int * y, int * z)
     bint get_solid(int x, int y, int z, MapData * map)
     int get_color(int x, int y, int z, MapData * map)
     void set_point(int x, int y, int z, MapData * map, bint solid, int color)
@@ -25,23 +39,80 @@ cdef extern from "vxl_c.cpp":
         MapData * map, int color)
     int get_random_point(int x1, int y1, int x2, int y2, MapData * map, 
         float random_1, float random_2, int * x, int * y)
+    HeightMap * get_heights(MapData * map)
+    int get_z(int x, int y, int start, MapData * map)
+    int get_height(int x, int y, MapData * map)
+    int get_surface(int x, int y, int z, MapData * map)
+    void draw_overview(MapData * map, unsigned int * data, int z, bint rgba,
+        int x1, int y1, int x2, int y2)
+    int update_overview(MapData * map)
+    int count_land_rect(int x1, int y1, int x2, int y2, MapData * map)
+    int count_solid(int x1, int y1, int z1, int x2, int y2, int z2,
+        MapData * map)
+    int count_water(int x1, int y1, int x2, int y2, MapData * map)
+    void get_height_histogram(int x1, int y1, int x2, int y2, MapData * map,
+        int * histogram)
     bint is_valid_position(int x, int y, int z)
+    int get_voxel_pos "get_pos" (int x, int y, int z)
     void update_shadows(MapData * map)
+    void start_delta(MapData * map)
+    void stop_delta(MapData * map)
+    int get_delta_size(MapData * map)
+    object get_delta(MapData * map)
 
 cdef class VXLData:
     cdef MapData * map
     cdef public int crc
+    cdef readonly unsigned int delta_id
+    # buffers exported by HeightMapView, which load_vxl would free
+    cdef int buffer_exports
     
     cpdef get_solid(self, int x, int y, int z)
     cpdef get_color(self, int x, int y, int z)
     cpdef tuple get_random_point(self, int x1, int y1, int x2, int y2)
     cpdef int get_z(self, int x, int y, int start = ?)
     cpdef int get_height(self, int x, int y)
+    cpdef int get_surface(self, int x, int y, int z)
     cpdef bint has_neighbors(self, int x, int y, int z)
     cpdef bint is_surface(self, int x, int y, int z)
     cpdef list get_neighbors(self, int x, int y, int z)
     cpdef int check_node(self, int x, int y, int z, bint destroy = ?)
+    cpdef int check_nodes(self, list nodes, bint destroy = ?)
     cpdef bint build_point(self, int x, int y, int z, tuple color)
     cpdef bint set_column_fast(self, int x, int y, int start_z,
         int end_z, int end_color_z, int color)
     cpdef update_shadows(self)
+
+cdef class HeightMapView:
+    cdef VXLData map
+    cdef bint ground
+    cdef Py_ssize_t shape[2]
+    cdef Py_ssize_t strides[2]
+    
+    cdef unsigned char * get_data(self)
+
+cdef class VoxelSet:
+    cdef unsigned long long * bits
+    cdef readonly int count
+    cdef dict values
+    
+    cpdef bint contains(self, int x, int y, int z)
+    cpdef bint add(self, int x, int y, int z, value = ?)
+    cpdef bint discard(self, int x, int y, int z)
+    cpdef int add_box(self, int x1, int y1, int z1, int x2, int y2, int z2)
+    cpdef bint any_in_box(self, int x1, int y1, int z1, int x2, int y2,
+        int z2)
+    cpdef int count_in_box(self, int x1, int y1, int z1, int x2, int y2,
+        int z2)
+    cdef list get_points(self)
+
+cdef class RegionSet:
+    cdef list boxes
+    cdef list voxels
+    cdef VoxelSet table
+    cdef bint dirty
+    
+    cdef VoxelSet get_table(self)
+    cpdef bint contains(self, int x, int y, int z)
+    cpdef bint any_in_box(self, int x1, int y1, int z1, int x2, int y2,
+        int z2)
@@ -16,6 +16,8 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 from pyspades.common cimport allocate_memory
+from libc.stdlib cimport calloc, free
+from libc.string cimport memset, memcpy
 
 cdef tuple make_color_tuple(int color):
     cdef int r, g, b, a
@@ -31,6 +33,9 @@ cpdef inline int make_color(int r, int g, int b, int a = 255):
 import time
 import random
 
+# every z of a column top, and empty columns
+DEF HISTOGRAM_SIZE = 64 + 1
+
 cdef class Generator:
     cdef MapGenerator * generator
     cdef public:
@@ -52,6 +57,19 @@ cdef class Generator:
     def __dealloc__(self):
         delete_map_generator(self.generator)
 
+def load_dump(bytes data):
+    """Returns the VXLData for a string from VXLData.dump(), or None if
+    the dump was made by a different version or build"""
+    cdef int crc
+    cdef MapData * c_map = load_map_dump(data, len(data), &crc)
+    if c_map == NULL:
+        return None
+    cdef VXLData map = VXLData()
+    delete_vxl(map.map)
+    map.map = c_map
+    map.crc = crc
+    return map
+
 cdef class VXLData:
     def __init__(self, fp = None):
         cdef unsigned char * c_data
@@ -63,15 +81,29 @@ cdef class VXLData:
             self.crc = crc
         else:
             c_data = NULL
-        self.map = load_vxl(c_data)
+        cdef MapData * map
+        # lets maps be loaded in a background thread
+        with nogil:
+            map = load_vxl(c_data)
+        self.map = map
     
     def load_vxl(self, c_data = None):
+        if self.buffer_exports:
+            raise BufferError('map has exported heightmap buffers')
+        delete_vxl(self.map)
         self.map = load_vxl(c_data)
+        self.delta_id += 1
     
     def copy(self):
         cdef VXLData map = VXLData()
+        delete_vxl(map.map)
         map.map = copy_map(self.map)
         return map
+    
+    def dump(self):
+        """Returns an exact image of the parsed map, which load_dump can
+        turn back into a VXLData much faster than parsing the .vxl"""
+        return dump_map(self.map, self.crc)
 
     def get_crc(self, data):
         import zlib
@@ -97,17 +129,21 @@ cdef class VXLData:
         return make_color_tuple(get_color(x, y, z, self.map))
     
     cpdef int get_z(self, int x, int y, int start = 0):
-        for z in xrange(start, 64):
-            if get_solid(x, y, z, self.map):
-                return z
-        return 0
+        return get_z(x, y, start, self.map)
     
     cpdef int get_height(self, int x, int y):
-        cdef int start = 63
-        for z in xrange(start, -1, -1):
-            if not get_solid(x, y, z, self.map):
-                return z + 1
-        return 0
+        return get_height(x, y, self.map)
+    
+    cpdef int get_surface(self, int x, int y, int z):
+        """Returns the z something resting at z ends up at: the top of the
+        solid blocks it is inside of, or the first solid block below it"""
+        return get_surface(x, y, z, self.map)
+    
+    def get_heightmap(self, bint ground = False):
+        """Returns the top (or with ground, the bottom) surface of every
+        column as a buffer of 512x512 bytes, indexed as [y][x]. The buffer
+        is live and follows changes to the map"""
+        return HeightMapView(self, ground)
     
     cpdef tuple get_random_point(self, int x1, int y1, int x2, int y2):
         cdef int x, y
@@ -115,28 +151,70 @@ cdef class VXLData:
             random.random(), &x, &y)
         return x, y
     
-    def count_land(self, int x1, y1, x2, y2):
-        cdef int land = 0
-        for x in xrange(x1, x2):
-            for y in xrange(y1, y2):
-                if self.get_solid(x, y, 62):
-                    land += 1
-        return land
+    def count_land(self, int x1 = 0, int y1 = 0, int x2 = MAP_X,
+                   int y2 = MAP_Y):
+        """Returns the number of columns in [x1, x2) * [y1, y2) that are
+        solid at z 62"""
+        return count_land_rect(x1, y1, x2, y2, self.map)
+    
+    def count_solid(self, int x1 = 0, int y1 = 0, int z1 = 0, int x2 = MAP_X,
+                    int y2 = MAP_Y, int z2 = MAP_Z):
+        """Returns the number of solid voxels in the box from (x1, y1, z1)
+        up to but not including (x2, y2, z2)"""
+        return count_solid(x1, y1, z1, x2, y2, z2, self.map)
+    
+    def count_water(self, int x1 = 0, int y1 = 0, int x2 = MAP_X,
+                    int y2 = MAP_Y):
+        """Returns the number of columns in [x1, x2) * [y1, y2) with
+        nothing above the water"""
+        return count_water(x1, y1, x2, y2, self.map)
+    
+    def get_height_histogram(self, int x1 = 0, int y1 = 0, int x2 = MAP_X,
+                             int y2 = MAP_Y):
+        """Returns a list with the number of columns in [x1, x2) * [y1, y2)
+        for every top z, with one more entry at the end for empty
+        columns"""
+        cdef int histogram[HISTOGRAM_SIZE]
+        get_height_histogram(x1, y1, x2, y2, self.map, histogram)
+        return [histogram[i] for i in xrange(HISTOGRAM_SIZE)]
     
     def destroy_point(self, int x, int y, int z):
-        if not self.get_solid(x, y, z) or z >= 62:
-            return 0
-        set_point(x, y, z, self.map, 0, 0)
-        count = 1
+        cdef char removed
         start = time.time()
-        for node_x, node_y, node_z in self.get_neighbors(x, y, z):
-            if node_z < 62:
-                count += self.check_node(node_x, node_y, node_z, True)
+        count = destroy_points(1, &x, &y, &z, &removed, self.map, NULL)
+        if not count:
+            return 0
         taken = time.time() - start
         if taken > 0.1:
             print 'destroying block at', x, y, z, 'took:', taken
         return count
     
+    def destroy_points(self, list points):
+        """Removes a list of (x, y, z) points at once, along with anything
+        left floating. Returns the list of points that were removed and the
+        list of voxels that fell"""
+        cdef int * data
+        cdef char * removed
+        cdef int i, x, y, z, count = len(points)
+        cdef vector[int] floating
+        data_python = allocate_memory(sizeof(int) * 3 * count, <char**>&data)
+        removed_python = allocate_memory(count, &removed)
+        for i in range(count):
+            data[i], data[count + i], data[count * 2 + i] = points[i]
+        start = time.time()
+        if not destroy_points(count, data, data + count, data + count * 2,
+                              removed, self.map, &floating):
+            return [], []
+        taken = time.time() - start
+        if taken > 0.1:
+            print 'destroying %s blocks took: %s' % (count, taken)
+        removed_points = [points[i] for i in range(count) if removed[i]]
+        falling = []
+        for i in range(floating.size()):
+            get_xyz(floating[i], &x, &y, &z)
+            falling.append((x, y, z))
+        return removed_points, falling
+    
     def remove_point(self, int x, int y, int z):
         if is_valid_position(x, y, z):
             set_point(x, y, z, self.map, 0, 0)
@@ -177,6 +255,17 @@ cdef class VXLData:
     cpdef int check_node(self, int x, int y, int z, bint destroy = False):
         return check_node(x, y, z, self.map, destroy)
     
+    cpdef int check_nodes(self, list nodes, bint destroy = False):
+        """Like check_node, but for a list of (x, y, z) nodes that are
+        checked together, so connected nodes are only walked once"""
+        cdef int * data
+        cdef int i, count = len(nodes)
+        data_python = allocate_memory(sizeof(int) * 3 * count, <char**>&data)
+        for i in range(count):
+            data[i], data[count + i], data[count * 2 + i] = nodes[i]
+        return check_nodes(count, data, data + count, data + count * 2, 
+            self.map, destroy)
+    
     cpdef bint build_point(self, int x, int y, int z, tuple color):
         if not is_valid_position(x, y, z):
             return False
@@ -203,35 +292,50 @@ cdef class VXLData:
     
     cpdef update_shadows(self):
         update_shadows(self.map)
+        # all colors change, so a delta would be as large as the map
+        self.stop_delta()
+    
+    def start_delta(self):
+        """Start a new delta log relative to the current state of the map.
+        Returns the id of the new log"""
+        start_delta(self.map)
+        self.delta_id += 1
+        return self.delta_id
+    
+    def stop_delta(self):
+        stop_delta(self.map)
+        self.delta_id += 1
+    
+    def get_delta_size(self):
+        """Number of voxels touched since the delta log was started, or -1
+        if no log is kept"""
+        return get_delta_size(self.map)
+    
+    def get_delta(self):
+        """Returns a list of (x, y, z, was_solid, color) for every voxel that
+        differs from when the delta log was started. color is None for
+        removed voxels"""
+        return get_delta(self.map)
     
     def get_overview(self, int z = -1, bint rgba = False):
         cdef unsigned int * data
-        cdef unsigned int i, r, g, b, a, color
         data_python = allocate_memory(sizeof(int[512][512]), <char**>&data)
-        i = 0
-        cdef int current_z
-        if z == -1:
-            a = 255
-        else:
-            current_z = z
-        for y in xrange(512):
-            for x in xrange(512):
-                if z == -1:
-                    current_z = self.get_z(x, y)
-                else:
-                    if get_solid(x, y, z, self.map):
-                        a = 255
-                    else:
-                        a = 0
-                color = get_color(x, y, current_z, self.map)
-                if rgba:
-                    b = color & 0xFF
-                    g = (color & 0xFF00) >> 8
-                    r = (color & 0xFF0000) >> 16
-                    data[i] = r | (g << 8) | (b << 16) | (a << 24)
-                else:
-                    data[i] = (color & 0x00FFFFFF) | (a << 24)
-                i += 1
+        draw_overview(self.map, data, z, rgba, 0, 0, MAP_X, MAP_Y)
+        return data_python
+    
+    def update_overview(self):
+        """Redraws the parts of the cached RGBA top overview that changed
+        since the last update. Returns the number of 32x32 tiles redrawn, so
+        0 means the overview is the same as last time"""
+        return update_overview(self.map)
+    
+    def get_cached_overview(self):
+        """Returns a copy of the cached RGBA top overview, which is the same
+        as get_overview(rgba = True), after bringing it up to date"""
+        cdef unsigned int * data
+        update_overview(self.map)
+        data_python = allocate_memory(sizeof(int[512][512]), <char**>&data)
+        memcpy(data, self.map.overview.data, sizeof(int[512][512]))
         return data_python
     
     def set_overview(self, data_str, int z):
@@ -266,3 +370,341 @@ cdef class VXLData:
             map = self.map
             self.map = NULL
             delete_vxl(map)
+
+cdef class HeightMapView:
+    """
+    Exposes the cached column heights of a map through the buffer protocol,
+    so memoryview(view)[y, x] or numpy.asarray(view) can read them without
+    a copy. load_vxl refuses to replace the map while a buffer is exported
+    """
+    def __init__(self, VXLData map, bint ground = False):
+        self.map = map
+        self.ground = ground
+        self.shape[0] = MAP_Y
+        self.shape[1] = MAP_X
+        self.strides[0] = MAP_X
+        self.strides[1] = 1
+    
+    cdef unsigned char * get_data(self):
+        # fetched every time, since load_vxl replaces the map and its heights
+        cdef HeightMap * heights = get_heights(self.map.map)
+        if self.ground:
+            return heights.ground
+        return heights.top
+    
+    def __getbuffer__(self, Py_buffer * buffer, int flags):
+        buffer.buf = self.get_data()
+        buffer.obj = self
+        buffer.len = MAP_X * MAP_Y
+        buffer.readonly = 1
+        buffer.itemsize = 1
+        buffer.format = 'B'
+        buffer.ndim = 2
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+        self.map.buffer_exports += 1
+    
+    def __releasebuffer__(self, Py_buffer * buffer):
+        self.map.buffer_exports -= 1
+    
+    def __len__(self):
+        return MAP_Y
+    
+    def __getitem__(self, tuple key):
+        cdef int x, y
+        y, x = key
+        if x < 0 or x >= MAP_X or y < 0 or y >= MAP_Y:
+            raise IndexError()
+        return self.get_data()[x + y * MAP_X]
+
+DEF VOXEL_WORDS = 512 * 512 * 64 // 64
+
+cdef inline void clip_box(int * x1, int * y1, int * z1, int * x2, int * y2,
+                          int * z2):
+    x1[0] = max(x1[0], 0)
+    y1[0] = max(y1[0], 0)
+    z1[0] = max(z1[0], 0)
+    x2[0] = min(x2[0], MAP_X)
+    y2[0] = min(y2[0], MAP_Y)
+    z2[0] = min(z2[0], MAP_Z)
+
+cdef class VoxelSet:
+    """
+    A set of map voxels, kept as one bit per voxel. Every member can carry a
+    value, which is stored only when it is not None. Points outside the map
+    are never members.
+    """
+    def __cinit__(self):
+        self.bits = <unsigned long long *>calloc(VOXEL_WORDS,
+            sizeof(unsigned long long))
+        if self.bits == NULL:
+            raise MemoryError()
+        self.values = {}
+    
+    def __init__(self, points = None, value = None):
+        if points is not None:
+            self.update(points, value)
+    
+    cpdef bint contains(self, int x, int y, int z):
+        cdef int pos
+        if not is_valid_position(x, y, z):
+            return False
+        pos = get_voxel_pos(x, y, z)
+        return (self.bits[pos >> 6] >> (pos & 63)) & 1
+    
+    cpdef bint add(self, int x, int y, int z, value = None):
+        """Adds a voxel, replacing its value if it is already a member.
+        Returns True if it was not a member before"""
+        cdef int pos
+        cdef unsigned long long mask
+        if not is_valid_position(x, y, z):
+            return False
+        pos = get_voxel_pos(x, y, z)
+        if value is None:
+            self.values.pop(pos, None)
+        else:
+            self.values[pos] = value
+        mask = (<unsigned long long>1) << (pos & 63)
+        if self.bits[pos >> 6] & mask:
+            return False
+        self.bits[pos >> 6] |= mask
+        self.count += 1
+        return True
+    
+    cpdef bint discard(self, int x, int y, int z):
+        """Removes a voxel. Returns True if it was a member"""
+        cdef int pos
+        cdef unsigned long long mask
+        if not is_valid_position(x, y, z):
+            return False
+        pos = get_voxel_pos(x, y, z)
+        mask = (<unsigned long long>1) << (pos & 63)
+        if not self.bits[pos >> 6] & mask:
+            return False
+        self.bits[pos >> 6] &= ~mask
+        self.count -= 1
+        if self.values:
+            self.values.pop(pos, None)
+        return True
+    
+    def update(self, points, value = None):
+        """Adds a list of (x, y, z) points, e.g. from cube_line"""
+        cdef int x, y, z
+        for x, y, z in points:
+            self.add(x, y, z, value)
+    
+    def difference_update(self, points):
+        cdef int x, y, z
+        for x, y, z in points:
+            self.discard(x, y, z)
+    
+    def get(self, tuple point, default = None):
+        cdef int x, y, z
+        x, y, z = point
+        if not self.contains(x, y, z):
+            return default
+        return self.values.get(get_voxel_pos(x, y, z), None)
+    
+    def pop(self, tuple point, *arg):
+        """Removes a voxel and returns its value. Raises KeyError if it is
+        not a member and no default is given"""
+        cdef int x, y, z
+        x, y, z = point
+        if not self.contains(x, y, z):
+            if arg:
+                return arg[0]
+            raise KeyError(point)
+        value = self.values.pop(get_voxel_pos(x, y, z), None)
+        self.discard(x, y, z)
+        return value
+    
+    cpdef int add_box(self, int x1, int y1, int z1, int x2, int y2, int z2):
+        """Adds every voxel in the box from (x1, y1, z1) up to but not
+        including (x2, y2, z2). Returns the number of voxels added"""
+        cdef int x, y, z, pos, added = 0
+        cdef unsigned long long mask
+        clip_box(&x1, &y1, &z1, &x2, &y2, &z2)
+        for z in range(z1, z2):
+            for y in range(y1, y2):
+                for x in range(x1, x2):
+                    pos = get_voxel_pos(x, y, z)
+                    mask = (<unsigned long long>1) << (pos & 63)
+                    if not self.bits[pos >> 6] & mask:
+                        self.bits[pos >> 6] |= mask
+                        added += 1
+        self.count += added
+        return added
+    
+    cpdef bint any_in_box(self, int x1, int y1, int z1, int x2, int y2,
+                          int z2):
+        """Returns True if any voxel in the box from (x1, y1, z1) up to but
+        not including (x2, y2, z2) is a member"""
+        cdef int x, y, z, pos
+        if self.count == 0:
+            return False
+        clip_box(&x1, &y1, &z1, &x2, &y2, &z2)
+        for z in range(z1, z2):
+            for y in range(y1, y2):
+                for x in range(x1, x2):
+                    pos = get_voxel_pos(x, y, z)
+                    if (self.bits[pos >> 6] >> (pos & 63)) & 1:
+                        return True
+        return False
+    
+    cpdef int count_in_box(self, int x1, int y1, int z1, int x2, int y2,
+                           int z2):
+        cdef int x, y, z, pos, count = 0
+        clip_box(&x1, &y1, &z1, &x2, &y2, &z2)
+        for z in range(z1, z2):
+            for y in range(y1, y2):
+                for x in range(x1, x2):
+                    pos = get_voxel_pos(x, y, z)
+                    count += (self.bits[pos >> 6] >> (pos & 63)) & 1
+        return count
+    
+    def clear(self):
+        memset(self.bits, 0, VOXEL_WORDS * sizeof(unsigned long long))
+        self.values.clear()
+        self.count = 0
+    
+    cdef list get_points(self):
+        cdef list points = []
+        cdef int i, bit, x, y, z
+        cdef unsigned long long word
+        if len(self.values) == self.count:
+            # every member has a value, so there is no need for a scan
+            for pos in self.values:
+                get_xyz(pos, &x, &y, &z)
+                points.append((x, y, z))
+            return points
+        for i in range(VOXEL_WORDS):
+            word = self.bits[i]
+            if not word:
+                continue
+            for bit in range(64):
+                if (word >> bit) & 1:
+                    get_xyz((i << 6) | bit, &x, &y, &z)
+                    points.append((x, y, z))
+        return points
+    
+    def iteritems(self):
+        cdef int x, y, z
+        cdef dict values = self.values
+        items = []
+        for point in self.get_points():
+            x, y, z = point
+            items.append((point, values.get(get_voxel_pos(x, y, z), None)))
+        return iter(items)
+    
+    def __iter__(self):
+        return iter(self.get_points())
+    
+    def __contains__(self, tuple point):
+        cdef int x, y, z
+        x, y, z = point
+        return self.contains(x, y, z)
+    
+    def __getitem__(self, tuple point):
+        cdef int x, y, z
+        x, y, z = point
+        if not self.contains(x, y, z):
+            raise KeyError(point)
+        return self.values.get(get_voxel_pos(x, y, z), None)
+    
+    def __setitem__(self, tuple point, value):
+        cdef int x, y, z
+        x, y, z = point
+        self.add(x, y, z, value)
+    
+    def __delitem__(self, tuple point):
+        cdef int x, y, z
+        x, y, z = point
+        if not self.discard(x, y, z):
+            raise KeyError(point)
+    
+    def __len__(self):
+        return self.count
+    
+    def __nonzero__(self):
+        return self.count > 0
+    
+    def __dealloc__(self):
+        if self.bits != NULL:
+            free(self.bits)
+            self.bits = NULL
+
+cdef class RegionSet:
+    """
+    Boxes and voxels that are registered once, e.g. protected areas, and
+    compiled into a VoxelSet so that lookups do not depend on how many
+    regions there are. Removing a region recompiles on the next lookup.
+    """
+    def __init__(self):
+        self.boxes = []
+        self.voxels = []
+        self.table = None
+        self.dirty = False
+    
+    cdef VoxelSet get_table(self):
+        cdef int x1, y1, z1, x2, y2, z2
+        if self.table is None:
+            self.table = VoxelSet()
+        elif self.dirty:
+            self.table.clear()
+        else:
+            return self.table
+        self.dirty = False
+        for x1, y1, z1, x2, y2, z2 in self.boxes:
+            self.table.add_box(x1, y1, z1, x2, y2, z2)
+        for points in self.voxels:
+            self.table.update(points)
+        return self.table
+    
+    def add_box(self, int x1, int y1, int z1, int x2, int y2, int z2):
+        """Protects the box from (x1, y1, z1) up to but not including
+        (x2, y2, z2)"""
+        self.boxes.append((x1, y1, z1, x2, y2, z2))
+        if self.table is not None and not self.dirty:
+            self.table.add_box(x1, y1, z1, x2, y2, z2)
+    
+    def remove_box(self, int x1, int y1, int z1, int x2, int y2, int z2):
+        self.boxes.remove((x1, y1, z1, x2, y2, z2))
+        self.dirty = True
+    
+    def add_sector(self, int x, int y):
+        """Adds the full height of the 64x64 sector at x, y, as given by
+        pyspades.common.coordinates"""
+        self.add_box(x, y, 0, x + 64, y + 64, MAP_Z)
+    
+    def remove_sector(self, int x, int y):
+        self.remove_box(x, y, 0, x + 64, y + 64, MAP_Z)
+    
+    def add_voxels(self, points):
+        """Adds a list of (x, y, z) points or a VoxelSet"""
+        points = list(points)
+        self.voxels.append(points)
+        if self.table is not None and not self.dirty:
+            self.table.update(points)
+    
+    def clear(self):
+        self.boxes = []
+        self.voxels = []
+        self.dirty = True
+    
+    cpdef bint contains(self, int x, int y, int z):
+        if not self.boxes and not self.voxels:
+            return False
+        return self.get_table().contains(x, y, z)
+    
+    cpdef bint any_in_box(self, int x1, int y1, int z1, int x2, int y2,
+                          int z2):
+        """Returns True if any voxel in the box from (x1, y1, z1) up to but
+        not including (x2, y2, z2) is in a region"""
+        if not self.boxes and not self.voxels:
+            return False
+        return self.get_table().any_in_box(x1, y1, z1, x2, y2, z2)
+    
+    def __nonzero__(self):
+        return bool(self.boxes or self.voxels)
@@ -61,7 +61,7 @@ MapData * load_vxl(unsigned char * v)
                map->geometry[get_pos(x, y, i)] = 0;
             color = (int *) (v+4);
             for(z=top_color_start; z <= top_color_end; z++)
-               map->colors[get_pos(x, y, z)] = *color++;
+               store_color(get_pos(x, y, z), map, *color++);
             len_bottom = top_color_end - top_color_start + 1;
 
             // check for end of data marker
@@ -80,7 +80,7 @@ MapData * load_vxl(unsigned char * v)
             bottom_color_end   = v[3]; // aka air start
             bottom_color_start = bottom_color_end - len_top;
             for(z=bottom_color_start; z < bottom_color_end; ++z) {
-               map->colors[get_pos(x, y, z)] = *color++;
+               store_color(get_pos(x, y, z), map, *color++);
             }
          }
       }
@@ -93,98 +93,167 @@ void inline delete_vxl(MapData * map)
     delete map;
 }
 
-struct Position {
-    int x; 
-    int y;
-    int z;
-};
-
 #define NODE_RESERVE_SIZE 250000
-static Position * nodes = NULL;
-static int node_pos;
-static int nodes_size;
-static set_type<int> marked;
-
-inline void push_back_node(int x, int y, int z)
-{
-    nodes[node_pos].x = x;
-    nodes[node_pos].y = y;
-    nodes[node_pos].z = z;
-    node_pos++;
-}
 
-inline const Position * pop_back_node()
+inline NodeScratch * get_scratch(MapData * map)
 {
-    return &nodes[--node_pos];
+    if (map->scratch == NULL) {
+        map->scratch = new NodeScratch;
+        map->scratch->nodes.reserve(NODE_RESERVE_SIZE);
+    }
+    return map->scratch;
 }
 
-inline void add_node(int x, int y, int z, MapData * map)
+inline void add_node(int x, int y, int z, MapData * map, 
+                     NodeScratch * scratch)
 {
     if (x < 0 || x > 511 ||
         y < 0 || y > 511 ||
         z < 0 || z > 63)
         return;
-    if (!map->geometry[get_pos(x, y, z)])
+    int i = get_pos(x, y, z);
+    if (!map->geometry[i])
+        return;
+    // visited nodes only need another look if they lead to the ground
+    if (scratch->visited[i] && !scratch->grounded[i])
         return;
-    push_back_node(x, y, z);
+    Position node = {x, y, z};
+    scratch->nodes.push_back(node);
 }
 
-int check_node(int x, int y, int z, MapData * map, int destroy)
+// walks the solid voxels connected to (x, y, z), adding them to marked.
+// returns true as soon as the ground or a voxel known to be connected to it
+// is reached
+
+bool find_ground(int x, int y, int z, MapData * map, NodeScratch * scratch)
 {
-    if (nodes == NULL) {
-        nodes = (Position*)malloc(sizeof(Position) * NODE_RESERVE_SIZE);
-        nodes_size = NODE_RESERVE_SIZE;
-    }
-    node_pos = 0;
+    std::vector<Position> & nodes = scratch->nodes;
+    nodes.clear();
     
-    push_back_node(x, y, z);
+    Position start = {x, y, z};
+    nodes.push_back(start);
     
-    while (node_pos > 0) {
-        if (node_pos >= nodes_size - 6) {
-            nodes_size += NODE_RESERVE_SIZE;
-            nodes = (Position*)realloc((void*)nodes, 
-                sizeof(Position) * nodes_size);
-        }
-        const Position * current_node = pop_back_node();
-        z = current_node->z;
-        if (z >= 62) {
-            marked.clear();
-            return 0;
-        }
-        x = current_node->x;
-        y = current_node->y;
+    while (!nodes.empty()) {
+        const Position current_node = nodes.back();
+        nodes.pop_back();
+        z = current_node.z;
+        if (z >= 62)
+            return true;
+        x = current_node.x;
+        y = current_node.y;
         
         int i = get_pos(x, y, z);
         
+        if (scratch->grounded[i])
+            return true;
         // already visited?
-        pair<set_type<int>::iterator, bool> ret;
-        ret = marked.insert(i);
-        if (ret.second) {
-            add_node(x, y, z - 1, map);
-            add_node(x, y - 1, z, map);
-            add_node(x, y + 1, z, map);
-            add_node(x - 1, y, z, map);
-            add_node(x + 1, y, z, map);
-            add_node(x, y, z + 1, map);
-        }
+        if (scratch->visited[i])
+            continue;
+        scratch->visited[i] = 1;
+        scratch->marked.push_back(i);
+        add_node(x, y, z - 1, map, scratch);
+        add_node(x, y - 1, z, map, scratch);
+        add_node(x, y + 1, z, map, scratch);
+        add_node(x - 1, y, z, map, scratch);
+        add_node(x + 1, y, z, map, scratch);
+        add_node(x, y, z + 1, map, scratch);
     }
+    return false;
+}
 
-    // destroy the node's path!
-    
-    if (destroy) {
-        for (set_type<int>::const_iterator iter = marked.begin(); 
-             iter != marked.end(); ++iter)
-        {
-            map->geometry[*iter] = 0;
-            map->colors.erase(*iter);
+// checks which of the given nodes are no longer connected to the ground,
+// sharing the work between nodes that are connected to each other.
+// returns the number of floating voxels, which are removed if destroy is set.
+// if floating is not NULL, their positions are appended to it
+
+int check_nodes(int count, const int * x, const int * y, const int * z, 
+                MapData * map, int destroy, vector<int> * floating = NULL)
+{
+    NodeScratch * scratch = get_scratch(map);
+    vector<int> & marked = scratch->marked;
+    int ret = 0;
+    for (int n = 0; n < count; n++) {
+        if (!is_valid_position(x[n], y[n], z[n]))
+            continue;
+        int i = get_pos(x[n], y[n], z[n]);
+        // removed, or part of a structure that has already been checked
+        if (!map->geometry[i] || scratch->visited[i])
+            continue;
+        size_t start = marked.size();
+        if (find_ground(x[n], y[n], z[n], map, scratch)) {
+            for (size_t j = start; j < marked.size(); j++)
+                scratch->grounded[marked[j]] = 1;
+            continue;
+        }
+        ret += (int)(marked.size() - start);
+        if (floating != NULL)
+            floating->insert(floating->end(), marked.begin() + start, 
+                marked.end());
+        if (!destroy)
+            continue;
+        // destroy the node's path!
+        for (size_t j = start; j < marked.size(); j++) {
+            i = marked[j];
+            log_point(i, map);
+            set_solid(i, map, 0);
+            erase_color(i, map);
         }
     }
-    
-    int ret = (int)marked.size();
+    for (size_t j = 0; j < marked.size(); j++) {
+        scratch->visited[marked[j]] = 0;
+        scratch->grounded[marked[j]] = 0;
+    }
     marked.clear();
     return ret;
 }
 
+int check_node(int x, int y, int z, MapData * map, int destroy)
+{
+    return check_nodes(1, &x, &y, &z, map, destroy);
+}
+
+inline void add_neighbor(NodeScratch * scratch, int x, int y, int z)
+{
+    scratch->neighbor_x.push_back(x);
+    scratch->neighbor_y.push_back(y);
+    scratch->neighbor_z.push_back(z);
+}
+
+// removes the given voxels together, and then everything that was only held
+// up by them. removed[n] is set for every given voxel that was solid.
+// returns the total number of voxels removed
+
+int destroy_points(int count, const int * x, const int * y, const int * z,
+                   char * removed, MapData * map, vector<int> * floating)
+{
+    NodeScratch * scratch = get_scratch(map);
+    int ret = 0;
+    scratch->neighbor_x.clear();
+    scratch->neighbor_y.clear();
+    scratch->neighbor_z.clear();
+    for (int n = 0; n < count; n++) {
+        removed[n] = 0;
+        if (!is_valid_position(x[n], y[n], z[n]) || z[n] >= 62)
+            continue;
+        if (!map->geometry[get_pos(x[n], y[n], z[n])])
+            continue;
+        set_point(x[n], y[n], z[n], map, 0, 0);
+        removed[n] = 1;
+        ret++;
+        add_neighbor(scratch, x[n], y[n], z[n] - 1);
+        add_neighbor(scratch, x[n], y[n] - 1, z[n]);
+        add_neighbor(scratch, x[n], y[n] + 1, z[n]);
+        add_neighbor(scratch, x[n] - 1, y[n], z[n]);
+        add_neighbor(scratch, x[n] + 1, y[n], z[n]);
+        add_neighbor(scratch, x[n], y[n], z[n] + 1);
+    }
+    if (ret == 0)
+        return 0;
+    return ret + check_nodes(scratch->neighbor_x.size(), 
+        &scratch->neighbor_x[0], &scratch->neighbor_y[0], 
+        &scratch->neighbor_z[0], map, 1, floating);
+}
+
 // write_map/save_vxl function from stb/nothings - thanks a lot for the 
 // public-domain code!
 
@@ -203,11 +272,10 @@ inline int is_surface(MapData * map, int x, int y, int z)
 
 inline int get_write_color(MapData * map, int x, int y, int z)
 {
-    map_type<int, int>::const_iterator iter = map->colors.find(
-        get_pos(x, y, z));
-    if (iter == map->colors.end())
+    int color;
+    if (!find_color(get_pos(x, y, z), map, &color))
         return DEFAULT_COLOR;
-    return iter->second;
+    return color;
 }
 
 inline void write_color(char ** out, int color)
@@ -329,19 +397,420 @@ PyObject * save_vxl(MapData * map)
 
 inline MapData * copy_map(MapData * map)
 {
+    // the delta log is not copied
     return new MapData(*map);
 }
 
-struct Point2D
+// map dumps are an exact image of a MapData, for caching parsed maps on
+// disk. they are only meant to be read back by the same build, so the
+// header records the sizes of everything that could differ between builds
+
+#define MAP_DUMP_MAGIC "PYSPMAP"
+#define MAP_DUMP_VERSION 1
+
+struct MapDumpHeader
 {
-    int x, y;
+    char magic[8];
+    int version;
+    int crc;
+    unsigned int geometry_size;
+    unsigned int column_count;
+    unsigned int color_count;
+    unsigned int colors_used;
 };
 
+inline void write_dump(char ** out, const void * data, size_t size)
+{
+    memcpy(*out, data, size);
+    *out += size;
+}
+
+PyObject * dump_map(MapData * map, int crc)
+{
+    MapDumpHeader header;
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, MAP_DUMP_MAGIC, sizeof(MAP_DUMP_MAGIC));
+    header.version = MAP_DUMP_VERSION;
+    header.crc = crc;
+    header.geometry_size = sizeof(map->geometry);
+    header.column_count = MAP_X * MAP_Y;
+    header.color_count = map->colors.size();
+    header.colors_used = map->colors_used;
+    size_t size = sizeof(header) + sizeof(map->geometry) + 
+        sizeof(map->color_mask) + sizeof(map->color_offset) + 
+        sizeof(map->color_capacity) + header.color_count * sizeof(int);
+    PyObject * value = PyString_FromStringAndSize(NULL, size);
+    if (value == NULL)
+        return NULL;
+    char * out = PyString_AS_STRING(value);
+    write_dump(&out, &header, sizeof(header));
+    // the bitset is a plain array of words
+    write_dump(&out, &map->geometry, sizeof(map->geometry));
+    write_dump(&out, map->color_mask, sizeof(map->color_mask));
+    write_dump(&out, map->color_offset, sizeof(map->color_offset));
+    write_dump(&out, map->color_capacity, sizeof(map->color_capacity));
+    if (header.color_count)
+        write_dump(&out, &map->colors[0], header.color_count * sizeof(int));
+    return value;
+}
+
+inline void read_dump(const char ** data, void * out, size_t size)
+{
+    memcpy(out, *data, size);
+    *data += size;
+}
+
+// returns NULL if data is not a dump from this build
+
+MapData * load_map_dump(const char * data, size_t size, int * crc)
+{
+    MapDumpHeader header;
+    if (size < sizeof(header))
+        return NULL;
+    read_dump(&data, &header, sizeof(header));
+    MapData * map = new MapData;
+    if (memcmp(header.magic, MAP_DUMP_MAGIC, sizeof(MAP_DUMP_MAGIC)) != 0 ||
+        header.version != MAP_DUMP_VERSION ||
+        header.geometry_size != sizeof(map->geometry) ||
+        header.column_count != MAP_X * MAP_Y ||
+        size != sizeof(header) + sizeof(map->geometry) + 
+            sizeof(map->color_mask) + sizeof(map->color_offset) + 
+            sizeof(map->color_capacity) + header.color_count * sizeof(int))
+    {
+        delete map;
+        return NULL;
+    }
+    read_dump(&data, &map->geometry, sizeof(map->geometry));
+    read_dump(&data, map->color_mask, sizeof(map->color_mask));
+    read_dump(&data, map->color_offset, sizeof(map->color_offset));
+    read_dump(&data, map->color_capacity, sizeof(map->color_capacity));
+    map->colors.resize(header.color_count);
+    if (header.color_count)
+        read_dump(&data, &map->colors[0], header.color_count * sizeof(int));
+    map->colors_used = header.colors_used;
+    *crc = header.crc;
+    return map;
+}
+
+void start_delta(MapData * map)
+{
+    if (map->delta == NULL)
+        map->delta = new map_type<int, DeltaEntry>;
+    else
+        map->delta->clear();
+}
+
+void stop_delta(MapData * map)
+{
+    delete map->delta;
+    map->delta = NULL;
+}
+
+int get_delta_size(MapData * map)
+{
+    if (map->delta == NULL)
+        return -1;
+    return (int)map->delta->size();
+}
+
+// returns a list of (x, y, z, was_solid, color) for every voxel that differs
+// from the state it had when the log was started. color is None for voxels
+// that have been removed. changes that were undone again are left out.
+
+PyObject * get_delta(MapData * map)
+{
+    PyObject * list = PyList_New(0);
+    if (map->delta == NULL)
+        return list;
+    int x, y, z, color;
+    PyObject * item;
+    for (map_type<int, DeltaEntry>::const_iterator iter = map->delta->begin();
+        iter != map->delta->end(); ++iter) {
+        const DeltaEntry & entry = iter->second;
+        get_xyz(iter->first, &x, &y, &z);
+        if (map->geometry[iter->first]) {
+            color = get_color(x, y, z, map);
+            if (entry.solid && 
+                (entry.color & 0xFFFFFF) == (color & 0xFFFFFF))
+                continue;
+            item = Py_BuildValue("(iiiii)", x, y, z, (int)entry.solid, 
+                color);
+        } else {
+            if (!entry.solid)
+                continue;
+            item = Py_BuildValue("(iiiiO)", x, y, z, 1, Py_None);
+        }
+        PyList_Append(list, item);
+        Py_DECREF(item);
+    }
+    return list;
+}
+
 inline unsigned int random(unsigned int a, unsigned int b, float value)
 {
     return (unsigned int)(value * (b - a) + a);
 }
 
+LandIndex * get_land(MapData * map)
+{
+    if (map->land != NULL)
+        return map->land;
+    LandIndex * land = map->land = new LandIndex;
+    memset(land->tree, 0, sizeof(land->tree));
+    int x, y, k;
+    for (x = 0; x < MAP_X; x++)
+        for (y = 0; y < MAP_Y; y++)
+            land->tree[x + 1][y + 1] = map->geometry[get_pos(x, y, LAND_Z)];
+    // turn the plain counts into a fenwick tree, one dimension at a time
+    for (x = 1; x <= MAP_X; x++) {
+        for (y = 1; y <= MAP_Y; y++) {
+            k = y + (y & -y);
+            if (k <= MAP_Y)
+                land->tree[x][k] += land->tree[x][y];
+        }
+    }
+    for (x = 1; x <= MAP_X; x++) {
+        k = x + (x & -x);
+        if (k > MAP_X)
+            continue;
+        for (y = 1; y <= MAP_Y; y++)
+            land->tree[k][y] += land->tree[x][y];
+    }
+    return land;
+}
+
+HeightMap * get_heights(MapData * map)
+{
+    if (map->heights != NULL)
+        return map->heights;
+    HeightMap * heights = map->heights = new HeightMap;
+    int x, y, z, column;
+    for (x = 0; x < MAP_X; x++) {
+        for (y = 0; y < MAP_Y; y++) {
+            column = x + y * MAP_X;
+            z = 0;
+            while (z < MAP_Z && !map->geometry[get_pos(x, y, z)])
+                z++;
+            heights->top[column] = z;
+            z = MAP_Z;
+            while (z > 0 && map->geometry[get_pos(x, y, z - 1)])
+                z--;
+            heights->ground[column] = z;
+        }
+    }
+    return heights;
+}
+
+// first solid z at or below start, or 0 if there is none
+
+int get_z(int x, int y, int start, MapData * map)
+{
+    if (x < 0 || x >= MAP_X || y < 0 || y >= MAP_Y)
+        return 0;
+    int z = get_heights(map)->top[x + y * MAP_X];
+    if (z >= MAP_Z)
+        return 0;
+    if (start <= z)
+        return z;
+    for (z = start; z < MAP_Z; z++) {
+        if (map->geometry[get_pos(x, y, z)])
+            return z;
+    }
+    return 0;
+}
+
+// lowest z that is solid all the way down to the bottom
+
+int get_height(int x, int y, MapData * map)
+{
+    if (x < 0 || x >= MAP_X || y < 0 || y >= MAP_Y)
+        return MAP_Z;
+    return get_heights(map)->ground[x + y * MAP_X];
+}
+
+// where something resting at z ends up: the top of the solid run it is
+// buried in, or else the first solid z below it
+
+int get_surface(int x, int y, int z, MapData * map)
+{
+    if (x < 0 || x >= MAP_X || y < 0 || y >= MAP_Y)
+        return z;
+    int top = get_heights(map)->top[x + y * MAP_X];
+    if (z <= top)
+        return top;
+    if (z <= MAP_Z && map->geometry[get_pos(x, y, z - 1)]) {
+        z--;
+        while (z > 0 && map->geometry[get_pos(x, y, z - 1)])
+            z--;
+        return z;
+    }
+    while (z < MAP_Z && !map->geometry[get_pos(x, y, z)])
+        z++;
+    return z;
+}
+
+// draws the columns in [x1, x2) * [y1, y2) of a top-down image of the map,
+// or of the single layer z if z is not -1. with rgba, pixels are RGBA bytes,
+// otherwise the colors are kept as they are stored
+
+void draw_overview(MapData * map, unsigned int * data, int z, bool rgba,
+                   int x1, int y1, int x2, int y2)
+{
+    HeightMap * heights = NULL;
+    if (z == -1)
+        heights = get_heights(map);
+    int x, y, current_z, i;
+    unsigned int a = 255, color;
+    for (y = y1; y < y2; y++) {
+        for (x = x1; x < x2; x++) {
+            i = x + y * MAP_X;
+            if (z == -1) {
+                current_z = heights->top[i];
+                if (current_z >= MAP_Z)
+                    current_z = 0;
+            } else {
+                current_z = z;
+                a = get_solid(x, y, z, map) ? 255 : 0;
+            }
+            if (is_valid_position(x, y, current_z))
+                color = get_color(x, y, current_z, map);
+            else
+                color = 0;
+            if (rgba)
+                data[i] = ((color >> 16) & 0xFF) | (color & 0xFF00) |
+                    ((color & 0xFF) << 16) | (a << 24);
+            else
+                data[i] = (color & 0x00FFFFFF) | (a << 24);
+        }
+    }
+}
+
+// redraws the tiles of the RGBA overview that changed since the last call,
+// returns how many were redrawn
+
+int update_overview(MapData * map)
+{
+    Overview * overview = map->overview;
+    if (overview == NULL) {
+        get_heights(map);
+        overview = map->overview = new Overview;
+        for (int tile = 0; tile < OVERVIEW_TILES; tile++)
+            overview->dirty[tile] = true;
+        overview->dirty_count = OVERVIEW_TILES;
+    }
+    int count = overview->dirty_count;
+    if (count == 0)
+        return 0;
+    int tiles_x = MAP_X / OVERVIEW_TILE;
+    for (int tile = 0; tile < OVERVIEW_TILES; tile++) {
+        if (!overview->dirty[tile])
+            continue;
+        int x = (tile % tiles_x) * OVERVIEW_TILE;
+        int y = (tile / tiles_x) * OVERVIEW_TILE;
+        draw_overview(map, overview->data, -1, true, x, y,
+            x + OVERVIEW_TILE, y + OVERVIEW_TILE);
+        overview->dirty[tile] = false;
+    }
+    overview->dirty_count = 0;
+    return count;
+}
+
+// terrain statistics. all boxes are half-open and clipped to the map
+
+inline void clip_rect(int * x1, int * y1, int * x2, int * y2)
+{
+    limit(x1, 0, MAP_X);
+    limit(x2, *x1, MAP_X);
+    limit(y1, 0, MAP_Y);
+    limit(y2, *y1, MAP_Y);
+}
+
+int count_land_rect(int x1, int y1, int x2, int y2, MapData * map)
+{
+    clip_rect(&x1, &y1, &x2, &y2);
+    return count_land(get_land(map), x1, y1, x2, y2);
+}
+
+// the bitset is a plain array of words, as in dump_map
+typedef unsigned long GeometryWord;
+#define WORD_BITS ((int)sizeof(GeometryWord) * 8)
+
+// solid voxels in the positions [start, end)
+
+inline int count_solid_range(const GeometryWord * words, int start, int end)
+{
+    int first = start / WORD_BITS, last = end / WORD_BITS;
+    int start_bit = start % WORD_BITS, end_bit = end % WORD_BITS;
+    GeometryWord all = ~(GeometryWord)0;
+    if (first == last) {
+        if (start_bit == end_bit)
+            return 0;
+        return count_bits((words[first] >> start_bit) & 
+            (all >> (WORD_BITS - (end_bit - start_bit))));
+    }
+    int count = count_bits(words[first] >> start_bit);
+    for (int i = first + 1; i < last; i++)
+        count += count_bits(words[i]);
+    if (end_bit)
+        count += count_bits(words[last] & (all >> (WORD_BITS - end_bit)));
+    return count;
+}
+
+int count_solid(int x1, int y1, int z1, int x2, int y2, int z2, MapData * map)
+{
+    clip_rect(&x1, &y1, &x2, &y2);
+    limit(&z1, 0, MAP_Z);
+    limit(&z2, z1, MAP_Z);
+    const GeometryWord * words = (const GeometryWord *)&map->geometry;
+    int count = 0;
+    if (x1 == 0 && x2 == MAP_X) {
+        // whole rows, so every layer is one run
+        for (int z = z1; z < z2; z++)
+            count += count_solid_range(words, get_pos(0, y1, z),
+                get_pos(0, y2, z));
+        return count;
+    }
+    for (int z = z1; z < z2; z++)
+        for (int y = y1; y < y2; y++)
+            count += count_solid_range(words, get_pos(x1, y, z),
+                get_pos(x2, y, z));
+    return count;
+}
+
+// columns whose top is the water layer
+
+int count_water(int x1, int y1, int x2, int y2, MapData * map)
+{
+    clip_rect(&x1, &y1, &x2, &y2);
+    HeightMap * heights = get_heights(map);
+    int count = 0;
+    for (int y = y1; y < y2; y++) {
+        unsigned char * top = &heights->top[y * MAP_X];
+        for (int x = x1; x < x2; x++)
+            count += top[x] == MAP_Z - 1;
+    }
+    return count;
+}
+
+// histogram has MAP_Z + 1 entries, the last for empty columns
+
+void get_height_histogram(int x1, int y1, int x2, int y2, MapData * map,
+                          int * histogram)
+{
+    clip_rect(&x1, &y1, &x2, &y2);
+    HeightMap * heights = get_heights(map);
+    memset(histogram, 0, (MAP_Z + 1) * sizeof(int));
+    for (int y = y1; y < y2; y++) {
+        unsigned char * top = &heights->top[y * MAP_X];
+        for (int x = x1; x < x2; x++)
+            histogram[top[x]]++;
+    }
+}
+
+// picks a random land column in [x1, x2) * [y1, y2), or any column if
+// there is no land. the land columns are numbered by x, then y, and
+// random_1 decides which one is picked
+
 inline void get_random_point(int x1, int y1, int x2, int y2, MapData * map,
                              float random_1, float random_2,
                              int * end_x, int * end_y)
@@ -350,28 +819,37 @@ inline void get_random_point(int x1, int y1, int x2, int y2, MapData * map,
     limit(&y1, 0, 511);
     limit(&x2, 0, 511);
     limit(&y2, 0, 511);
-    vector<Point2D> items;
-    int size = 0;
-    int x, y;
-    for(x = x1; x < x2; x++){
-        for(y = y1; y < y2; y++) {
-            if (map->geometry[get_pos(x, y, 62)]) {
-                Point2D item;
-                item.x = x;
-                item.y = y;
-                items.push_back(item);
-                size += 1;
-            }
-        }
-    }
+    LandIndex * land = get_land(map);
+    int size = count_land(land, x1, y1, x2, y2);
     if (size == 0) {
         *end_x = random(x1, x2, random_1);
         *end_y = random(y1, y2, random_2);
-    } else {
-        Point2D item = items[random(0, size, random_1)];
-        *end_x = item.x;
-        *end_y = item.y;
+        return;
     }
+    int index = random(0, size, random_1);
+    // first x where the land in [x1, x + 1) * [y1, y2) goes past index
+    int low = x1, high = x2 - 1, middle;
+    while (low < high) {
+        middle = (low + high) / 2;
+        if (count_land(land, x1, y1, middle + 1, y2) > index)
+            high = middle;
+        else
+            low = middle + 1;
+    }
+    int x = low;
+    index -= count_land(land, x1, y1, x, y2);
+    // then the y in that column
+    low = y1;
+    high = y2 - 1;
+    while (low < high) {
+        middle = (low + high) / 2;
+        if (count_land(land, x, y1, x + 1, middle + 1) > index)
+            high = middle;
+        else
+            low = middle + 1;
+    }
+    *end_x = x;
+    *end_y = low;
 }
 
 #define SHADOW_DISTANCE 18
@@ -396,12 +874,20 @@ void update_shadows(MapData * map)
     int x, y, z;
     int a;
     unsigned int color;
-    for (map_type<int, int>::iterator iter = map->colors.begin();
-        iter != map->colors.end(); ++iter) {
-        get_xyz(iter->first, &x, &y, &z);
-        color = iter->second;
-        a = sunblock(map, x, y, z);
-        iter->second = (color & 0x00FFFFFF) | (a << 24);
+    for (int i = 0; i < MAP_X * MAP_Y; i++) {
+        unsigned long long mask = map->color_mask[i];
+        if (mask == 0)
+            continue;
+        int * data = &map->colors[map->color_offset[i]];
+        x = i % MAP_X;
+        y = i / MAP_X;
+        for (z = 0; mask != 0; z++, mask >>= 1) {
+            if (!(mask & 1))
+                continue;
+            color = *data;
+            a = sunblock(map, x, y, z);
+            *data++ = (color & 0x00FFFFFF) | (a << 24);
+        }
     }
 }
 
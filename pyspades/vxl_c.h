@@ -2,6 +2,10 @@
 #define VXL_C_H
 
 #include <bitset>
+#include <string.h>
+#include <stdlib.h>
+#include <vector>
+#include <algorithm>
 #include <boost/unordered_map.hpp>
 #include <boost/unordered_set.hpp>
 
@@ -14,13 +18,230 @@
 #define get_pos(x, y, z) ((x) + (y) * MAP_Y + (z) * MAP_X * MAP_Y)
 #define DEFAULT_COLOR 0xFF674028
 
+struct DeltaEntry
+{
+    bool solid;
+    int color;
+};
+
+#define COLOR_STEP 4
+
+struct Position {
+    int x; 
+    int y;
+    int z;
+};
+
+// scratch state for check_nodes. the bits of every voxel in marked are
+// cleared again before returning, so nothing has to be reset or freed
+// between queries
+struct NodeScratch
+{
+    std::vector<Position> nodes;
+    std::bitset<MAP_X * MAP_Y * MAP_Z> visited;
+    std::bitset<MAP_X * MAP_Y * MAP_Z> grounded;
+    std::vector<int> marked;
+    std::vector<int> neighbor_x, neighbor_y, neighbor_z;
+};
+
+// columns that are solid at LAND_Z count as land, e.g. for spawning
+#define LAND_Z 62
+
+// 2D fenwick tree over the land columns, so the land in any rectangle can
+// be counted in O(log^2 n)
+struct LandIndex
+{
+    int tree[MAP_X + 1][MAP_Y + 1];
+};
+
+// the top and bottom surface of every column
+struct HeightMap
+{
+    // first solid z, or MAP_Z if there is none
+    unsigned char top[MAP_X * MAP_Y];
+    // lowest z that is solid all the way down to the bottom, or MAP_Z if
+    // the bottom is not solid
+    unsigned char ground[MAP_X * MAP_Y];
+};
+
+// the overview is redrawn in tiles of this many columns squared
+#define OVERVIEW_TILE 32
+#define OVERVIEW_TILES ((MAP_X / OVERVIEW_TILE) * (MAP_Y / OVERVIEW_TILE))
+
+// RGBA top-down image of the map, redrawn a tile at a time as the map
+// changes
+struct Overview
+{
+    unsigned int data[MAP_X * MAP_Y];
+    bool dirty[OVERVIEW_TILES];
+    int dirty_count;
+};
+
+#ifdef __GNUC__
+#define count_bits(v) __builtin_popcountll(v)
+#else
+int inline count_bits(unsigned long long v)
+{
+    v = v - ((v >> 1) & 0x5555555555555555ULL);
+    v = (v & 0x3333333333333333ULL) + ((v >> 2) & 0x3333333333333333ULL);
+    v = (v + (v >> 4)) & 0x0F0F0F0F0F0F0F0FULL;
+    return (int)((v * 0x0101010101010101ULL) >> 56);
+}
+#endif
+
+int inline get_color_capacity(int count)
+{
+    return (count + COLOR_STEP - 1) & ~(COLOR_STEP - 1);
+}
+
 struct MapData
 {
     std::bitset<MAP_X * MAP_Y * MAP_Z> geometry;
     // char geometry[MAP_X * MAP_Y * MAP_Z];
-    map_type<int, int> colors;
+    // colors are kept per column: a bit for every z that has a color, and
+    // the colors themselves packed in z order into a slot of the shared
+    // colors array
+    unsigned long long color_mask[MAP_X * MAP_Y];
+    unsigned int color_offset[MAP_X * MAP_Y];
+    unsigned char color_capacity[MAP_X * MAP_Y];
+    std::vector<int> colors;
+    // number of entries in colors that belong to a column slot
+    unsigned int colors_used;
+    // original state of every voxel changed since the delta log was started,
+    // or NULL if no log is kept
+    map_type<int, DeltaEntry> * delta;
+    // created on the first check_nodes call. every map has its own, so
+    // different maps can be worked on at the same time
+    NodeScratch * scratch;
+    // created on the first land query and kept up to date by set_solid
+    LandIndex * land;
+    // created on the first height query and kept up to date by set_solid
+    HeightMap * heights;
+    // created on the first overview update, log_point marks its tiles
+    Overview * overview;
+
+    MapData()
+    : colors_used(0), delta(NULL), scratch(NULL), land(NULL), heights(NULL),
+      overview(NULL)
+    {
+        memset(color_mask, 0, sizeof(color_mask));
+        memset(color_offset, 0, sizeof(color_offset));
+        memset(color_capacity, 0, sizeof(color_capacity));
+    }
+
+    MapData(const MapData & other)
+    : geometry(other.geometry), colors(other.colors), 
+      colors_used(other.colors_used), delta(NULL), scratch(NULL), land(NULL),
+      heights(NULL), overview(NULL)
+    {
+        memcpy(color_mask, other.color_mask, sizeof(color_mask));
+        memcpy(color_offset, other.color_offset, sizeof(color_offset));
+        memcpy(color_capacity, other.color_capacity, sizeof(color_capacity));
+    }
+
+    ~MapData()
+    {
+        delete delta;
+        delete scratch;
+        delete land;
+        delete heights;
+        delete overview;
+    }
 };
 
+// moves all column slots together at the start of the colors array
+
+void inline compact_colors(MapData * map)
+{
+    std::vector<int> colors;
+    colors.reserve(map->colors_used);
+    for (int i = 0; i < MAP_X * MAP_Y; i++) {
+        int count = count_bits(map->color_mask[i]);
+        int capacity = get_color_capacity(count);
+        unsigned int offset = map->color_offset[i];
+        map->color_offset[i] = colors.size();
+        map->color_capacity[i] = capacity;
+        colors.insert(colors.end(), map->colors.begin() + offset,
+            map->colors.begin() + offset + count);
+        colors.resize(colors.size() + capacity - count);
+    }
+    map->colors.swap(colors);
+    map->colors_used = map->colors.size();
+}
+
+// i is a position as given by get_pos()
+
+bool inline find_color(int i, MapData * map, int * color)
+{
+    int column = i & (MAP_X * MAP_Y - 1);
+    unsigned long long mask = map->color_mask[column];
+    unsigned long long bit = 1ULL << (i / (MAP_X * MAP_Y));
+    if (!(mask & bit))
+        return false;
+    *color = map->colors[map->color_offset[column] + 
+        count_bits(mask & (bit - 1))];
+    return true;
+}
+
+void inline store_color(int i, MapData * map, int color)
+{
+    int column = i & (MAP_X * MAP_Y - 1);
+    unsigned long long mask = map->color_mask[column];
+    unsigned long long bit = 1ULL << (i / (MAP_X * MAP_Y));
+    int index = count_bits(mask & (bit - 1));
+    unsigned int offset = map->color_offset[column];
+    if (mask & bit) {
+        map->colors[offset + index] = color;
+        return;
+    }
+    int count = count_bits(mask);
+    int capacity = map->color_capacity[column];
+    if (count == capacity) {
+        int new_capacity = get_color_capacity(count + 1);
+        unsigned int size = map->colors.size();
+        if (offset + capacity == size) {
+            // last slot in the array, so it can just grow
+            map->colors.resize(offset + new_capacity);
+        } else {
+            map->colors.resize(size + new_capacity);
+            std::copy(map->colors.begin() + offset, 
+                map->colors.begin() + offset + count,
+                map->colors.begin() + size);
+            offset = size;
+            map->color_offset[column] = offset;
+        }
+        map->color_capacity[column] = new_capacity;
+        map->colors_used += new_capacity - capacity;
+    }
+    int * data = &map->colors[offset];
+    memmove(data + index + 1, data + index, (count - index) * sizeof(int));
+    data[index] = color;
+    map->color_mask[column] = mask | bit;
+    if (map->colors.size() > map->colors_used * 2)
+        compact_colors(map);
+}
+
+void inline erase_color(int i, MapData * map)
+{
+    int column = i & (MAP_X * MAP_Y - 1);
+    unsigned long long mask = map->color_mask[column];
+    unsigned long long bit = 1ULL << (i / (MAP_X * MAP_Y));
+    if (!(mask & bit))
+        return;
+    mask &= ~bit;
+    map->color_mask[column] = mask;
+    if (mask == 0) {
+        // give up the slot
+        map->colors_used -= map->color_capacity[column];
+        map->color_capacity[column] = 0;
+        return;
+    }
+    int * data = &map->colors[map->color_offset[column]];
+    int index = count_bits(mask & (bit - 1));
+    int count = count_bits(mask);
+    memmove(data + index, data + index + 1, (count - index) * sizeof(int));
+}
+
 void inline get_xyz(int pos, int* x, int* y, int* z)
 {
     *x = pos % MAP_Y;
@@ -51,21 +272,129 @@ int inline get_solid_wrap(int x, int y, int z, MapData * map)
 
 int inline get_color(int x, int y, int z, MapData * map)
 {
-    map_type<int, int>::const_iterator iter = map->colors.find(
-        get_pos(x, y, z));
-    if (iter == map->colors.end())
+    int color;
+    if (!find_color(get_pos(x, y, z), map, &color))
+        return 0;
+    return color;
+}
+
+void inline add_land(LandIndex * land, int x, int y, int value)
+{
+    for (int i = x + 1; i <= MAP_X; i += i & -i)
+        for (int j = y + 1; j <= MAP_Y; j += j & -j)
+            land->tree[i][j] += value;
+}
+
+// land columns in [0, x) * [0, y)
+
+int inline get_land_prefix(LandIndex * land, int x, int y)
+{
+    int count = 0;
+    for (int i = x; i > 0; i -= i & -i)
+        for (int j = y; j > 0; j -= j & -j)
+            count += land->tree[i][j];
+    return count;
+}
+
+// land columns in [x1, x2) * [y1, y2)
+
+int inline count_land(LandIndex * land, int x1, int y1, int x2, int y2)
+{
+    if (x1 >= x2 || y1 >= y2)
         return 0;
-    return iter->second;
+    return get_land_prefix(land, x2, y2) - get_land_prefix(land, x1, y2) -
+           get_land_prefix(land, x2, y1) + get_land_prefix(land, x1, y1);
+}
+
+LandIndex * get_land(MapData * map);
+HeightMap * get_heights(MapData * map);
+int update_overview(MapData * map);
+
+// called after the voxel at x, y, z has been set
+
+void inline update_heights(int x, int y, int z, MapData * map, bool solid)
+{
+    HeightMap * heights = map->heights;
+    int column = x + y * MAP_X;
+    int top = heights->top[column];
+    int ground = heights->ground[column];
+    if (solid) {
+        if (z < top)
+            heights->top[column] = z;
+        if (z == ground - 1) {
+            while (z > 0 && map->geometry[get_pos(x, y, z - 1)])
+                z--;
+            heights->ground[column] = z;
+        }
+    } else {
+        if (z == top) {
+            while (top < MAP_Z && !map->geometry[get_pos(x, y, top)])
+                top++;
+            heights->top[column] = top;
+        }
+        if (z >= ground)
+            heights->ground[column] = z + 1;
+    }
+}
+
+// every write to the geometry goes through here, so the land index and
+// heightmap stay in sync
+
+void inline set_solid(int i, MapData * map, bool solid)
+{
+    if (map->geometry[i] == solid)
+        return;
+    map->geometry[i] = solid;
+    if (map->land == NULL && map->heights == NULL)
+        return;
+    int x, y, z;
+    get_xyz(i, &x, &y, &z);
+    if (map->land != NULL && z == LAND_Z)
+        add_land(map->land, x, y, solid ? 1 : -1);
+    if (map->heights != NULL)
+        update_heights(x, y, z, map, solid);
+}
+
+// a voxel only shows in the overview if it is at or above the top of its
+// column, so changes below that leave the tile alone
+
+void inline mark_overview(int i, MapData * map)
+{
+    Overview * overview = map->overview;
+    int column = i & (MAP_X * MAP_Y - 1);
+    if (i / (MAP_X * MAP_Y) > map->heights->top[column])
+        return;
+    int tile = (column % MAP_X) / OVERVIEW_TILE +
+        (column / MAP_X) / OVERVIEW_TILE * (MAP_X / OVERVIEW_TILE);
+    if (overview->dirty[tile])
+        return;
+    overview->dirty[tile] = true;
+    overview->dirty_count++;
+}
+
+// called before every change to the voxel at i
+
+void inline log_point(int i, MapData * map)
+{
+    if (map->overview != NULL)
+        mark_overview(i, map);
+    if (map->delta == NULL || map->delta->count(i))
+        return;
+    DeltaEntry & entry = (*map->delta)[i];
+    entry.solid = map->geometry[i];
+    if (!find_color(i, map, &entry.color))
+        entry.color = 0;
 }
 
 void inline set_point(int x, int y, int z, MapData * map, bool solid, int color)
 {
     int i = get_pos(x, y, z);
-    map->geometry[i] = solid;
+    log_point(i, map);
+    set_solid(i, map, solid);
     if (!solid)
-        map->colors.erase(i);
+        erase_color(i, map);
     else
-        map->colors[i] = color;
+        store_color(i, map, color);
 }
 
 void inline set_column_solid(int x, int y, int z_start, int z_end,
@@ -77,7 +406,8 @@ void inline set_column_solid(int x, int y, int z_start, int z_end,
     {
         while (i <= i_end)
         {
-            map->geometry[i] = solid;
+            log_point(i, map);
+            set_solid(i, map, solid);
             i += MAP_X * MAP_Y;
         }
     }
@@ -85,7 +415,8 @@ void inline set_column_solid(int x, int y, int z_start, int z_end,
     {
         while (i <= i_end)
         {
-            map->geometry[i] = solid;
+            log_point(i, map);
+            set_solid(i, map, solid);
             i += MAP_X * MAP_Y;
         }
     }
@@ -98,7 +429,8 @@ void inline set_column_color(int x, int y, int z_start, int z_end,
     int i_end = get_pos(x, y, z_end);
     while (i <= i_end)
     {
-        map->colors[i] = color;
+        log_point(i, map);
+        store_color(i, map, color);
         i += MAP_X * MAP_Y;
     }
 }
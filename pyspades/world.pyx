@@ -38,11 +38,14 @@ cdef extern from "world_c.cpp":
         float orientation_x, float orientation_y, float orientation_z,
         float victim_x, float victim_y, float victim_z, float tolerance)
     int c_can_see "can_see" (MapData * map, float x0, float y0, float z0,
-        float x1, float y1, float z1)
+        float x1, float y1, float z1) nogil
     int c_cast_ray "cast_ray" (MapData * map, float x0, float y0, float z0,
-        float x1, float y1, float z1, float length, long* x, long* y, long* z)
+        float x1, float y1, float z1, float length, long* x, long* y, 
+        long* z) nogil
     size_t cube_line_c "cube_line"(int, int, int, int, int, int, LongVector *)
-    void set_globals(MapData * map, float total_time, float dt)
+    struct WorldContext:
+        MapData * map
+        float ftotclk, fsynctics
     struct PlayerType:
         Vector p, e, v, s, h, f
         int mf, mb, ml, mr
@@ -52,18 +55,25 @@ cdef extern from "world_c.cpp":
         
     struct GrenadeType:
         Vector p, v
+        float fuse
     PlayerType * create_player()
     void destroy_player(PlayerType * player)
     void destroy_grenade(GrenadeType * player)
     void update_timer(float value, float dt)
     void reorient_player(PlayerType * p, Vector * vector) 
-    int move_player(PlayerType * p)
-    void set_globals(MapData * map)
-    int try_uncrouch(PlayerType * p)
+    int try_uncrouch(WorldContext * w, PlayerType * p)
     GrenadeType * create_grenade(Vector * p, Vector * v)
-    int move_grenade(GrenadeType * grenade)
+    int move_grenade(WorldContext * w, GrenadeType * grenade)
+    void move_players(WorldContext * w, PlayerType ** players, long * results,
+                      int count) nogil
+    int move_grenades(WorldContext * w, GrenadeType ** grenades, int count,
+                      int * expired) nogil
     
-from libc.math cimport sqrt
+from libc.math cimport sqrt, floor
+from libc.stdlib cimport realloc, free
+
+# size of a spatial index cell, in blocks
+DEF CELL_SIZE = 16.0
 
 cdef inline bint can_see(VXLData map, float x1, float y1, float z1,
     float x2, float y2, float z2):
@@ -101,15 +111,20 @@ cdef class Object:
 cdef class Character(Object):
     cdef:
         PlayerType * player
+        list cell
+        int cell_x, cell_y
+        int array_index
     cdef public:
         Vertex3 position, orientation, velocity
         object fall_callback
+        object owner
     
     def initialize(self, Vertex3 position, Vertex3 orientation, 
-                   fall_callback = None):
+                   fall_callback = None, owner = None):
         self.name = 'character'
         self.player = create_player()
         self.fall_callback = fall_callback
+        self.owner = owner
         self.position = create_proxy_vector(&self.player.p)
         self.orientation = create_proxy_vector(&self.player.f)
         self.velocity = create_proxy_vector(&self.player.v)
@@ -147,6 +162,7 @@ cdef class Character(Object):
         self.player.p.x = self.player.e.x = x
         self.player.p.y = self.player.e.y = y
         self.player.p.z = self.player.e.z = z
+        self.world.index_character(self)
         if reset:
             self.velocity.set(0.0, 0.0, 0.0)
             self.primary_fire = self.secondary_fire = False 
@@ -207,12 +223,6 @@ cdef class Character(Object):
         self.player.secondary_fire = False
         self.player.sprint = False
         
-    cdef int update(self, double dt) except -1:
-        cdef long ret = move_player(self.player)
-        if ret > 0:
-            self.fall_callback(ret)
-        return 0
-    
     # properties
     property up:
         def __get__(self):
@@ -291,10 +301,10 @@ cdef class Character(Object):
 cdef class Grenade(Object):
     cdef public:
         Vertex3 position, velocity
-        float fuse
         object callback
         object team
     cdef GrenadeType * grenade
+    cdef int array_index
     
     def initialize(self, double fuse, Vertex3 position, Vertex3 orientation, 
                    Vertex3 velocity, callback = None):
@@ -319,7 +329,8 @@ cdef class Grenade(Object):
         cdef double x, y, z
         cdef Vertex3 old_position = self.position.copy()
         cdef Vertex3 old_velocity = self.velocity.copy()
-        while move_grenade(self.grenade) == 0:
+        cdef WorldContext * context = self.world.get_context()
+        while move_grenade(context, self.grenade) == 0:
             eta += dt
             if eta > 5.0:
                 break
@@ -344,16 +355,13 @@ cdef class Grenade(Object):
                 return 100.0
             return 4096.0 / value
         return 0
-        
-    cdef int update(self, double dt) except -1:
-        self.fuse -= dt
-        if self.fuse <= 0:
-            if self.callback is not None:
-                self.callback(self)
-            self.delete()
-            return 0
-        move_grenade(self.grenade)
     
+    property fuse:
+        def __get__(self):
+            return self.grenade.fuse
+        def __set__(self, float value):
+            self.grenade.fuse = value
+        
     def __dealloc__(self):
         destroy_grenade(self.grenade)
 
@@ -362,27 +370,289 @@ cdef class World(object):
         VXLData map
         list objects
         float time
+    cdef:
+        WorldContext context
+        dict cells
+        int character_count
+        # characters and grenades are stepped in one C call each, so their
+        # structs are also kept in arrays in the same order as these lists
+        list characters, grenades, others
+        PlayerType ** player_array
+        long * fall_array
+        int player_size
+        GrenadeType ** grenade_array
+        int * expired_array
+        int grenade_size
 
     def __init__(self):
         self.objects = []
         self.time = 0
+        self.cells = {}
+        self.character_count = 0
+        self.characters = []
+        self.grenades = []
+        self.others = []
+    
+    def __dealloc__(self):
+        free(self.player_array)
+        free(self.fall_array)
+        free(self.grenade_array)
+        free(self.expired_array)
     
     def update(self, double dt):
         if self.map is None:
             return
         self.time += dt
-        set_globals(self.map.map, self.time, dt)
+        self.context.ftotclk = self.time
+        self.context.fsynctics = dt
+        cdef WorldContext * context = self.get_context()
         cdef Object instance
-        for instance in self.objects[:]:
+        for instance in self.others[:]:
             instance.update(dt)
+        cdef int i
+        cdef int player_count = len(self.characters)
+        cdef Character character
+        cdef list falls = []
+        cdef int grenade_count = len(self.grenades)
+        cdef int expired_count
+        with nogil:
+            move_players(context, self.player_array, self.fall_array, 
+                player_count)
+            expired_count = move_grenades(context, self.grenade_array, 
+                grenade_count, self.expired_array)
+        for i in range(player_count):
+            character = self.characters[i]
+            self.index_character(character)
+            if self.fall_array[i] > 0:
+                falls.append((character, self.fall_array[i]))
+        cdef list expired = [self.grenades[self.expired_array[i]]
+            for i in range(expired_count)]
+        # callbacks can create and delete objects, so they are only run once
+        # every object has been moved
+        for character, damage in falls:
+            if character.array_index != -1:
+                character.fall_callback(damage)
+        cdef Grenade grenade
+        for grenade in expired:
+            if grenade.array_index == -1:
+                continue
+            if grenade.callback is not None:
+                grenade.callback(grenade)
+            grenade.delete()
+    
+    cdef WorldContext * get_context(self):
+        self.context.map = self.map.map
+        return &self.context
     
     cpdef delete_object(self, Object item):
         self.objects.remove(item)
+        cdef Character character
+        cdef Grenade grenade
+        cdef int index, last
+        if isinstance(item, Character):
+            character = item
+            self.unindex_character(character)
+            index = character.array_index
+            last = len(self.characters) - 1
+            self.characters[index] = self.characters[last]
+            (<Character>self.characters[index]).array_index = index
+            self.player_array[index] = self.player_array[last]
+            self.characters.pop()
+            character.array_index = -1
+        elif isinstance(item, Grenade):
+            grenade = item
+            index = grenade.array_index
+            last = len(self.grenades) - 1
+            self.grenades[index] = self.grenades[last]
+            (<Grenade>self.grenades[index]).array_index = index
+            self.grenade_array[index] = self.grenade_array[last]
+            self.grenades.pop()
+            grenade.array_index = -1
+        else:
+            self.others.remove(item)
         
     def create_object(self, klass, *arg, **kw):
         new_object = klass(self, *arg, **kw)
         self.objects.append(new_object)
+        if isinstance(new_object, Character):
+            self.add_character(new_object)
+        elif isinstance(new_object, Grenade):
+            self.add_grenade(new_object)
+        else:
+            self.others.append(new_object)
         return new_object
+    
+    cdef int add_character(self, Character character) except -1:
+        cdef int count = len(self.characters)
+        cdef PlayerType ** players
+        cdef long * falls
+        if count == self.player_size:
+            self.player_size = max(8, self.player_size * 2)
+            players = <PlayerType**>realloc(self.player_array,
+                self.player_size * sizeof(PlayerType*))
+            if players == NULL:
+                raise MemoryError()
+            self.player_array = players
+            falls = <long*>realloc(self.fall_array,
+                self.player_size * sizeof(long))
+            if falls == NULL:
+                raise MemoryError()
+            self.fall_array = falls
+        self.player_array[count] = character.player
+        character.array_index = count
+        self.characters.append(character)
+        self.index_character(character)
+        return 0
+    
+    cdef int add_grenade(self, Grenade grenade) except -1:
+        cdef int count = len(self.grenades)
+        cdef GrenadeType ** grenades
+        cdef int * expired
+        if count == self.grenade_size:
+            self.grenade_size = max(8, self.grenade_size * 2)
+            grenades = <GrenadeType**>realloc(self.grenade_array,
+                self.grenade_size * sizeof(GrenadeType*))
+            if grenades == NULL:
+                raise MemoryError()
+            self.grenade_array = grenades
+            expired = <int*>realloc(self.expired_array,
+                self.grenade_size * sizeof(int))
+            if expired == NULL:
+                raise MemoryError()
+            self.expired_array = expired
+        self.grenade_array[count] = grenade.grenade
+        grenade.array_index = count
+        self.grenades.append(grenade)
+        return 0
+    
+    # spatial index
+    
+    cdef int index_character(self, Character character) except -1:
+        cdef int cell_x = <int>floor(character.player.p.x / CELL_SIZE)
+        cdef int cell_y = <int>floor(character.player.p.y / CELL_SIZE)
+        if character.cell is not None:
+            if character.cell_x == cell_x and character.cell_y == cell_y:
+                return 0
+            self.unindex_character(character)
+        key = (cell_x, cell_y)
+        cdef list cell = self.cells.get(key, None)
+        if cell is None:
+            cell = self.cells[key] = []
+        cell.append(character)
+        character.cell = cell
+        character.cell_x = cell_x
+        character.cell_y = cell_y
+        self.character_count += 1
+        return 0
+    
+    cdef int unindex_character(self, Character character) except -1:
+        cdef list cell = character.cell
+        if cell is None:
+            return 0
+        cell.remove(character)
+        if not cell:
+            del self.cells[(character.cell_x, character.cell_y)]
+        character.cell = None
+        self.character_count -= 1
+        return 0
+    
+    cdef list get_cell_characters(self, float x1, float y1, float x2, 
+                                  float y2):
+        cdef int cell_x1 = <int>floor(x1 / CELL_SIZE)
+        cdef int cell_y1 = <int>floor(y1 / CELL_SIZE)
+        cdef int cell_x2 = <int>floor(x2 / CELL_SIZE)
+        cdef int cell_y2 = <int>floor(y2 / CELL_SIZE)
+        cdef list characters = []
+        cdef list cell
+        cdef int cell_x, cell_y
+        if ((cell_x2 - cell_x1 + 1) * (cell_y2 - cell_y1 + 1) > 
+            len(self.cells)):
+            for (cell_x, cell_y), cell in self.cells.iteritems():
+                if (cell_x1 <= cell_x <= cell_x2 and 
+                    cell_y1 <= cell_y <= cell_y2):
+                    characters.extend(cell)
+            return characters
+        for cell_x in xrange(cell_x1, cell_x2 + 1):
+            for cell_y in xrange(cell_y1, cell_y2 + 1):
+                cell = self.cells.get((cell_x, cell_y), None)
+                if cell is not None:
+                    characters.extend(cell)
+        return characters
+    
+    cpdef list get_characters_in_box(self, float x1, float y1, float z1, 
+                                     float x2, float y2, float z2):
+        """
+        Returns the characters whose position is inside the given box
+        """
+        cdef list characters = []
+        cdef Character character
+        cdef Vector * p
+        for character in self.get_cell_characters(x1, y1, x2, y2):
+            p = &character.player.p
+            if (x1 <= p.x <= x2 and y1 <= p.y <= y2 and z1 <= p.z <= z2):
+                characters.append(character)
+        return characters
+    
+    cpdef list get_characters_in_radius(self, float x, float y, float z,
+                                        float radius):
+        """
+        Returns the characters within radius of (x, y, z)
+        """
+        cdef list characters = []
+        cdef Character character
+        cdef Vector * p
+        cdef float max_distance = radius * radius
+        for character in self.get_cell_characters(x - radius, y - radius,
+                                                  x + radius, y + radius):
+            p = &character.player.p
+            if ((p.x - x) ** 2 + (p.y - y) ** 2 + (p.z - z) ** 2 <= 
+                max_distance):
+                characters.append(character)
+        return characters
+    
+    def get_nearest_characters(self, float x, float y, float z, 
+                               int count = 1, max_distance = None):
+        """
+        Returns up to count characters nearest to (x, y, z), nearest first,
+        optionally only those within max_distance
+        """
+        cdef int center_x = <int>floor(x / CELL_SIZE)
+        cdef int center_y = <int>floor(y / CELL_SIZE)
+        cdef list found = []
+        cdef list cell
+        cdef Character character
+        cdef Vector * p
+        cdef int ring = 0, seen = 0, cell_x, cell_y
+        cdef double distance
+        cdef double limit = -1.0
+        if max_distance is not None:
+            limit = max_distance ** 2
+        while seen < self.character_count:
+            # (x, y) can be anywhere in its cell, so characters in this ring
+            # or further out can be as close as one cell less than the ring
+            distance = (max(ring - 1, 0) * CELL_SIZE) ** 2
+            if limit >= 0.0 and distance > limit:
+                break
+            if len(found) >= count and found[count - 1][0] <= distance:
+                break
+            for cell_x in xrange(center_x - ring, center_x + ring + 1):
+                for cell_y in xrange(center_y - ring, center_y + ring + 1):
+                    if (ring and center_x - ring < cell_x < center_x + ring
+                        and center_y - ring < cell_y < center_y + ring):
+                        continue
+                    cell = self.cells.get((cell_x, cell_y), None)
+                    if cell is None:
+                        continue
+                    seen += len(cell)
+                    for character in cell:
+                        p = &character.player.p
+                        distance = ((p.x - x) ** 2 + (p.y - y) ** 2 + 
+                            (p.z - z) ** 2)
+                        if limit < 0.0 or distance <= limit:
+                            found.append((distance, character))
+            found.sort()
+            ring += 1
+        return [character for (distance, character) in found[:count]]
 
 # utility functions
 
@@ -48,10 +48,14 @@
 
 enum damage_index {BODY_TORSO, BODY_HEAD, BODY_ARMS, BODY_LEGS, BODY_MELEE};
 
-// globals to make porting easier
-float ftotclk;
-float fsynctics;
-MapData * global_map;
+// simulation state of a single world, passed to everything that used to
+// read the voxlap globals, so several worlds can be simulated at once
+struct WorldContext
+{
+    MapData * map;
+    float ftotclk; // total time
+    float fsynctics; // time step
+};
 
 struct Orientation
 {
@@ -70,6 +74,7 @@ struct PlayerType
 struct GrenadeType
 {
     Vector p, v;
+    float fuse;
 };
 
 inline void get_orientation(Orientation * o,
@@ -129,7 +134,7 @@ inline void ftol(float f, long *a)
 }
 
 //same as isvoxelsolid but water is empty && out of bounds returns true
-int clipbox(float x, float y, float z)
+int clipbox(MapData * map, float x, float y, float z)
 {
     int sz;
 
@@ -142,21 +147,21 @@ int clipbox(float x, float y, float z)
         sz=62;
     else if (sz >= 64)
         return 1;
-    return get_solid((int)x, (int)y, sz, global_map);
+    return get_solid((int)x, (int)y, sz, map);
 }
 
 //same as isvoxelsolid() but with wrapping
-long isvoxelsolidwrap(long x, long y, long z)
+long isvoxelsolidwrap(MapData * map, long x, long y, long z)
 {
     if (z < 0)
         return 0;
     else if (z >= 64)
         return 1;
-	return get_solid((int)x & VSIDM, (int)y & VSIDM, z, global_map);
+	return get_solid((int)x & VSIDM, (int)y & VSIDM, z, map);
 }
 
 //same as isvoxelsolid but water is empty
-long clipworld(long x, long y, long z)
+long clipworld(MapData * map, long x, long y, long z)
 {
     int sz;
 
@@ -171,7 +176,7 @@ long clipworld(long x, long y, long z)
         return 1;
     else if (sz < 0)
         return 0;
-    return get_solid((int)x, (int)y, sz, global_map);
+    return get_solid((int)x, (int)y, sz, map);
 }
 
 long can_see(MapData * map, float x0, float y0, float z0, float x1, float y1,
@@ -227,7 +232,7 @@ long can_see(MapData * map, float x0, float y0, float z0, float x1, float y1,
             a.y += d.y; p.y += i.z; p.z += i.x;
         }
 
-        if (isvoxelsolidwrap(a.x, a.y, a.z))
+        if (isvoxelsolidwrap(map, a.x, a.y, a.z))
             return 0;
         cnt--;
     }
@@ -290,7 +295,7 @@ long cast_ray(MapData * map, float x0, float y0, float z0, float x1, float y1,
             a.y += d.y; p.y += i.z; p.z += i.x;
         }
 
-        if (isvoxelsolidwrap(a.x, a.y,a.z)) {
+        if (isvoxelsolidwrap(map, a.x, a.y, a.z)) {
             *x = a.x;
             *y = a.y;
             *z = a.z;
@@ -393,12 +398,12 @@ size_t cube_line(int x1, int y1, int z1, int x2, int y2, int z2,
 
 // original C code
 
-void reposition_player(PlayerType * p, Vector * position) 
+void reposition_player(WorldContext * w, PlayerType * p, Vector * position) 
 {
     float f; /* FIXME meaningful name */
 
     p->e = p->p = *position;
-    f = p->lastclimb-ftotclk; /* FIXME meaningful name */
+    f = p->lastclimb-w->ftotclk; /* FIXME meaningful name */
     if(f>-0.25f)
         p->e.z += (f+0.25f)/0.25f;
 }
@@ -419,7 +424,7 @@ void reorient_player(PlayerType * p, Vector * orientation)
     set_orientation_vectors(orientation, &p->s, &p->h);
 }
 
-int try_uncrouch(PlayerType * p)
+int try_uncrouch(WorldContext * w, PlayerType * p)
 {
     float x1 = p->p.x + 0.45f;
     float x2 = p->p.x - 0.45f;
@@ -430,16 +435,16 @@ int try_uncrouch(PlayerType * p)
 
     //first check if player can lower feet (in midair)
     if(p->airborne && !(
-        clipbox(x1, y1, z1) ||
-        clipbox(x1, y2, z1) ||
-        clipbox(x2, y1, z1) ||
-        clipbox(x2, y2, z1)))
+        clipbox(w->map, x1, y1, z1) ||
+        clipbox(w->map, x1, y2, z1) ||
+        clipbox(w->map, x2, y1, z1) ||
+        clipbox(w->map, x2, y2, z1)))
         return(1);
     //then check if they can raise their head
-    else if(!(clipbox(x1, y1, z2) ||
-        clipbox(x1, y2, z2) ||
-        clipbox(x2, y1, z2) ||
-        clipbox(x2, y2, z2)))
+    else if(!(clipbox(w->map, x1, y1, z2) ||
+        clipbox(w->map, x1, y2, z2) ||
+        clipbox(w->map, x2, y1, z2) ||
+        clipbox(w->map, x2, y2, z2)))
     {
         p->p.z -= 0.9f;
         p->e.z -= 0.9f;
@@ -449,12 +454,12 @@ int try_uncrouch(PlayerType * p)
 }
 
 //player movement with autoclimb
-void boxclipmove(PlayerType * p)
+void boxclipmove(WorldContext * w, PlayerType * p)
 {
 	float offset, m, f, nx, ny, nz, z;
 	long climb = 0;
 
-	f = fsynctics*32.f;
+	f = w->fsynctics*32.f;
 	nx = f*p->v.x+p->p.x;
 	ny = f*p->v.y+p->p.y;
 
@@ -474,13 +479,13 @@ void boxclipmove(PlayerType * p)
 	if(p->v.x < 0) f = -0.45f;
 	else f = 0.45f;
 	z=m;
-	while(z>=-1.36f && !clipbox(nx+f, p->p.y-0.45f, nz+z) && !clipbox(nx+f, p->p.y+0.45f, nz+z))
+	while(z>=-1.36f && !clipbox(w->map, nx+f, p->p.y-0.45f, nz+z) && !clipbox(w->map, nx+f, p->p.y+0.45f, nz+z))
 		z-=0.9f;
 	if(z<-1.36f) p->p.x = nx;
 	else if(!p->crouch && p->f.z<0.5f && !p->sprint)
 	{
 		z=0.35f;
-		while(z>=-2.36f && !clipbox(nx+f, p->p.y-0.45f, nz+z) && !clipbox(nx+f, p->p.y+0.45f, nz+z))
+		while(z>=-2.36f && !clipbox(w->map, nx+f, p->p.y-0.45f, nz+z) && !clipbox(w->map, nx+f, p->p.y+0.45f, nz+z))
 			z-=0.9f;
 		if(z<-2.36f)
 		{
@@ -494,13 +499,13 @@ void boxclipmove(PlayerType * p)
 	if(p->v.y < 0) f = -0.45f;
 	else f = 0.45f;
 	z=m;
-	while(z>=-1.36f && !clipbox(p->p.x-0.45f, ny+f, nz+z) && !clipbox(p->p.x+0.45f, ny+f, nz+z))
+	while(z>=-1.36f && !clipbox(w->map, p->p.x-0.45f, ny+f, nz+z) && !clipbox(w->map, p->p.x+0.45f, ny+f, nz+z))
 		z-=0.9f;
 	if(z<-1.36f) p->p.y = ny;
 	else if(!p->crouch && p->f.z<0.5f && !p->sprint && !climb)
 	{
 		z=0.35f;
-		while(z>=-2.36f && !clipbox(p->p.x-0.45f, ny+f, nz+z) && !clipbox(p->p.x+0.45f, ny+f, nz+z))
+		while(z>=-2.36f && !clipbox(w->map, p->p.x-0.45f, ny+f, nz+z) && !clipbox(w->map, p->p.x+0.45f, ny+f, nz+z))
 			z-=0.9f;
 		if(z<-2.36f)
 		{
@@ -516,7 +521,7 @@ void boxclipmove(PlayerType * p)
 	{
 		p->v.x *= 0.5f;
 		p->v.y *= 0.5f;
-		p->lastclimb = ftotclk;
+		p->lastclimb = w->ftotclk;
 		nz--;
 		m = -1.35f;
 	}
@@ -524,15 +529,15 @@ void boxclipmove(PlayerType * p)
 	{
 		if(p->v.z < 0)
 			m=-m;
-		nz += p->v.z*fsynctics*32.f;
+		nz += p->v.z*w->fsynctics*32.f;
 	}
 
 	p->airborne = 1;
 
-	if(clipbox(p->p.x-0.45f, p->p.y-0.45f, nz+m) ||
-		clipbox(p->p.x-0.45f, p->p.y+0.45f, nz+m) ||
-		clipbox(p->p.x+0.45f, p->p.y-0.45f, nz+m) ||
-		clipbox(p->p.x+0.45f, p->p.y+0.45f, nz+m))
+	if(clipbox(w->map, p->p.x-0.45f, p->p.y-0.45f, nz+m) ||
+		clipbox(w->map, p->p.x-0.45f, p->p.y+0.45f, nz+m) ||
+		clipbox(w->map, p->p.x+0.45f, p->p.y-0.45f, nz+m) ||
+		clipbox(w->map, p->p.x+0.45f, p->p.y+0.45f, nz+m))
 	{
 		if(p->v.z >= 0)
 		{
@@ -544,10 +549,10 @@ void boxclipmove(PlayerType * p)
 	else
 		p->p.z = nz-offset;
 
-	reposition_player(p, &p->p);
+	reposition_player(w, p, &p->p);
 }
 
-long move_player(PlayerType *p)
+long move_player(WorldContext * w, PlayerType *p)
 {
 	float f, f2;
 
@@ -558,7 +563,7 @@ long move_player(PlayerType *p)
 		p->v.z = -0.36f;
 	}
 
-	f = fsynctics; //player acceleration scalar
+	f = w->fsynctics; //player acceleration scalar
 	if(p->airborne)
 		f *= 0.1f;
 	else if(p->crouch)
@@ -592,17 +597,17 @@ long move_player(PlayerType *p)
 		p->v.y += p->s.y*f;
 	}
 
-	f = fsynctics + 1;
-	p->v.z += fsynctics;
+	f = w->fsynctics + 1;
+	p->v.z += w->fsynctics;
 	p->v.z /= f; //air friction
 	if(p->wade)
-		f = fsynctics*6.f + 1; //water friction
+		f = w->fsynctics*6.f + 1; //water friction
 	else if(!p->airborne)
-		f = fsynctics*4.f + 1; //ground friction
+		f = w->fsynctics*4.f + 1; //ground friction
 	p->v.x /= f;
 	p->v.y /= f;
 	f2 = p->v.z;
-	boxclipmove(p);
+	boxclipmove(w, p);
 	//hit ground... check if hurt
 	if(!p->v.z && (f2 > FALL_SLOW_DOWN))
 	{
@@ -628,16 +633,17 @@ GrenadeType * create_grenade(Vector * p, Vector * v)
     GrenadeType * g = new GrenadeType;
     g->p = *p;
     g->v = *v;
+    g->fuse = 0.0f;
     return g;
 }
 
 // returns 1 if there was a collision, 2 if sound should be played
-int move_grenade(GrenadeType * g)
+int move_grenade(WorldContext * w, GrenadeType * g)
 {
     Vector fpos = g->p; //old position
     //do velocity & gravity (friction is negligible)
-    float f = fsynctics*32;
-    g->v.z += fsynctics;
+    float f = w->fsynctics*32;
+    g->v.z += w->fsynctics;
     g->p.x += g->v.x*f;
     g->p.y += g->v.y*f;
     g->p.z += g->v.z*f;
@@ -655,7 +661,7 @@ int move_grenade(GrenadeType * g)
     
     int ret = 0;
     
-    if(clipworld(lp.x, lp.y, lp.z))  //hit a wall
+    if(clipworld(w->map, lp.x, lp.y, lp.z))  //hit a wall
     {
         #define BOUNCE_SOUND_THRESHOLD 0.1f
         
@@ -669,11 +675,11 @@ int move_grenade(GrenadeType * g)
         lp2.x = (long)floor(fpos.x);
         lp2.y = (long)floor(fpos.y);
         lp2.z = (long)floor(fpos.z);
-        if (lp.z != lp2.z && ((lp.x == lp2.x && lp.y == lp2.y) || !clipworld(lp.x, lp.y, lp2.z)))
+        if (lp.z != lp2.z && ((lp.x == lp2.x && lp.y == lp2.y) || !clipworld(w->map, lp.x, lp.y, lp2.z)))
             g->v.z = -g->v.z;
-        else if(lp.x != lp2.x && ((lp.y == lp2.y && lp.z == lp2.z) || !clipworld(lp2.x, lp.y, lp.z)))
+        else if(lp.x != lp2.x && ((lp.y == lp2.y && lp.z == lp2.z) || !clipworld(w->map, lp2.x, lp.y, lp.z)))
             g->v.x = -g->v.x;
-        else if(lp.y != lp2.y && ((lp.x == lp2.x && lp.z == lp2.z) || !clipworld(lp.x, lp2.y, lp.z)))
+        else if(lp.y != lp2.y && ((lp.x == lp2.x && lp.z == lp2.z) || !clipworld(w->map, lp.x, lp2.y, lp.z)))
             g->v.y = -g->v.y;
         g->p = fpos; //set back to old position
         g->v.x *= 0.36f;
@@ -683,6 +689,36 @@ int move_grenade(GrenadeType * g)
     return ret;
 }
 
+// moves every player, storing what move_player returned for each one in
+// results
+void move_players(WorldContext * w, PlayerType ** players, long * results,
+                  int count)
+{
+    for(int i = 0; i < count; i++)
+        results[i] = move_player(w, players[i]);
+}
+
+// counts down the fuse of every grenade and moves the ones that are still
+// live. the indices of the grenades whose fuse ran out are written to
+// expired, and their number is returned
+int move_grenades(WorldContext * w, GrenadeType ** grenades, int count,
+                  int * expired)
+{
+    int expired_count = 0;
+    for(int i = 0; i < count; i++)
+    {
+        GrenadeType * g = grenades[i];
+        g->fuse -= w->fsynctics;
+        if(g->fuse <= 0)
+        {
+            expired[expired_count++] = i;
+            continue;
+        }
+        move_grenade(w, g);
+    }
+    return expired_count;
+}
+
 // C interface
 
 PlayerType * create_player()
@@ -711,10 +747,3 @@ void destroy_grenade(GrenadeType * grenade)
 {
     delete grenade;
 }
-
-void set_globals(MapData * map, float time, float dt)
-{
-    global_map = map;
-    ftotclk = time;
-    fsynctics = dt;
-}
\ No newline at end of file